@@ -4,22 +4,48 @@ Extracts and evaluates data points from DICOM RTPLAN files.
 This file covers the high level process of handling input and processing dicoms 
 '''
 
-import pydicom 
+import io
 import os
+import sqlite3
 import argparse
 from pathlib import Path
-from code_files import strings
-from code_files.outputter import output
+from code_files import strings, metrics, memory, archives
+from code_files.dicom_loader import read_header, read_plan
+from code_files.discovery import find_dicoms
+from code_files.dose_struct_index import build_index, update_index
+from code_files.outputter import output, output_path, open_report
+from code_files.result_cache import ResultCache
 from code_files.truth_table_reader import read_truth_table
-from code_files.parameters.parameter_retrieval import extract_parameters, evaluate_parameters
+from code_files.parameters.parameter_retrieval import extract_parameters, evaluate_parameters, evaluate_combinations
 
 silent = None
 skip_dose_structure = None
+cache_folder = None
+result_cache = None
+per_file_output = True
+metrics_file = None
+prefetch = 0
+low_memory = False
+memory_guard = None
+# Whether to work out the case number of plans without one, and where plans whose case is unclear are listed
+auto_case = False
+review_list = None
+# [(name, truth table), ...] when plans are evaluated against several truth tables or cases in one run
+truth_tables = None
+# Options for finding the DICOMs in a folder (see code_files/discovery.py)
+discovery = {}
+# The database every run's results are added to, if any (see code_files/results_store.py)
+results_store = None
+
+# Settings which are copied into the worker processes of a parallel batch, and the state shared with them
+worker_settings = ["silent", "skip_dose_structure", "result_cache", "per_file_output", "metrics_file", "low_memory", "auto_case", "truth_tables"]
+worker_state = None
 
 def main():
     ''' Handles input arguments and processes the dicoms'''
 
-    global silent, skip_dose_structure
+    global silent, skip_dose_structure, cache_folder, result_cache, per_file_output, metrics_file, prefetch
+    global low_memory, memory_guard, auto_case, review_list, truth_tables, results_store
 
     # Retrieve user inputs and settings from command line arguments
     user_input = parse_arguments()
@@ -31,12 +57,46 @@ def main():
     output = user_input["output"] if user_input["output"] else properties["default_output_folder"]
     silent = True if properties["silent_run"].lower() == "true" else False
     skip_dose_structure = True if properties["skip_dose_structure"].lower() == "true" else False
-    case_number = user_input["case_number"]
-    truth_table_file = user_input["truth_table_file"] if user_input["truth_table_file"] else properties["truth_table_file"]
-    truth_table = read_truth_table(truth_table_file) 
+    cache_folder = properties.get("cache_folder") or None
+    case_numbers = user_input["case_number"]
+    settings_tables = [filepath.strip() for filepath in properties["truth_table_file"].split('*')]
+    truth_table_files = user_input["truth_table_file"] if user_input["truth_table_file"] else settings_tables
+    tables = [read_truth_table(filepath) for filepath in truth_table_files]
+    truth_table_file, truth_table = truth_table_files[0], tables[0]
+    case_number = case_numbers[0] if case_numbers else None
+    # Several truth tables or cases: each plan is extracted once and evaluated against every table and case
+    if len(tables) > 1 or (case_numbers and len(case_numbers) > 1):
+        truth_tables = list(zip(table_names(truth_table_files), tables))
+        case_number = case_numbers
+    workers = user_input["workers"] if user_input["workers"] is not None else int(properties.get("workers", 1))
+    metrics_file = user_input["metrics"] if user_input["metrics"] else properties.get("metrics_file") or None
+    metrics.enabled = bool(metrics_file)
+    prefetch = user_input["prefetch"] if user_input["prefetch"] is not None else int(properties.get("prefetch", 0))
+    discovery.update(
+        recursive=user_input["recursive"] or properties.get("recursive", "false").lower() == "true",
+        include=user_input["include"] or split_patterns(properties.get("include", "")),
+        exclude=user_input["exclude"] or split_patterns(properties.get("exclude", "")),
+        detect=user_input["detect_dicom"] or properties.get("detect_dicom", "false").lower() == "true",
+        threads=int(properties.get("discovery_threads", 4)))
+
+    # A memory limit also turns on low memory mode, so that each plan takes as little memory as possible
+    max_memory = user_input["max_memory"] or properties.get("max_memory") or None
+    if max_memory:
+        try:
+            memory_guard = memory.MemoryGuard(memory.parse_size(max_memory))
+        except ValueError as error:
+            exit(str(error))
+        if not memory_guard.measurable:
+            info_print("The memory used can't be measured on this system (install psutil): --max_memory is ignored")
+    low_memory = user_input["low_memory"] or properties.get("low_memory", "false").lower() == "true" or bool(memory_guard)
+    auto_case = user_input["auto_case"] or properties.get("auto_case", "false").lower() == "true"
 
     # Print truth table being applied: this can be confusing for the user due to the settings file defaulting to lvl3
-    info_print(f"\nUsing truth table: {truth_table_file}\n")
+    info_print(f"\nUsing truth table{'s' if len(tables) > 1 else ''}: {', '.join(truth_table_files)}\n")
+    for filepath, table in zip(truth_table_files, tables):
+        where = f"{filepath} case" if len(tables) > 1 else "case"
+        for case, parameter, value, error in table.errors:
+            info_print(f"{strings.TRUTH_TABLE_ERROR}: {where} {case}, {parameter} <{value}>: {error}")
     
     # Create the output folder if it doesn't exist
     if not os.path.isdir(output):
@@ -44,63 +104,478 @@ def main():
             os.mkdir(output)
         except FileNotFoundError:
             exit(f"Tried creating the output directory <{output}>, but the location <{Path(output).resolve().parent}> doesn't exist!")
+    if cache_folder:
+        os.makedirs(cache_folder, exist_ok=True)
+        # Cached results are kept per truth table, so they aren't used when comparing several
+        if not user_input["no_cache"] and not truth_tables:
+            max_size = int(float(properties.get("cache_size_mb", 256)) * 1024 * 1024)
+            result_cache = ResultCache(os.path.join(cache_folder, "results.sqlite"), truth_table_file, max_size)
+
+    # Results are kept for looking at across runs by whichever process merges them into a report
+    store_file = user_input["store"] or properties.get("results_store") or None
+    if store_file and user_input["shard"] != "work" and user_input["serve"] is None:
+        from code_files.results_store import ResultsStore
+        try:
+            results_store = ResultsStore(store_file)
+        except sqlite3.Error as error:
+            exit(f"Could not open the results store <{store_file}>: {error}")
+        results_store.start_run(truth_table_files, inputs)
+
+    # Batches spread over several computers are processed by their workers, see code_files/sharding.py
+    if user_input["shard"]:
+        shard_queue = user_input["shard_queue"] or properties.get("shard_queue") or None
+        if not shard_queue:
+            exit("A sharded batch needs a queue on storage shared by its workers: use --shard_queue FILE")
+        run_sharded(user_input["shard"], shard_queue, inputs, output, case_number, truth_table_files,
+                    workers, user_input["report"] or properties.get("report_file") or None, user_input["per_file"],
+                    int(properties.get("shard_size", 50)))
+        close_results_store()
+        return
+
+    # Serve plan checks to other programs instead of processing the inputs, keeping everything loaded in between
+    if user_input["serve"] is not None:
+        from code_files import server
+        address = user_input["serve"] or properties.get("serve_address") or server.default_address
+        plans = server.PlanServer(dict(zip(table_names(truth_table_files), tables)), workers, low_memory,
+                                  None if skip_dose_structure else dose_struct_references)
+        try:
+            server.serve(address, plans, info_print)
+        except (ValueError, OSError) as error:
+            plans.close()
+            exit(f"Could not serve plan checks at <{address}>: {error}")
+        return
+
+    # Plans whose case can't be worked out are listed for review, instead of prompting for their case
+    if auto_case:
+        from code_files.case_classifier import ReviewList
+        review_list = ReviewList(user_input["review"] or properties.get("review_file") or os.path.join(output, "review.csv"))
+
+    # A consolidated report replaces the per-file reports, unless they are also asked for
+    # Comparisons of several truth tables or cases always make one, with a column for the truth table
+    report_file = user_input["report"] if user_input["report"] else properties.get("report_file") or None
+    if truth_tables and not report_file:
+        report_file = os.path.join(output, "combined_report.csv")
+    report = None
+    if report_file:
+        per_file_output = user_input["per_file"]
+        try:
+            report = open_report(report_file, truth_tables=bool(truth_tables))
+        except (ValueError, ImportError, OSError) as error:
+            exit(f"Could not create the report <{report_file}>: {error}")
+
+    # Profiling covers only the thread it runs in, so a profiled batch is processed serially, without a pipeline
+    profiler = None
+    if user_input["profile"]:
+        from code_files.profiling import Profiler
+        if workers > 1:
+            info_print(f"Profiling: processing serially instead of with {workers} workers")
+            workers = 1
+        if prefetch:
+            info_print(f"Profiling: processing without a pipeline instead of prefetching {prefetch} plans")
+            prefetch = 0
+        profiler = Profiler(user_input["profile"], top=user_input["profile_top"], slowest=user_input["profile_slowest"])
+        profiler.start()
 
     # Look for the given file or files or directories (aka folders) and process them
-    for location in inputs:
-        process_location(location, output, case_number, truth_table)
+    # The metrics and profile are saved even if a plan fails, as they are most useful then
+    run_info = dict(truth_table=truth_table_file if not truth_tables else truth_table_files, inputs=inputs, workers=workers)
+    try:
+        for location in inputs:
+            process_location(location, output, case_number, truth_table, workers, report)
+
+        # Then keep processing new plans as they arrive in the folders, until stopped
+        if user_input["watch"]:
+            settle_time = float(properties.get("watch_settle_seconds", 2))
+            poll_interval = float(properties.get("watch_poll_seconds", 5))
+            watch_locations(inputs, output, case_number, truth_table, report, settle_time, poll_interval, run_info)
+    finally:
+        if profiler:
+            info_print("\nProfile saved to " + ", ".join(profiler.stop()))
+        if metrics_file:
+            save_metrics(metrics_file, **run_info)
+    if report:
+        report.close()
+        info_print(f"\nReport saved to {report_file}")
+    if review_list and review_list.count:
+        review_list.close()
+        info_print(f"\nThe case of {review_list.count} plan(s) couldn't be worked out: they are listed in {review_list.filepath}")
+    close_results_store()
     print()
 
-def process_location(location, output, case_number, truth_table):
-    # Check if input item has case number attached
+def close_results_store():
+    if results_store:
+        results_store.close()
+        info_print(f"\nResults of {results_store.count} plan(s) added to {results_store.store_file}")
+
+def save_metrics(filepath, announce=True, **run_info):
+    ''' Saves the metrics of the run as JSON to filepath, and in the Prometheus text format next to it (as .prom)'''
+    metrics.export_json(filepath, **run_info)
+    prometheus_file = os.path.splitext(filepath)[0] + ".prom"
+    metrics.export_prometheus(prometheus_file)
+    if announce:
+        info_print(f"\nMetrics saved to {filepath} and {prometheus_file}")
+
+def run_sharded(role, shard_queue, inputs, output, case_number, truth_table_files, workers=1, report_file=None,
+                per_file=False, shard_size=50):
+    ''' Runs one part of a sharded batch (see code_files/sharding.py)
+
+    role        - "coordinate": writes the manifest of the inputs to shard_queue, starts a number of workers on this
+                    computer (workers, which may be 0), waits for the shards to be done and merges their results into
+                    report_file
+                  "work": processes the shards of shard_queue
+                  "merge": merges the results of the shards of shard_queue that are done into report_file
+    '''
+    from code_files import sharding
+    if role == "coordinate":
+        if os.path.exists(shard_queue):
+            exit(f"The queue <{shard_queue}> already exists: merge it with --shard merge, or delete it to start again")
+        # Each input may have its own case (FOLDER,CASE), so the case is checked for each input in turn
+        for location in inputs:
+            if split_location(location, case_number)[1] is None and not auto_case:
+                exit(f"Workers can't ask for case numbers: give one for <{location}> with -c (or as {location},CASE), or use --auto_case")
+        os.makedirs(output, exist_ok=True)
+
+        def plans():
+            for location in inputs:
+                location, location_case = split_location(location, case_number)
+                if os.path.isfile(location) and not archives.is_archive(location) or archives.split_member(location):
+                    yield os.path.abspath(location), None, location_case
+                else:
+                    for entry in find_dicoms(location, **discovery):
+                        yield os.path.abspath(entry.path), os.path.abspath(location), location_case
+
+        with metrics.timer("manifest"):
+            queue = sharding.WorkQueue(shard_queue)
+            shards = queue.create(plans(), dict(truth_table_files=[os.path.abspath(filepath) for filepath in truth_table_files],
+                                                case_number=case_number, output=os.path.abspath(output),
+                                                per_file=per_file, auto_case=auto_case), shard_size)
+            queue.close()
+        info_print(f"Wrote {shards} shard(s) of up to {shard_size} plans to {shard_queue}")
+
+        # Workers on this computer are separate processes, just like workers on other computers
+        import subprocess, sys
+        local_workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "--shard", "work", "--shard_queue", shard_queue])
+                         for worker in range(workers)]
+        sharding.wait(shard_queue, log=info_print)
+        for worker in local_workers:
+            worker.wait()
+
+    if role == "work":
+        work_shards(shard_queue)
+        return
+
+    # Merge the results of the finished shards into one report
+    settings = sharding.WorkQueue(shard_queue).settings()
+    report_file = report_file or os.path.join(settings["output"], "report.csv")
+    tables = len(settings["truth_table_files"]) > 1 or isinstance(settings["case_number"], list)
+    try:
+        report = open_report(report_file, truth_tables=tables)
+    except (ValueError, ImportError, OSError) as error:
+        exit(f"Could not create the report <{report_file}>: {error}")
+    global review_list
+    if settings["auto_case"] and review_list is None:
+        from code_files.case_classifier import ReviewList
+        review_list = ReviewList(os.path.join(settings["output"], "review.csv"))
+    failed, unfinished = [], []
+    with report:
+        for shard, result in sharding.merge(shard_queue):
+            if result is None:
+                unfinished.append(shard)
+            elif "error" in result:
+                failed.append(result["message"])
+            else:
+                record = result["record"]
+                if record and "review" in record:
+                    from code_files.case_classifier import Classification
+                    record["review"] = Classification(**record["review"])
+                if record and "reviews" in record:
+                    from code_files.case_classifier import Classification
+                    record["reviews"] = [(name, Classification(**review)) for name, review in record["reviews"]]
+                report_record(record, report)
+    info_print(f"\nReport saved to {report_file}")
+    for message in failed:
+        info_print(message)
+    if unfinished:
+        info_print(f"The plans of shard(s) {', '.join(map(str, unfinished))} aren't in the report, as they aren't done")
+    if review_list and review_list.count:
+        review_list.close()
+        info_print(f"The case of {review_list.count} plan(s) couldn't be worked out: they are listed in {review_list.filepath}")
+
+def work_shards(shard_queue):
+    ''' Processes the shards of a queue with the truth tables, cases and output folder of its coordinator'''
+    global truth_tables, per_file_output, auto_case
+    from code_files import sharding
+    queue = sharding.WorkQueue(shard_queue)
+    settings = queue.settings()
+    queue.close()
+    truth_table_files, output = settings["truth_table_files"], settings["output"]
+    tables = [read_truth_table(filepath) for filepath in truth_table_files]
+    if len(tables) > 1 or isinstance(settings["case_number"], list):
+        truth_tables = list(zip(table_names(truth_table_files), tables))
+    per_file_output, auto_case = settings["per_file"], settings["auto_case"]
+
+    indexes = {}
+    def process_plan(path, input_folder, case_number):
+        folder = input_folder or os.path.dirname(path)
+        if folder not in indexes:
+            indexes[folder] = dose_struct_references(folder)
+        return process_dicom(path, output, case_number, tables[0], indexes[folder], input_folder)
+
+    finished = sharding.work(shard_queue, process_plan, log=info_print)
+    info_print(f"\nNo shards left to process: this worker finished {finished}")
+
+def table_names(filepaths):
+    ''' The names of truth tables in reports: their filenames without the extension, or their paths if those clash'''
+    names = [os.path.splitext(os.path.basename(filepath))[0] for filepath in filepaths]
+    return [name if names.count(name) == 1 else filepath for name, filepath in zip(names, filepaths)]
+
+def split_patterns(setting):
+    ''' Splits a setting holding a comma separated list of glob patterns'''
+    return [pattern.strip() for pattern in setting.split(",") if pattern.strip()]
+
+def split_location(location, case_number):
+    ''' Splits an input location, which may have a case number attached ("folder,7"), into its path and case number'''
     input_item = location.split(",")
     if len(input_item) == 2:
-        location = Path(input_item[0])
-        case_number = int(input_item[1])
-    else:
-        location = Path(location)
+        return Path(input_item[0]), int(input_item[1])
+    return Path(location), case_number
+
+def process_location(location, output, case_number, truth_table, workers=1, report=None):
+    # Check if input item has case number attached
+    location, case_number = split_location(location, case_number)
 
-    # Handle the location where a file is specified
-    if os.path.isfile(location):
-        folder_path = Path(os.path.dirname(location))
+    # Handle the location where a file is specified. The dose and structure files of a member of an archive are
+    # looked for in the rest of the archive.
+    member = archives.split_member(location)
+    if member or (os.path.isfile(location) and not archives.is_archive(location)):
+        folder_path = Path(member[0] if member else os.path.dirname(location))
         dose_struct_index = dose_struct_references(folder_path)
-        process_dicom(location, output, case_number, truth_table, dose_struct_index)
+        dicom_paths = [location]
 
-    # Handle the location where a folder is specified
+    # Handle the location where a folder (or an archive, which is searched like a folder) is specified
     else:
         # First we scan through the entire folder once to find out what dose and structure files we have
         dose_struct_index = dose_struct_references(location)
         # Then, scan through the folder and process each RTPLAN DICOM
-        with os.scandir(location) as folder:
-            for item in folder:
-                if item.is_file() and item.name.endswith(".dcm"):
-                    result = process_dicom(item.path, output, case_number, truth_table, dose_struct_index)
-                    info_print(result)
-        
+        # The DICOMs are found in the same order on every run, and processing starts as soon as the first is found
+        dicom_paths = (entry.path for entry in find_dicoms(location, **discovery))
+
+    if (workers > 1 or prefetch) and case_number is None and not auto_case:
+        # Worker processes and pipeline threads can't prompt for a case number, so fall back to processing one at a time
+        info_print(f"No case number given for {location}: processing one DICOM at a time")
+        workers = 1
+        pipelined = False
+    else:
+        pipelined = prefetch > 0
+
+    # The reports of DICOMs found in subfolders are saved in the same subfolders of the output folder
+    input_folder = location if os.path.isdir(location) or archives.is_archive(location) else None
+    if workers > 1 and input_folder:
+        results = process_in_parallel(list(dicom_paths), output, case_number, truth_table, dose_struct_index, workers, input_folder)
+    elif pipelined and input_folder:
+        results = process_pipelined(dicom_paths, output, case_number, truth_table, dose_struct_index, prefetch, input_folder)
+    else:
+        results = (process_dicom(path, output, case_number, truth_table, dose_struct_index, input_folder) for path in dicom_paths)
+    for message, record in results:
+        handle_result(message, record, report)
+
+def handle_result(message, record, report=None):
+    ''' Prints the message returned by process_dicom, and adds its record to the batch report
+        (or, for a plan whose case couldn't be worked out, to the review list)
+    '''
+    info_print(message)
+    report_record(record, report)
+
+def report_record(record, report=None):
+    ''' Adds a record returned by process_dicom to the batch report and the results store, or to the review list'''
+    if record and "results" in record:
+        # A plan evaluated against several truth tables or cases (see evaluate_combinations)
+        for name, classification in record["reviews"]:
+            review_list.add(f"{record['location']} ({name})", classification)
+        if report:
+            with metrics.timer("report"):
+                for result in record["results"]:
+                    report.write(location=record["location"], **result)
+        if results_store:
+            with metrics.timer("store"):
+                for result in record["results"]:
+                    results_store.add(record["location"], identifiers=record.get("identifiers"), **result)
+    elif record and "review" in record:
+        review_list.add(record["location"], record["review"])
+    elif record:
+        fields = dict(record)
+        identifiers = fields.pop("identifiers", None)
+        if report:
+            with metrics.timer("report"):
+                report.write(**fields)
+        if results_store:
+            with metrics.timer("store"):
+                results_store.add(identifiers=identifiers, **fields)
+
+def watch_locations(inputs, output, case_number, truth_table, report=None, settle_time=2.0, poll_interval=5.0, run_info=None):
+    ''' Function to keep processing the DICOMs that are added to (or modified in) the input folders, until interrupted
+
+    The dose/struct index of each folder and the truth table stay in memory, and only the new arrivals are read.
+    New dose and structure files are added to the index before any plans that arrived with them are processed.
+    The DICOMs watched for are the ones a batch run would find in each folder, with the same discovery options.
+    A case number is needed for each folder (unless cases are worked out with --auto_case), since there may be
+    nobody around to be asked for one.
+    '''
+    from code_files.watcher import FolderWatcher
+
+    # {folder: (case number, dose/struct index)}
+    watched = {}
+    for location in inputs:
+        location, location_case = split_location(location, case_number)
+        if not os.path.isdir(location):
+            info_print(f"Only folders can be watched: <{location}> will not be watched")
+            continue
+        if location_case is None and not auto_case:
+            exit(f"A case number is needed to watch <{location}>: use -c or give the folder as {location},CASE")
+        watched[os.path.abspath(location)] = (location_case, dose_struct_references(location))
+    if not watched:
+        return
+
+    # Stopping the watch from a service manager (SIGTERM) is handled the same way as Ctrl+C
+    import signal
+    signal.signal(signal.SIGTERM, _stop_watching)
+
+    with FolderWatcher(list(watched), settle_time=settle_time, poll_interval=poll_interval, discovery=discovery) as watcher:
+        info_print(f"\nWatching {', '.join(watched)} for new plans ({watcher.method}). Press Ctrl+C to stop.")
+        try:
+            for paths in watcher.changes():
+                plans = []
+                for path in paths:
+                    folder = _watched_folder(watched, path)
+                    folder_case, dose_struct_index = watched[folder]
+                    if dose_struct_index is not None:
+                        header = read_header(path)
+                        modality, uid = header.get("Modality"), header.get("StudyInstanceUID")
+                        modality = str(modality) if modality is not None else None
+                        update_index(dose_struct_index, path, str(uid) if uid is not None else None, modality)
+                        if modality in [strings.RTDOSE, strings.RTSTRUCT]:
+                            info_print("{:10} {}".format("INDEXED", path))
+                            continue
+                    plans.append((path, folder, folder_case, dose_struct_index))
+
+                for path, folder, folder_case, dose_struct_index in plans:
+                    handle_result(*process_dicom(path, output, folder_case, truth_table, dose_struct_index, folder), report)
+                if report:
+                    report.flush()
+                if results_store:
+                    results_store.flush()
+                if metrics_file:
+                    save_metrics(metrics_file, False, **(run_info or {}))
+        except KeyboardInterrupt:
+            info_print("\nStopped watching")
+
+def _watched_folder(watched, path):
+    ''' The watched folder that path was found in: the innermost one, if one watched folder is inside another'''
+    return max((folder for folder in watched if os.path.commonpath([folder, path]) == folder), key=len)
+
+def _stop_watching(signum, frame):
+    raise KeyboardInterrupt
+
+def process_pipelined(dicom_paths, output, case_number, truth_table, dose_struct_index, prefetch, input_folder=None):
+    ''' Function to process a batch of DICOMs in a pipeline, so that reading the next DICOMs overlaps with
+        extracting and evaluating the current one, and with writing the reports of the previous one.
+        Up to prefetch DICOMs are read ahead, by as many reader threads.
+        Yields the result of process_dicom for each path, in the same order as dicom_paths.
+    '''
+    from time import perf_counter
+    from code_files.pipeline import run_pipeline
+
+    # The time each plan spends in the stages (but not waiting between them) is recorded as the process_dicom timer,
+    # so that the slowest plans show up in the metrics as they do when plans are processed one at a time
+    def read(location):
+        start = perf_counter()
+        job = prepare_dicom(location, case_number, truth_table, dose_struct_index, prefetch=True)
+        job["seconds"] = perf_counter() - start
+        return job
+
+    def process(job):
+        start = perf_counter()
+        job = evaluate_dicom(job, truth_table)
+        job["seconds"] += perf_counter() - start
+        return job
+
+    def write(job):
+        start = perf_counter()
+        result = report_dicom(job, output, truth_table, input_folder)
+        if metrics.enabled:
+            metrics.record("process_dicom", job["seconds"] + perf_counter() - start, job["location"])
+        return result
+
+    try:
+        yield from run_pipeline(dicom_paths, read, process, write, readers=prefetch, queue_size=prefetch)
+    except Exception:
+        metrics.count("files_failed")
+        raise
+
+def process_in_parallel(dicom_paths, output, case_number, truth_table, dose_struct_index, workers, input_folder=None):
+    ''' Function to process a batch of DICOMs across a pool of worker processes
+        The truth table and dose/struct index are sent to each worker once, when it starts, rather than with every file.
+        Yields the result of process_dicom for each path, in the same order as dicom_paths.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    settings = {name: globals()[name] for name in worker_settings}
+    shared = (settings, (output, case_number, truth_table, dose_struct_index, input_folder))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=shared) as executor:
+        if memory_guard:
+            results = _map_within_memory(executor, dicom_paths, workers)
+        else:
+            # Hand out several files at a time so that small plans don't spend most of their time in inter-process overhead
+            chunksize = max(1, len(dicom_paths) // (workers * 4))
+            results = executor.map(process_dicom_in_worker, dicom_paths, chunksize=chunksize)
+        for result, worker_metrics in results:
+            if worker_metrics:
+                metrics.merge(worker_metrics)
+            yield result
+
+def _map_within_memory(executor, dicom_paths, workers):
+    ''' Like executor.map(process_dicom_in_worker, dicom_paths), but keeping the batch within the memory limit
+        A plan is only handed to a worker while the main process and the workers are under the limit. Otherwise
+        the plans in progress are waited for, one at a time, so a batch that stays over the limit ends up
+        processing one plan at a time.
+    '''
+    from collections import deque
+    pending = deque()
+    for path in dicom_paths:
+        # The pool's worker processes, to measure their memory (ProcessPoolExecutor doesn't make them public)
+        pids = list(getattr(executor, "_processes", None) or {})
+        while pending and (len(pending) >= workers or memory_guard.over(pids)):
+            yield pending.popleft().result()
+        pending.append(executor.submit(process_dicom_in_worker, path))
+    while pending:
+        yield pending.popleft().result()
+
+def init_worker(settings, state):
+    ''' Runs once in each worker process to receive the settings and state shared by the whole batch'''
+    global worker_state
+    globals().update(settings)
+    worker_state = state
+    metrics.enabled = bool(metrics_file)
+
+def process_dicom_in_worker(location):
+    ''' Processes one DICOM in a worker process
+        Returns the result of process_dicom, and the metrics recorded while processing it (None if metrics are off)
+    '''
+    output, case_number, truth_table, dose_struct_index, input_folder = worker_state
+    result = process_dicom(location, output, case_number, truth_table, dose_struct_index, input_folder)
+    return result, metrics.snapshot(clear=True) if metrics.enabled else None
+
 def dose_struct_references(folder_path):
     ''' Function to scan a directory and build an index of RTDOSE and RTSTRUCT files by StudyInstanceUID
+        The index is kept in the cache folder between runs, so only new or changed files are read.
         Returns a dictionary: {StudyInstanceUID: {RTDOSE: [paths,...]), RTSTRUCT: [paths,...]}, ...}
     '''
     if skip_dose_structure:
         return None
-    dose_struct_index = {}
-    with os.scandir(folder_path) as folder:
-        for entry in folder:
-            # uid, modality and file_path are all None if the entry is not a dose or structure file
-            uid, modality, file_path = dose_struct_reference(entry.path)
-            # create a new dictionary entry if we haven't seen this uid before
-            if uid not in dose_struct_index:
-                dose_struct_index[uid] = {strings.RTDOSE:[], strings.RTSTRUCT:[], None:[]}
-            dose_struct_index[uid][modality].append(file_path)
-    return dose_struct_index
-
-def dose_struct_reference(dir_entry):
-    if dir_entry.is_file() and dir_entry.name.endwith(".dcm"):
-        dataset = pydicom.dcmread(dir_entry.path, force=True, specific_tags=["StudyInstanceUID", "Modality"])
-        if str(dataset.Modality) in [strings.RTDOSE, strings.RTSTRUCT]:
-            return dataset.StudyInstanceUID, dataset.Modality, dir_entry.path
-    return None,None,None
-
-def process_dicom(location, destination, case_number, truth_table, dose_struct_index):
+    index_file = os.path.join(cache_folder, "dose_struct_index.sqlite") if cache_folder else ":memory:"
+    with metrics.timer("dose_struct_index", folder_path):
+        return build_index(folder_path, index_file, **discovery)
+
+def process_dicom(location, destination, case_number, truth_table, dose_struct_index, input_folder=None):
     ''' Function to process a single DICOM RTPLAN
 
     location            - the filepath of the DICOM
@@ -108,35 +583,248 @@ def process_dicom(location, destination, case_number, truth_table, dose_struct_i
     case_number         - the case number of the truth table that parameters should be evaluated against (see data/truth_table_lvl3.csv)
     truth_table         - a dictionary of correct values for each case
     dose_struct_index   - a dictionary {StudyInstanceUID: {RTDOSE: [paths,...]), RTSTRUCT: [paths,...]}, ...}
+    input_folder        - the input folder the DICOM was found in. If it was in a subfolder of it, the result is saved
+                            in the same subfolder of destination.
+
+    Returns a message describing what was done, and a record of the results for the batch report
+    (a dictionary of keyword arguments for BatchReport.write), or None if the file was skipped.
+    If the plan's case couldn't be worked out (see --auto_case), the record is {location, review: Classification}.
+    When comparing several truth tables (see truth_tables), case_number is a list of cases (or None) and the record is
+    {location, results: [keyword arguments for BatchReport.write, ...], reviews: [(table name, Classification), ...]}.
+    '''
+    # The time taken by each plan is recorded so that the slowest plans show up in the metrics
+    with metrics.timer("process_dicom", location):
+        try:
+            job = prepare_dicom(location, case_number, truth_table, dose_struct_index)
+            return report_dicom(evaluate_dicom(job, truth_table), destination, truth_table, input_folder)
+        except Exception:
+            metrics.count("files_failed")
+            raise
+
+# process_dicom is split into three stages, so that they can also be overlapped in a pipeline (see process_pipelined).
+# The stages pass along a job: a dictionary with the location and case number of the plan and what is known about it.
+
+def prepare_dicom(location, case_number, truth_table, dose_struct_index, prefetch=False):
+    ''' The first stage of processing a DICOM: finds out whether it is a plan, and looks for cached results
+
+    prefetch    - whether to read the whole file into memory first, so the later stages don't touch the disk
+    Returns a job for evaluate_dicom. If the file isn't a plan, job["skipped"] holds the message saying so.
     '''
-    dataset = pydicom.read_file(location, force=True)
+    job = dict(location=location, case=case_number, data=None, dataset=None, skipped=None,
+               dose_struct_paths=None, cache_key=None, cached=None, classification=None, identifiers=None)
+    if prefetch:
+        # Reading ahead waits (for a while) for the plans being processed to free memory, if over the memory limit
+        if memory_guard and not memory_guard.wait():
+            metrics.count("memory_waits_expired")
+        with metrics.timer("prefetch"):
+            if archives.split_member(location):
+                job["data"] = archives.read_member(location)
+            else:
+                with open(location, 'rb') as dicom_file:
+                    job["data"] = dicom_file.read()
+    elif archives.split_member(location):
+        # Members of archives are read out of the archive once, for all the stages (see code_files/archives.py).
+        # Members stored uncompressed are only mapped, not copied.
+        with metrics.timer("read_member"):
+            job["data"] = archives.read_member(location)
+
+    # Only the header is read at first, so that files which aren't plans can be skipped cheaply
+    with metrics.timer("read_header"):
+        header = read_header(dicom_source(job))
 
     # If the dicom is not an RTPLAN, we don't want to process it. 
-    if str(dataset.Modality) != "RTPLAN":
-        return "{:10} {}: not a plan file".format("SKIPPED", location)
+    if str(header.get("Modality")) != "RTPLAN":
+        metrics.count("files_skipped")
+        job["skipped"] = "{:10} {}: not a plan file".format("SKIPPED", location)
+        return job
+    job["identifiers"] = tuple(str(header[keyword].value) if keyword in header else None
+                               for keyword in ("SOPInstanceUID", "StudyInstanceUID"))
+
+    # The cases of plans compared against several truth tables are worked out for each table, in evaluate_dicom
+    if truth_tables:
+        if dose_struct_index and header.get("StudyInstanceUID") in dose_struct_index:
+            job["dose_struct_paths"] = dose_struct_index[header.StudyInstanceUID]
+        return job
+
+    # Work out the case number if not specified, reading the plan now rather than in evaluate_dicom
+    if not isinstance(job["case"], int) and auto_case:
+        from code_files.case_classifier import classify
+        with metrics.timer("read_plan", location):
+            job["dataset"] = read_plan(dicom_source(job), low_memory=low_memory)
+        with metrics.timer("classify_case"):
+            classification = job["classification"] = classify(job["dataset"], truth_table, location)
+        if not classification.confident:
+            metrics.count("files_review")
+            job["dataset"] = None
+            job["skipped"] = "{:10} {}: unclear case, {} ({:.2f}) or {}".format(
+                "REVIEW", location, classification.case, classification.confidence, classification.describe_alternatives())
+            return job
+        job["case"] = classification.case
 
     # Prompt for case number if not specified
     cases = len(truth_table["case"])
-    while not isinstance(case_number, int):
+    while not isinstance(job["case"], int):
         try:
-            case_number = int(input(f"What is the case number for {location}? "))
+            job["case"] = int(input(f"What is the case number for {location}? "))
         except ValueError:
             print(f"Case must be an integer between 1 and {cases}!")
 
     # Look for any related dose files or structure sets
-    dose_struct_paths = None
-    if dose_struct_index and dataset.StudyInstanceUID in dose_struct_index:
-        dose_struct_paths = dose_struct_index[dataset.StudyInstanceUID]
+    if dose_struct_index and header.get("StudyInstanceUID") in dose_struct_index:
+        job["dose_struct_paths"] = dose_struct_index[header.StudyInstanceUID]
+
+    # If this plan has been processed before with the same truth table and code, reuse those results. The key hashes
+    # the whole file, so it is only worked out once the header shows the file is a plan.
+    if result_cache:
+        with metrics.timer("cache_lookup"):
+            job["cache_key"] = result_cache.key(location, job["case"], job["dose_struct_paths"], job["data"])
+            job["cached"] = result_cache.get(job["cache_key"])
+    return job
+
+def dicom_source(job):
+    ''' What the DICOM of a job should be read from: its contents if they were prefetched, otherwise its location'''
+    if job["data"] is None:
+        return job["location"]
+    # The contents of a mapped archive member are a view of the archive, which BytesIO would copy
+    return io.BytesIO(job["data"]) if isinstance(job["data"], bytes) else archives.MemoryFile(job["data"])
+
+def evaluate_dicom(job, truth_table):
+    ''' The second stage of processing a DICOM: extracts and evaluates its parameters, unless they were cached
+        Returns the job, with its parameters and evaluations
+    '''
+    if job["skipped"]:
+        return job
+    if job["cached"]:
+        metrics.count("files_cached")
+        job["parameters"], job["evaluations"] = job["cached"]
+        return job
+
+    # Read the parts of the plan that the extractors need, unless it was read to work out its case
+    dataset, job["dataset"] = job["dataset"], None
+    if dataset is None:
+        with metrics.timer("read_plan", job["location"]):
+            dataset = read_plan(dicom_source(job), low_memory=low_memory)
+    # The plan's contents aren't needed any more once it has been read
+    job["data"] = None
+
+    if truth_tables:
+        evaluate_combinations_of(job, dataset)
+        del dataset
+        if low_memory:
+            memory.release()
+        metrics.count("files_extracted")
+        return job
 
     # Extract and evaluate the DICOM 
-    parameters = extract_parameters(dataset, dose_struct_paths, case_number)
-    evaluations = evaluate_parameters(parameters, truth_table, case_number)
+    job["parameters"] = extract_parameters(dataset, job["dose_struct_paths"], job["case"])
+    # Nor is the dataset once the parameters are extracted
+    del dataset
+    if low_memory:
+        memory.release()
+    job["evaluations"] = evaluate_parameters(job["parameters"], truth_table, job["case"])
+    metrics.count("files_extracted")
+    if result_cache:
+        with metrics.timer("cache_store"):
+            result_cache.put(job["cache_key"], job["parameters"], job["evaluations"])
+    return job
+
+def evaluate_combinations_of(job, dataset):
+    ''' Evaluates a plan against every truth table and case being compared, extracting its parameters only once
+        Sets job["results"] to the combinations evaluated, and job["reviews"] to the tables whose case was unclear
+    '''
+    combinations, job["reviews"] = [], []
+    for name, table in truth_tables:
+        if job["case"]:
+            cases = job["case"] if isinstance(job["case"], list) else [job["case"]]
+        elif auto_case:
+            from code_files.case_classifier import classify
+            with metrics.timer("classify_case"):
+                classification = classify(dataset, table, job["location"])
+            if not classification.confident:
+                metrics.count("files_review")
+                job["reviews"].append((name, classification))
+                continue
+            cases = [classification.case]
+        else:
+            cases = [None]
+            while not isinstance(cases[0], int):
+                try:
+                    cases[0] = int(input(f"What is the case number for {job['location']} in {name}? "))
+                except ValueError:
+                    print(f"Case must be an integer between 1 and {len(table['case'])}!")
+        combinations += [(name, table, case) for case in cases]
+
+    evaluated = evaluate_combinations(dataset, job["dose_struct_paths"], [(table, case) for name, table, case in combinations])
+    job["results"] = []
+    for (name, table, case), (parameters, evaluations) in zip(combinations, evaluated):
+        solutions = dict([(key, table[key][case-1]) for key in table])
+        job["results"].append(dict(truth_table=name, case=case, parameters=parameters, evaluations=evaluations,
+                                   solutions=solutions))
+
+def report_dicom(job, destination, truth_table, input_folder=None):
+    ''' The last stage of processing a DICOM: saves its report
+        Returns the message and record returned by process_dicom
+    '''
+    location, case_number, cached = job["location"], job["case"], job["cached"]
+    if job["skipped"]:
+        if job["classification"]:
+            return job["skipped"], dict(location=location, review=job["classification"])
+        return job["skipped"], None
+    if input_folder:
+        member = archives.split_member(location)
+        subfolder = archives.member_folder(member[1]) if member else os.path.relpath(os.path.dirname(location), input_folder)
+        if subfolder != os.curdir:
+            # Reports stay within the output folder, whatever the members of an archive are called
+            top = os.path.realpath(destination)
+            destination = os.path.join(destination, subfolder)
+            if os.path.commonpath([top, os.path.realpath(destination)]) != top:
+                raise ValueError(f"The report of <{location}> would be saved outside the output folder <{top}>")
+            os.makedirs(destination, exist_ok=True)
+    output_file = output_path(os.path.join(destination, Path(archives.member_name(location)).stem))
+    status = "CACHED" if cached else "EXTRACTED"
+    if "results" in job:
+        return report_combinations(job, output_file)
+    parameters, evaluations = job["parameters"], job["evaluations"]
+    if job["classification"]:
+        location_text = "{} (case {}, {:.2f})".format(location, case_number, job["classification"].confidence)
+    else:
+        location_text = location
+
     solutions = dict([(key, truth_table[key][case_number-1]) for key in truth_table])
+    record = dict(location=location, case=case_number, parameters=parameters, evaluations=evaluations, solutions=solutions,
+                  identifiers=job["identifiers"])
+
+    if not per_file_output:
+        return "{:10} {}".format(status, location_text), record
 
     # Output the extracted parameters into the format specified by user
-    output_location = os.path.join(destination,Path(location).stem)
-    output_file = output(parameters, evaluations, solutions, output_location)
-    return "{:10} {} -> {}".format("EXTRACTED", location, output_file)
+    # Cached results are written out again too, as the report there may be from another truth table or case
+    with metrics.timer("output"):
+        output_file = output(parameters, evaluations, solutions, output_file)
+    return "{:10} {} -> {}".format(status, location_text, output_file), record
+
+def report_combinations(job, output_file):
+    ''' report_dicom for a plan evaluated against several truth tables or cases: with --per_file, a CSV is saved for
+        each truth table and case, named after the plan, table and case
+    '''
+    location, results = job["location"], job["results"]
+    evaluated = ", ".join("{} case {}".format(result["truth_table"], result["case"]) for result in results)
+    unclear = ", ".join(name for name, classification in job["reviews"])
+    message = "{:10} {} ({})".format("EXTRACTED", location, evaluated) if results else "{:10} {}".format("REVIEW", location)
+    if unclear:
+        message += f": unclear case for {unclear}"
+    record = dict(location=location, results=results, reviews=job["reviews"], identifiers=job["identifiers"])
+
+    if per_file_output and results:
+        stem = os.path.splitext(output_file)[0]
+        output_files = []
+        with metrics.timer("output"):
+            for result in results:
+                name = Path(result["truth_table"]).stem
+                output_files.append(output(result["parameters"], result["evaluations"], result["solutions"],
+                                           f"{stem}_{name}_case{result['case']}"))
+        message += " -> " + ", ".join(output_files)
+    return message, record
 
 def info_print(text,silent=False):
     if not silent:
@@ -145,13 +833,57 @@ def info_print(text,silent=False):
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Extract and evaluate information from DICOM files for the purpose of auditing planned radiotherapy treatment.")
     parser.add_argument("-i", "--inputs", nargs='+',
-                        help="The locations of one or more DICOMS to be processed, OR the locations of one or more folders containing DICOMS to be processed.")
-    parser.add_argument("-t", "--truth_table", dest="truth_table_file",
-                        help="The path of the file containing the truth table to be used for determining pass/fail results.")    
+                        help="The locations of one or more DICOMS to be processed, OR the locations of one or more folders containing DICOMS to be processed. Zip and tar archives are processed like folders, without extracting them, and a DICOM in an archive can be given as ARCHIVE!PATH (e.g. plans.zip!set1/RP1.dcm).")
+    parser.add_argument("-t", "--truth_table", dest="truth_table_file", nargs='+',
+                        help="The path of the file containing the truth table to be used for determining pass/fail results. With several, each plan is extracted once and evaluated against every table, into one combined report.")    
     parser.add_argument("-o", "--output", metavar="FOLDER",
                         help="The location where the reports for processed DICOMs should be saved (creates folder if doesn't yet exist). If unspecified, each report will be saved in a Reports folder in this directory.")
-    parser.add_argument("-c", "--case_number", metavar="NUMBER", type=int,
-                        help="The case number of input DICOMS. If specified, assumes all DICOMS in this batch will be this case.")
+    parser.add_argument("-c", "--case_number", metavar="NUMBER", type=int, nargs='+',
+                        help="The case number of input DICOMS. If specified, assumes all DICOMS in this batch will be this case. With several, each plan is evaluated against every one of them, into one combined report.")
+    parser.add_argument("--auto_case", "--auto-case", dest="auto_case", action="store_true",
+                        help="Work out the case number of plans without one from their name and contents, instead of asking for it. Plans whose case is unclear are listed for review (see --review) rather than processed.")
+    parser.add_argument("--review", metavar="FILE",
+                        help="With --auto_case, the CSV listing the plans whose case couldn't be worked out, with the most likely cases. Defaults to review.csv in the output folder.")
+    parser.add_argument("--recursive", action="store_true",
+                        help="Also process the DICOMs in the subfolders of input folders (and look there for dose and structure files).")
+    parser.add_argument("--include", metavar="GLOB", nargs='+',
+                        help="Only process the files in input folders matching one of these patterns (e.g. 'RP*'), by name or by path within the folder. Defaults to '*.dcm'.")
+    parser.add_argument("--exclude", metavar="GLOB", nargs='+',
+                        help="Leave out the files and subfolders of input folders matching one of these patterns (e.g. '*/archive/*').")
+    parser.add_argument("--detect_dicom", action="store_true",
+                        help="Recognise DICOMs by their contents instead of by a .dcm extension, for exports with extension-less files.")
+    parser.add_argument("-w", "--workers", metavar="N", type=int,
+                        help="The number of processes used to process the DICOMs in a folder. Requires a case number; defaults to 1 (no parallelism).")
+    parser.add_argument("-r", "--report", metavar="FILE",
+                        help="Save the results of the whole run to one report (.csv, .jsonl or .parquet) instead of one CSV per DICOM.")
+    parser.add_argument("-p", "--prefetch", metavar="N", type=int,
+                        help="Overlap reading DICOMs with processing them and writing their reports, reading up to N DICOMs ahead. Helps most when the DICOMs are on a slow or network drive. Requires a case number; 0 (the default) turns it off.")
+    parser.add_argument("--low_memory", "--low-memory", dest="low_memory", action="store_true",
+                        help="Use as little memory as possible for each plan, by streaming the control points of large (e.g. VMAT) plans into arrays instead of reading them as datasets.")
+    parser.add_argument("--max_memory", "--max-memory", dest="max_memory", metavar="SIZE",
+                        help="Keep a parallel or prefetching batch within SIZE of memory (e.g. 4GB), by waiting for plans in progress to finish before starting more. Implies --low_memory.")
+    parser.add_argument("--per_file", action="store_true",
+                        help="When saving a report with --report, also save the usual CSV report for each DICOM.")
+    parser.add_argument("--no_cache", "--no-cache", dest="no_cache", action="store_true",
+                        help="Process every plan again, instead of reusing the results of plans that haven't changed since they were last processed.")
+    parser.add_argument("--watch", action="store_true",
+                        help="After processing the inputs, keep watching the input folders and process each DICOM that is added or modified, until stopped with Ctrl+C. Needs a case number for each folder.")
+    parser.add_argument("--shard", choices=["coordinate", "work", "merge"],
+                        help="Spread a batch over several computers sharing a folder: 'coordinate' splits the inputs into shards in the queue given by --shard_queue and merges their results into one report when they are done, 'work' processes shards of the queue until none are left, and 'merge' merges the shards done so far. With 'coordinate', -w N also starts N workers on this computer (-w 0 for none).")
+    parser.add_argument("--shard_queue", "--shard-queue", dest="shard_queue", metavar="FILE",
+                        help="The work queue (an SQLite database) of a sharded batch, on storage shared by the coordinator and every worker.")
+    parser.add_argument("--serve", metavar="ADDRESS", nargs='?', const="",
+                        help="Instead of processing the inputs, keep running and check the plans sent to ADDRESS (HOST:PORT, or unix:PATH for a Unix socket; defaults to 127.0.0.1:8765) over HTTP, returning their parameters and evaluations as JSON. See code_files/server.py for the API.")
+    parser.add_argument("--store", metavar="FILE",
+                        help="Also add the results of the run to FILE, an SQLite database of the results of every run, to look at results across runs and over time (see code_files/results_store.py).")
+    parser.add_argument("--profile", metavar="PREFIX", nargs='?', const="profile",
+                        help="Profile the run, saving PREFIX.prof (cProfile), PREFIX.folded (stacks for flame graphs) and PREFIX.txt (a summary of the hottest functions and slowest plans). PREFIX defaults to 'profile'.")
+    parser.add_argument("--profile_top", metavar="N", type=int, default=20,
+                        help="The number of hottest functions of each library listed in the profile summary.")
+    parser.add_argument("--profile_slowest", metavar="K", type=int, default=10,
+                        help="The number of slowest plans listed in the profile summary.")
+    parser.add_argument("-m", "--metrics", metavar="FILE",
+                        help="Save how long each stage of processing took, and how many files were extracted, skipped or failed, to FILE as JSON (and next to it in the Prometheus text format, as .prom).")
     args = parser.parse_args()
     return vars(args)
     
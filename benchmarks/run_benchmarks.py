@@ -0,0 +1,157 @@
+''' Benchmark suite timing each stage of processing on folders of synthetic plans
+
+For each scenario a folder of synthetic plans (with a dose and structure set each) is generated, and then
+these stages are timed separately:
+
+dose_struct_references  - indexing the dose and structure files of the folder (once per folder)
+read_plan               - reading the parts of each plan that are needed
+extract_parameters      - extracting every parameter from each plan
+evaluate_parameters     - evaluating the parameters against the truth table
+output                  - writing each plan's CSV report (outputter.output)
+
+The results are saved as JSON, along with the commit they were run on, so that runs on different commits can
+be compared with --compare.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--scenario NAME ...] [--json FILE] [--compare OLD_FILE]
+    python benchmarks/run_benchmarks.py --plans 500 --template vmat8b --control_points 360 --leaf_pairs 80
+'''
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
+
+import app
+import pydicom
+from benchmarks.synthetic import generate_folder
+from code_files.dicom_loader import read_header, read_plan
+from code_files.outputter import output
+from code_files.truth_table_reader import read_truth_table
+from code_files.parameters.parameter_retrieval import extract_parameters, evaluate_parameters
+
+# Each scenario is a set of arguments for generate_folder
+scenarios = {
+    "imrt"          : dict(plans=20, template="imrt", beams=5, control_points=20, leaf_pairs=60),
+    "vmat"          : dict(plans=20, template="vmat", beams=2, control_points=180, leaf_pairs=60),
+    "vmat-large"    : dict(plans=10, template="vmat8b", beams=2, control_points=360, leaf_pairs=80),
+    "large-folder"  : dict(plans=200, template="imrt", beams=5, control_points=10, leaf_pairs=60, dose_shape=(10, 32, 32)),
+}
+
+stages = ["dose_struct_references", "read_plan", "extract_parameters", "evaluate_parameters", "output"]
+
+def summarise(timings):
+    ''' Summary statistics (in seconds) of a list of timings'''
+    timings = sorted(timings)
+    return {
+        "count": len(timings),
+        "total": sum(timings),
+        "mean": statistics.mean(timings),
+        "median": statistics.median(timings),
+        "p95": timings[min(len(timings) - 1, int(0.95 * len(timings)))],
+    }
+
+def run_scenario(config, truth_table, case):
+    ''' Generates the scenario's folder and times each stage of processing it
+        Returns a dictionary {stage: summary of timings}
+    '''
+    timings = dict((stage, []) for stage in stages)
+    with tempfile.TemporaryDirectory() as folder, tempfile.TemporaryDirectory() as reports:
+        plan_paths = generate_folder(folder, **config)
+
+        app.skip_dose_structure = False
+        app.cache_folder = None
+        start = time.perf_counter()
+        dose_struct_index = app.dose_struct_references(folder)
+        timings["dose_struct_references"].append(time.perf_counter() - start)
+
+        for path in plan_paths:
+            start = time.perf_counter()
+            header = read_header(path)
+            dataset = read_plan(path)
+            read_done = time.perf_counter()
+            parameters = extract_parameters(dataset, dose_struct_index.get(header.StudyInstanceUID), case)
+            extract_done = time.perf_counter()
+            evaluations = evaluate_parameters(parameters, truth_table, case)
+            evaluate_done = time.perf_counter()
+            solutions = dict([(key, truth_table[key][case-1]) for key in truth_table])
+            output(parameters, evaluations, solutions, os.path.join(reports, os.path.basename(path)))
+            output_done = time.perf_counter()
+
+            timings["read_plan"].append(read_done - start)
+            timings["extract_parameters"].append(extract_done - read_done)
+            timings["evaluate_parameters"].append(evaluate_done - extract_done)
+            timings["output"].append(output_done - evaluate_done)
+    return dict((stage, summarise(stage_timings)) for stage, stage_timings in timings.items())
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=repository, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous):
+    ''' Prints how the total time of each stage changed from a previous set of results'''
+    print(f"\nCompared with {previous.get('commit')}:")
+    for name, scenario in results["scenarios"].items():
+        if name not in previous["scenarios"]:
+            continue
+        for stage, summary in scenario["stages"].items():
+            old = previous["scenarios"][name]["stages"].get(stage)
+            if old and old["total"] > 0:
+                print("{:14} {:24} {:6.2f}x".format(name, stage, summary["total"] / old["total"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each stage of processing folders of synthetic plans.")
+    parser.add_argument("--scenario", nargs='+', choices=list(scenarios), help="The scenarios to run. Defaults to all of them.")
+    parser.add_argument("--plans", type=int, help="Run a custom scenario with this many plans.")
+    parser.add_argument("--template", default="vmat", choices=["imrt", "vmat", "vmat8b"], help="The template of the custom scenario.")
+    parser.add_argument("--beams", type=int, default=1, help="The number of beams per plan in the custom scenario.")
+    parser.add_argument("--control_points", type=int, help="The number of control points per beam in the custom scenario.")
+    parser.add_argument("--leaf_pairs", type=int, help="The number of MLC leaf pairs in the custom scenario.")
+    parser.add_argument("--case", type=int, default=7, help="The truth table case to evaluate against.")
+    parser.add_argument("--truth_table", default="data/truth_table_lvl3.csv", help="The truth table to evaluate against.")
+    parser.add_argument("--json", metavar="FILE", default="benchmark_results.json", help="Where to save the results.")
+    parser.add_argument("--compare", metavar="OLD_FILE", help="Results of an earlier run to compare against.")
+    args = parser.parse_args()
+
+    if args.plans:
+        selected = {"custom": dict(plans=args.plans, template=args.template, beams=args.beams,
+                                   control_points=args.control_points, leaf_pairs=args.leaf_pairs)}
+    else:
+        selected = dict((name, scenarios[name]) for name in (args.scenario or scenarios))
+
+    truth_table = read_truth_table(os.path.join(repository, args.truth_table))
+    results = {
+        "commit": commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pydicom": pydicom.__version__,
+        "scenarios": {},
+    }
+    for name, config in selected.items():
+        stage_results = run_scenario(config, truth_table, args.case)
+        results["scenarios"][name] = {"config": config, "stages": stage_results}
+        print(f"\n{name}: {config}")
+        for stage, summary in stage_results.items():
+            print("  {:24} total {:9.1f} ms   median {:8.2f} ms   p95 {:8.2f} ms".format(
+                stage, summary["total"] * 1000, summary["median"] * 1000, summary["p95"] * 1000))
+
+    with open(args.json, 'w') as json_file:
+        json.dump(results, json_file, indent=2)
+    print(f"\nResults saved to {args.json}")
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            compare(results, json.load(previous_file))
+
+if __name__ == "__main__":
+    main()
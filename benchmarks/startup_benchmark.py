@@ -0,0 +1,68 @@
+''' Benchmark of how long it takes to check one plan from the command line
+
+When the checker is run once per plan (e.g. from a treatment planning system's export hook), the time is
+dominated by starting the interpreter and importing modules rather than by the checking itself.
+This times, over several runs:
+
+import      - python -c "import app"
+cold run    - python app.py -i PLAN -c CASE --no-cache
+cached run  - python app.py -i PLAN -c CASE, with the result already in the cache
+
+Usage: python benchmarks/startup_benchmark.py [--plan PATH] [--case NUMBER] [--runs N] [--json FILE]
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def time_command(command, runs):
+    ''' Runs a command several times from the repository folder, returning the wall clock time of each run'''
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=repository, check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def run_benchmark(plan, case, runs):
+    ''' Returns a dictionary {benchmark name: {"median": seconds, "min": seconds, "runs": [seconds,...]}}'''
+    with tempfile.TemporaryDirectory() as output:
+        app = [sys.executable, "app.py", "-i", plan, "-c", str(case), "-o", output]
+        commands = {
+            "import"        : [sys.executable, "-c", "import app"],
+            "cold run"      : app + ["--no-cache"],
+            "cached run"    : app,
+        }
+        # Make sure the result is in the cache before timing the cached runs
+        subprocess.run(app, cwd=repository, check=True, stdout=subprocess.DEVNULL)
+
+        results = {}
+        for name, command in commands.items():
+            timings = time_command(command, runs)
+            results[name] = {"median": statistics.median(timings), "min": min(timings), "runs": timings}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Time how long the checker takes to start and check a single plan.")
+    parser.add_argument("--plan", default="tests/resources/YellowLvlIII_7a.dcm", help="The RTPLAN to check.")
+    parser.add_argument("--case", type=int, default=7, help="The case number of the plan.")
+    parser.add_argument("--runs", type=int, default=10, help="The number of times to run each benchmark.")
+    parser.add_argument("--json", metavar="FILE", help="Also save the results to this file as JSON.")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.plan, args.case, args.runs)
+    for name, result in results.items():
+        print("{:12} median {:7.1f} ms   min {:7.1f} ms".format(name, result["median"] * 1000, result["min"] * 1000))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+''' Generator of synthetic RTPLAN, RTDOSE and RTSTRUCT DICOMs for benchmarking
+
+Plans are built from the real sample plans, so they have the same structure and elements as plans from the
+treatment planning system, but with a chosen number of beams, control points per beam and MLC leaf pairs:
+
+imrt    - data/samples/YellowLvlIII_7a.dcm  (static gantry beams)
+vmat    - data/samples/YellowLvlIII_7b.dcm  (one arc with a setup beam)
+vmat8b  - data/samples2/YellowLvlIII_8b.dcm (one arc with no setup beam)
+
+Dose and structure sets are made from scratch: a dose grid with a smooth dose distribution, and a structure set
+of cylindrical ROIs. Each shares a StudyInstanceUID with its plan, so they're found by dose_struct_references.
+'''
+
+import copy
+import os
+import random
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ImplicitVRLittleEndian, generate_uid
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+templates = {
+    "imrt"      : "data/samples/YellowLvlIII_7a.dcm",
+    "vmat"      : "data/samples/YellowLvlIII_7b.dcm",
+    "vmat8b"    : "data/samples2/YellowLvlIII_8b.dcm",
+}
+
+RTPLAN_CLASS = "1.2.840.10008.5.1.4.1.1.481.5"
+RTDOSE_CLASS = "1.2.840.10008.5.1.4.1.1.481.2"
+RTSTRUCT_CLASS = "1.2.840.10008.5.1.4.1.1.481.3"
+
+def _is_arc(template_beam):
+    control_points = template_beam.ControlPointSequence
+    return len(control_points) > 1 and float(control_points[0].GantryAngle) != float(control_points[1].GantryAngle)
+
+def _mlc_positions(generator, leaf_pairs):
+    ''' Leaf positions (mm) of an irregular open aperture: all left leaves, then all right leaves'''
+    centre = generator.uniform(-20, 20)
+    half_widths = [generator.uniform(5, 50) for _ in range(leaf_pairs)]
+    return [round(centre - width, 1) for width in half_widths] + [round(centre + width, 1) for width in half_widths]
+
+def _set_leaf_pairs(beam, leaf_pairs):
+    ''' Changes the number of MLC leaf pairs of a beam, with equally spaced leaf boundaries'''
+    for device in beam.BeamLimitingDeviceSequence:
+        if device.RTBeamLimitingDeviceType in ("MLCX", "MLCY"):
+            device.NumberOfLeafJawPairs = leaf_pairs
+            width = 400.0 / leaf_pairs
+            device.LeafPositionBoundaries = [round(-200 + i * width, 2) for i in range(leaf_pairs + 1)]
+
+def _control_point(template, index, gantry, generator, leaf_pairs, ssd):
+    control_point = copy.deepcopy(template)
+    control_point.ControlPointIndex = index
+    control_point.GantryAngle = round(gantry, 1)
+    for device in control_point.get("BeamLimitingDevicePositionSequence", []):
+        if device.RTBeamLimitingDeviceType in ("MLCX", "MLCY"):
+            device.LeafJawPositions = _mlc_positions(generator, leaf_pairs)
+    if "SourceToSurfaceDistance" in control_point:
+        control_point.SourceToSurfaceDistance = round(ssd, 1)
+    for dose_point in control_point.get("ReferencedDoseReferenceSequence", []):
+        if "BeamDosePointSSD" in dose_point:
+            dose_point.BeamDosePointSSD = ssd - 50
+    return control_point
+
+def synthetic_plan(template="vmat", beams=1, control_points=None, leaf_pairs=None, study_uid=None, seed=0):
+    ''' Builds an RTPLAN from one of the sample plan templates
+
+    template        - a key of templates
+    beams           - the number of treatment beams (a setup beam is kept if the template has one)
+    control_points  - the number of control points per beam. Defaults to the template's.
+    leaf_pairs      - the number of MLC leaf pairs. Defaults to the template's.
+    study_uid       - the StudyInstanceUID of the plan. Defaults to a new UID.
+    seed            - the seed for the random MLC positions and SSDs
+    '''
+    generator = random.Random(seed)
+    dataset = pydicom.dcmread(os.path.join(repository, templates[template]), force=True)
+    setup_beams = [beam for beam in dataset.BeamSequence if beam.get("BeamDescription") == "SETUP beam"]
+    template_beam = [beam for beam in dataset.BeamSequence if beam.get("BeamDescription") != "SETUP beam"][0]
+    template_points = template_beam.ControlPointSequence
+    arc = _is_arc(template_beam)
+    control_points = control_points or len(template_points)
+    leaf_pairs = leaf_pairs or int([device for device in template_beam.BeamLimitingDeviceSequence
+                                    if device.RTBeamLimitingDeviceType in ("MLCX", "MLCY")][0].NumberOfLeafJawPairs)
+
+    beam_sequence = []
+    for number in range(1, beams + 1):
+        beam = copy.deepcopy(template_beam)
+        beam.BeamNumber = number
+        start = (180 + 360 * (number - 1) / beams) % 360
+        beam.BeamDescription = str(int(start))
+        _set_leaf_pairs(beam, leaf_pairs)
+
+        points = []
+        for index in range(control_points):
+            # Arcs sweep all the way round; static beams stay at their starting angle
+            gantry = (start + 358 * index / max(1, control_points - 1)) % 360 if arc else start
+            ssd = generator.uniform(850, 950)
+            point_template = template_points[0] if index == 0 else template_points[min(1, len(template_points) - 1)]
+            points.append(_control_point(point_template, index, gantry, generator, leaf_pairs, ssd))
+        beam.ControlPointSequence = Sequence(points)
+        beam.NumberOfControlPoints = control_points
+        beam_sequence.append(beam)
+    for number, beam in enumerate(setup_beams, start=beams + 1):
+        beam.BeamNumber = number
+        beam_sequence.append(beam)
+    dataset.BeamSequence = Sequence(beam_sequence)
+
+    # Refer to every beam from the fraction group
+    fraction_group = dataset.FractionGroupSequence[0]
+    reference_template = fraction_group.ReferencedBeamSequence[0]
+    references = []
+    for beam in beam_sequence:
+        reference = copy.deepcopy(reference_template)
+        reference.ReferencedBeamNumber = beam.BeamNumber
+        references.append(reference)
+    fraction_group.ReferencedBeamSequence = Sequence(references)
+    fraction_group.NumberOfBeams = len(beam_sequence)
+
+    dataset.StudyInstanceUID = study_uid or generate_uid()
+    dataset.SeriesInstanceUID = generate_uid()
+    dataset.SOPInstanceUID = generate_uid()
+    dataset.file_meta = _file_meta(RTPLAN_CLASS, dataset.SOPInstanceUID)
+    dataset.preamble = bytes(128)
+    return dataset
+
+def _file_meta(sop_class, sop_instance):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = sop_class
+    file_meta.MediaStorageSOPInstanceUID = sop_instance
+    file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+    return file_meta
+
+def _new_dataset(modality, sop_class, study_uid):
+    dataset = Dataset()
+    dataset.SOPClassUID = sop_class
+    dataset.SOPInstanceUID = generate_uid()
+    dataset.Modality = modality
+    dataset.StudyInstanceUID = study_uid
+    dataset.SeriesInstanceUID = generate_uid()
+    dataset.FrameOfReferenceUID = generate_uid()
+    dataset.file_meta = _file_meta(sop_class, dataset.SOPInstanceUID)
+    dataset.preamble = bytes(128)
+    return dataset
+
+def dose_distribution(shape, spacing):
+    ''' A smooth dose distribution (Gy) peaking in the middle of a grid with the given (frames, rows, columns)'''
+    axes = [(np.arange(size) - (size - 1) / 2) * step for size, step in zip(shape, spacing)]
+    z, y, x = np.meshgrid(*axes, indexing="ij")
+    return 2.0 * np.exp(-(x ** 2 + y ** 2 + z ** 2) / (2 * 60.0 ** 2))
+
+def synthetic_dose(study_uid, shape=(40, 64, 64), spacing=(3.0, 2.5, 2.5), origin=(-80.0, -80.0, -60.0)):
+    ''' Builds an RTDOSE with a dose grid of the given (frames, rows, columns)
+
+    spacing - the (slice, row, column) spacing in mm
+    origin  - the patient position (x, y, z) of the first voxel in mm
+    '''
+    dataset = _new_dataset("RTDOSE", RTDOSE_CLASS, study_uid)
+    dose = dose_distribution(shape, spacing)
+    scaling = float(dose.max()) / (2 ** 32 - 1)
+    frames, rows, columns = shape
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = "MONOCHROME2"
+    dataset.NumberOfFrames = frames
+    dataset.FrameIncrementPointer = 0x3004000C
+    dataset.Rows = rows
+    dataset.Columns = columns
+    dataset.PixelSpacing = [spacing[1], spacing[2]]
+    dataset.ImagePositionPatient = list(origin)
+    dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dataset.GridFrameOffsetVector = [i * spacing[0] for i in range(frames)]
+    dataset.BitsAllocated = 32
+    dataset.BitsStored = 32
+    dataset.HighBit = 31
+    dataset.PixelRepresentation = 0
+    dataset.DoseUnits = "GY"
+    dataset.DoseType = "PHYSICAL"
+    dataset.DoseSummationType = "PLAN"
+    dataset.DoseGridScaling = scaling
+    dataset.PixelData = np.round(dose / scaling).astype("<u4").tobytes()
+    return dataset
+
+def _circle(centre, radius, z, points):
+    angles = np.linspace(0, 2 * np.pi, points, endpoint=False)
+    contour = np.column_stack([centre[0] + radius * np.cos(angles), centre[1] + radius * np.sin(angles), np.full(points, z)])
+    return [round(float(value), 2) for value in contour.ravel()]
+
+def synthetic_struct(study_uid, rois=None, slices=20, slice_thickness=3.0, points_per_contour=64):
+    ''' Builds an RTSTRUCT of cylindrical ROIs
+
+    rois    - a list of (name, (x, y) centre in mm, radius in mm). Defaults to a few ROIs from the level 3 truth table.
+    slices  - the number of contour slices of each ROI, centred on z = 0
+    '''
+    rois = rois or [("CShape", (0.0, 0.0), 40.0), ("C8Target", (10.0, 5.0), 15.0), ("SoftTiss", (0.0, 0.0), 90.0)]
+    dataset = _new_dataset("RTSTRUCT", RTSTRUCT_CLASS, study_uid)
+    dataset.StructureSetLabel = "Synthetic"
+    z_positions = [(i - (slices - 1) / 2) * slice_thickness for i in range(slices)]
+
+    structure_set_rois, roi_contours = [], []
+    for number, (name, centre, radius) in enumerate(rois, start=1):
+        roi = Dataset()
+        roi.ROINumber = number
+        roi.ROIName = name
+        roi.ReferencedFrameOfReferenceUID = dataset.FrameOfReferenceUID
+        structure_set_rois.append(roi)
+
+        contours = []
+        for z in z_positions:
+            contour = Dataset()
+            contour.ContourGeometricType = "CLOSED_PLANAR"
+            contour.NumberOfContourPoints = points_per_contour
+            contour.ContourData = _circle(centre, radius, z, points_per_contour)
+            contours.append(contour)
+        roi_contour = Dataset()
+        roi_contour.ReferencedROINumber = number
+        roi_contour.ContourSequence = Sequence(contours)
+        roi_contours.append(roi_contour)
+
+    dataset.StructureSetROISequence = Sequence(structure_set_rois)
+    dataset.ROIContourSequence = Sequence(roi_contours)
+    return dataset
+
+def generate_folder(folder, plans=10, template="vmat", beams=1, control_points=None, leaf_pairs=None,
+                    dose_struct=True, dose_shape=(40, 64, 64)):
+    ''' Writes a folder of synthetic plans, each in its own study with (optionally) a dose and structure set
+        Returns the paths of the plans
+    '''
+    os.makedirs(folder, exist_ok=True)
+    plan_paths = []
+    for number in range(plans):
+        study_uid = generate_uid()
+        plan = synthetic_plan(template, beams, control_points, leaf_pairs, study_uid, seed=number)
+        plan_path = os.path.join(folder, f"plan_{number:05}.dcm")
+        plan.save_as(plan_path)
+        plan_paths.append(plan_path)
+        if dose_struct:
+            synthetic_dose(study_uid, dose_shape).save_as(os.path.join(folder, f"dose_{number:05}.dcm"))
+            synthetic_struct(study_uid).save_as(os.path.join(folder, f"struct_{number:05}.dcm"))
+    return plan_paths
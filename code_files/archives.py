@@ -0,0 +1,261 @@
+''' Module for reading DICOMs straight out of zip and tar archives, without extracting them
+
+Plan sets often arrive as archives. An archive given as an input (-i plans.zip, or a .tar, .tar.gz, .tgz, .tar.bz2
+or .tar.xz) is processed like a folder: its members are found with the same include and exclude patterns
+(see code_files/discovery.py), in the order they are stored, throughout the folders within the archive. Each member is
+named by the archive and its path within it, e.g. "plans.zip!set1/RP1.dcm", and can be given as an input like that.
+
+Members are read from the archive into memory, and are never written to disk:
+
+- members stored uncompressed in a zip, and the members of an uncompressed tar, are read through a memory map of the
+  archive. Nothing is copied: pydicom reads from a view of the archive's pages, and the voxels of a dose grid are an
+  array over them, so only the parts of a member that are used are read from disk.
+- compressed zip members are decompressed into memory. So are the members of a compressed tar, but it can only be
+  read from start to end: going back to an earlier member decompresses the archive again from the start. Since
+  members are processed in the order they are stored, a batch reads a compressed tar through about once.
+
+Each process keeps the archives it reads open (up to open_archives of them). The workers of a parallel batch each
+open the archive themselves, so the members of an archive are processed in parallel just like the files of a folder.
+Zip archives and uncompressed tars suit parallel batches best, as their members can be read in any order.
+'''
+
+import os
+import posixpath
+import struct
+import threading
+from collections import OrderedDict
+
+# Separates the path of an archive from the path of a member within it
+separator = "!"
+# Archives are recognised by their extension
+zip_extensions = (".zip",)
+tar_extensions = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+# The number of archives each process keeps open
+open_archives = 8
+
+# Zip members start with a local file header: its signature, and the lengths of the name and extra field at offset 26
+_local_header = b"PK\x03\x04"
+_local_header_size = 30
+
+_archives = OrderedDict()
+_archives_pid = None
+_archives_lock = threading.Lock()
+
+def is_archive(path):
+    ''' Whether path is an archive file (by its extension)'''
+    path = os.fspath(path)
+    return path.lower().endswith(zip_extensions + tar_extensions) and os.path.isfile(path)
+
+def split_member(location):
+    ''' Splits the location of an archive member ("plans.zip!set1/RP1.dcm") into the path of the archive and the
+        path of the member within it. Returns None if location isn't a member of an archive.
+    '''
+    if not isinstance(location, (str, os.PathLike)):
+        return None
+    location = os.fspath(location)
+    index = location.find(separator)
+    while index >= 0:
+        if location[:index].lower().endswith(zip_extensions + tar_extensions):
+            return location[:index], location[index + 1:].replace(os.sep, "/")
+        index = location.find(separator, index + 1)
+    return None
+
+def member_folder(member):
+    ''' The folder of a member within its archive, as a relative path for the reports of the member's DICOM
+        Members are named by whoever made the archive, so the folder is kept from leaving wherever it is joined on
+        to: "/" at the start and ".." that would go above the top of the archive are dropped. Returns os.curdir for
+        members at the top of the archive.
+    '''
+    folder = posixpath.normpath("/" + posixpath.dirname(member.replace("\\", "/")))
+    parts = [part for part in folder.split("/") if part not in ("", ".", "..")]
+    return os.path.join(*parts) if parts else os.curdir
+
+def member_name(location):
+    ''' The filename of a DICOM: of the member itself for an archive member ("plans.zip!set1/RP1.dcm" is RP1.dcm)'''
+    member = split_member(location)
+    return posixpath.basename(member[1]) if member else os.path.basename(os.fspath(location))
+
+def stat(location):
+    ''' os.stat of a file, or of the archive holding a member. Any change to a member changes its archive.'''
+    member = split_member(location)
+    return os.stat(member[0] if member else location)
+
+class Member:
+    ''' A member of an archive, as found by find_members. Like the os.DirEntry of a file in a folder, with:
+
+    path    - its location, "archive!member"
+    name    - its filename
+    member  - its path within the archive
+    stat()  - the os.stat of the archive
+    '''
+    __slots__ = ("path", "name", "member", "_stat")
+
+    def __init__(self, archive, member, archive_stat):
+        self.path = archive + separator + member
+        self.name = posixpath.basename(member)
+        self.member = member
+        self._stat = archive_stat
+
+    def stat(self):
+        return self._stat
+
+    def __fspath__(self):
+        return self.path
+
+class Archive:
+    ''' An open zip or tar archive
+
+    path    - the filepath of the archive
+    '''
+    def __init__(self, path):
+        import mmap
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # An empty file can't be mapped
+            self.map = None
+        # Reading a compressed member moves the archive's shared file position, so only one thread reads at a time
+        self.lock = threading.Lock()
+        # {member path: ZipInfo or TarInfo} of every file in the archive, and {member path: (offset, size)} of the
+        # members that can be read straight from the map
+        self.members = {}
+        self.spans = {}
+        if path.lower().endswith(zip_extensions):
+            import zipfile
+            self.zip, self.tar = zipfile.ZipFile(self.file), None
+            for info in self.zip.infolist():
+                if info.is_dir():
+                    continue
+                self.members[info.filename] = info
+                # Members which are neither compressed nor encrypted are stored as they are
+                if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1 and self.map is not None:
+                    offset = self._zip_data_offset(info)
+                    if offset is not None:
+                        self.spans[info.filename] = (offset, info.file_size)
+        else:
+            import tarfile
+            self.zip, self.tar = None, tarfile.open(fileobj=self.file, mode="r:*")
+            # A compressed tar is read through a decompressing file object, rather than the archive's own file
+            compressed = self.tar.fileobj is not self.file
+            for info in self.tar.getmembers():
+                if not info.isfile():
+                    continue
+                self.members[info.name] = info
+                if not compressed and not info.issparse() and self.map is not None:
+                    self.spans[info.name] = (info.offset_data, info.size)
+
+    def _zip_data_offset(self, info):
+        start = info.header_offset
+        if self.map[start:start + len(_local_header)] != _local_header:
+            return None
+        name_length, extra_length = struct.unpack_from("<HH", self.map, start + 26)
+        return start + _local_header_size + name_length + extra_length
+
+    def names(self):
+        ''' The paths of the files in the archive, in the order they are stored'''
+        return list(self.members)
+
+    def read(self, member, size=None):
+        ''' The contents of a member: a memoryview of the archive's map if the member is stored uncompressed,
+            otherwise the decompressed bytes. size limits how much of the start of the member is read.
+        '''
+        if member in self.spans:
+            offset, length = self.spans[member]
+            if size is not None:
+                length = min(length, size)
+            return memoryview(self.map)[offset:offset + length]
+        info = self.members.get(member)
+        if info is None:
+            raise FileNotFoundError(f"No such member <{member}> in the archive <{self.path}>")
+        with self.lock:
+            member_file = self.zip.open(info) if self.zip is not None else self.tar.extractfile(info)
+            with member_file:
+                return member_file.read(-1 if size is None else size)
+
+    def close(self):
+        # The map isn't closed, as datasets and dose grids may still be reading from it: it is unmapped once they're gone
+        (self.zip or self.tar).close()
+        self.file.close()
+
+def open_archive(path):
+    ''' The Archive at path, opened by this process the first time it is read'''
+    global _archives_pid
+    path = os.path.abspath(path)
+    with _archives_lock:
+        # The workers of a parallel batch may be forked from a process which already opened the archive. They open it
+        # again, as a forked file would share its position with the other processes.
+        if _archives_pid != os.getpid():
+            _archives.clear()
+            _archives_pid = os.getpid()
+        archive = _archives.get(path)
+        if archive is None:
+            archive = _archives[path] = Archive(path)
+            while len(_archives) > open_archives:
+                _archives.popitem(last=False)[1].close()
+        else:
+            _archives.move_to_end(path)
+        return archive
+
+def find_members(archive):
+    ''' The files in an archive, in the order they are stored, as a list of Members'''
+    archive_stat = os.stat(archive)
+    return [Member(os.fspath(archive), name, archive_stat) for name in open_archive(archive).names()]
+
+def read_member(location, size=None):
+    ''' The contents of the archive member at location (see Archive.read)'''
+    archive, member = split_member(location)
+    return open_archive(archive).read(member, size)
+
+def open_member(location):
+    ''' A file object reading the archive member at location, from memory'''
+    return MemoryFile(read_member(location))
+
+def source(location):
+    ''' What a DICOM should be read from: a file object if location is an archive member, otherwise location itself'''
+    return open_member(location) if split_member(location) else location
+
+class MemoryFile:
+    ''' A read-only file object over a buffer in memory, such as a memoryview of a mapped archive
+        Unlike io.BytesIO, the buffer isn't copied: each read copies only the bytes it returns.
+
+    view    - a memoryview of the buffer
+    '''
+    def __init__(self, buffer):
+        self.view = memoryview(buffer)
+        self.position = 0
+
+    def read(self, size=-1):
+        start = self.position
+        end = len(self.view) if size is None or size < 0 else min(start + size, len(self.view))
+        self.position = max(start, end)
+        return self.view[start:end].tobytes()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError(f"negative seek position {offset}")
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
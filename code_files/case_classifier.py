@@ -0,0 +1,145 @@
+''' Module for working out which case of the truth table a plan is, so that batches can run without anyone to ask
+
+Each plan is fingerprinted with the values the extractors already take from it (beam count and gantry angles,
+SSDs, field sizes, wedges, energies, prescription...) and the case number in its name, if it has one: plans are
+usually named after their case, e.g. RTPlanName "7a" or RTPlanLabel "A7a". The fingerprint is then compared with
+every case of the truth table, using the same evaluation functions as a normal run:
+
+    score = (parameters passed + label_weight if the name gives this case) / (parameters checked + label_weight)
+
+where parameters which can't be checked (the value isn't extracted, or the case accepts anything) don't count.
+The case with the highest score is chosen if its score is at least min_confidence and it is at least min_margin
+ahead of the next best case. Otherwise the plan is left for someone to review, with the best cases as alternatives.
+'''
+
+import csv
+import os
+import re
+from code_files import strings
+from code_files.parameters.extractor_functions import mode_cases
+from code_files.parameters.parameter_retrieval import extract_parameters, evaluate_parameters
+
+# A case number at the start of a plan's name, optionally after a single letter: "7a", "A7a", "1c6FFF", "12"
+_label_pattern = re.compile(r"^[A-Za-z]?(\d{1,3})(?!\d)")
+
+# How much a case number in the plan's name counts for, in parameters passed
+label_weight = 3
+# The lowest score a case can be chosen with, and how far ahead of the next case it must be
+min_confidence = 0.75
+min_margin = 0.1
+# The number of alternatives reported with each classification
+alternatives = 3
+
+class Classification:
+    ''' The result of classifying a plan
+
+    case            - the most likely case
+    confidence      - its score, between 0 and 1
+    confident       - whether the case is certain enough to use without review
+    alternatives    - [(case, score), ...] for the next most likely cases
+    label_case      - the case number found in the plan's name, or None
+    '''
+    __slots__ = ("case", "confidence", "confident", "alternatives", "label_case")
+
+    def __init__(self, case, confidence, confident, alternatives, label_case):
+        self.case = case
+        self.confidence = confidence
+        self.confident = confident
+        self.alternatives = alternatives
+        self.label_case = label_case
+
+    def describe_alternatives(self):
+        return " ".join("{}:{:.2f}".format(case, score) for case, score in self.alternatives)
+
+class CaseIndex:
+    ''' The cases of a truth table, grouped by the values extracted for them
+
+    Extraction only depends on the case for the cases in mode_cases, so a plan is extracted at most twice:
+    once for those cases and once for the rest.
+    '''
+    def __init__(self, truth_table):
+        self.truth_table = truth_table
+        self.cases = list(range(1, len(truth_table["case"]) + 1))
+        self.groups = {}
+        for case in self.cases:
+            representative = next((other for other in self.cases if (other in mode_cases) == (case in mode_cases)))
+            self.groups.setdefault(representative, []).append(case)
+
+def case_index(truth_table):
+    ''' The CaseIndex of a truth table, built the first time it's needed (for compiled truth tables, once)'''
+    index = getattr(truth_table, "case_index", None)
+    if index is None:
+        index = CaseIndex(truth_table)
+        try:
+            truth_table.case_index = index
+        except AttributeError:
+            pass
+    return index
+
+def label_case(dataset, location=None):
+    ''' The case number in a plan's RTPlanName or RTPlanLabel (or its filename, after the last "_"), or None'''
+    names = [dataset.get("RTPlanName"), dataset.get("RTPlanLabel")]
+    if location is not None:
+        names.append(os.path.splitext(os.path.basename(str(location)))[0].split("_")[-1])
+    for name in names:
+        match = _label_pattern.match(str(name or "").strip())
+        if match:
+            return int(match.group(1))
+    return None
+
+def score_cases(dataset, truth_table, location=None):
+    ''' Scores how well a plan fits every case of a truth table
+        Returns [(score, case), ...] sorted from the best fit, and the case number in the plan's name (or None)
+    '''
+    index = case_index(truth_table)
+    named_case = label_case(dataset, location)
+    if named_case not in index.cases:
+        named_case = None
+
+    scores = []
+    for representative, cases in index.groups.items():
+        parameters = extract_parameters(dataset, None, representative)
+        for case in cases:
+            evaluations = evaluate_parameters(parameters, truth_table, case)
+            passed = sum(1 for result in evaluations.values() if result == strings.PASS)
+            checked = passed + sum(1 for result in evaluations.values() if result == strings.FAIL)
+            weight = label_weight if named_case is not None else 0
+            bonus = label_weight if case == named_case else 0
+            scores.append(((passed + bonus) / (checked + weight) if checked + weight else 0.0, case))
+    # Ties go to the lower case number
+    scores.sort(key=lambda score: (-score[0], score[1]))
+    return scores, named_case
+
+def classify(dataset, truth_table, location=None):
+    ''' Works out the most likely case of a plan
+        Returns a Classification
+    '''
+    scores, named_case = score_cases(dataset, truth_table, location)
+    best_score, best_case = scores[0]
+    runner_up = scores[1][0] if len(scores) > 1 else 0.0
+    confident = best_score >= min_confidence and best_score - runner_up >= min_margin
+    others = [(case, round(score, 3)) for score, case in scores[1:alternatives + 1] if score > 0]
+    return Classification(best_case, round(best_score, 3), confident, others, named_case)
+
+class ReviewList:
+    ''' A CSV of the plans whose case couldn't be worked out with confidence, created when the first is added'''
+    header = ["location", "suggested case", "confidence", "alternatives", "case in name"]
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.file = None
+        self.count = 0
+
+    def add(self, location, classification):
+        if self.file is None:
+            self.file = open(self.filepath, 'w', newline='')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(self.header)
+        self.writer.writerow([location, classification.case, classification.confidence,
+                              classification.describe_alternatives(), classification.label_case or ""])
+        self.file.flush()
+        self.count += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
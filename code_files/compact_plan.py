@@ -0,0 +1,289 @@
+''' Module for reading RTPLANs with very many control points in bounded memory
+
+pydicom turns every control point of every beam into a Dataset, and each of its elements into an object. On large
+VMAT plans this costs around ten times the size of the file. Only the first couple of control points of each beam are
+needed as datasets though; from the rest, the extractors only need the gantry angle, the dose point SSD and the
+positions of the jaws and leaves.
+
+read_compact_plan() streams through the file itself instead. Every control point after the first kept_control_points
+of a beam is read straight into arrays of numbers, and the rest of the plan (the elements asked for, with the
+shortened ControlPointSequences) is handed to pydicom to read as usual. The arrays are attached to each beam dataset
+as compact_control_points, where PlanSummary picks them up instead of walking the control points.
+
+Only little endian transfer syntaxes without compression are streamed; read_compact_plan() returns None for others.
+'''
+
+import io
+import struct
+from array import array
+
+# Tags of the elements the reader looks for
+_SpecificCharacterSet = 0x00080005
+_BeamSequence = 0x300A00B0
+_ControlPointSequence = 0x300A0111
+_GantryAngle = 0x300A011E
+_ReferencedDoseReferenceSequence = 0x300C0050
+_BeamDosePointSSD = 0x300A008A
+_BeamLimitingDevicePositionSequence = 0x300A011A
+_RTBeamLimitingDeviceType = 0x300A00B8
+_LeafJawPositions = 0x300A011C
+_Item = 0xFFFEE000
+_ItemDelimiter = 0xFFFEE00D
+_SequenceDelimiter = 0xFFFEE0DD
+_TransferSyntaxUID = 0x00020010
+_undefined_length = 0xFFFFFFFF
+
+_ImplicitVRLittleEndian = "1.2.840.10008.1.2"
+_ExplicitVRLittleEndian = "1.2.840.10008.1.2.1"
+
+# The number of control points of each beam kept as datasets (PlanSummary reads the first two of the first beam)
+kept_control_points = 2
+
+# In explicit VR, these VRs have a 4 byte length after 2 reserved bytes, rather than a 2 byte length
+_long_length_VRs = {b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC", b"UN", b"UR", b"UT", b"UV"}
+
+_item_start = struct.pack("<HHI", 0xFFFE, 0xE000, _undefined_length)
+_item_end = struct.pack("<HHI", 0xFFFE, 0xE00D, 0)
+_sequence_end = struct.pack("<HHI", 0xFFFE, 0xE0DD, 0)
+
+class _Stream:
+    ''' Reads the elements of a DICOM one header at a time'''
+    def __init__(self, fp, implicit):
+        self.fp = fp
+        self.implicit = implicit
+
+    def header(self):
+        ''' Reads the next element header
+            Returns (tag, length, the header's bytes), or None at the end of the file
+        '''
+        data = self.fp.read(8)
+        if len(data) < 8:
+            return None
+        group, element, length = struct.unpack("<HHI", data)
+        # Items and delimiters never have a VR
+        if self.implicit or group == 0xFFFE:
+            return group << 16 | element, length, data
+        vr = data[4:6]
+        if vr in _long_length_VRs:
+            extra = self.fp.read(4)
+            return group << 16 | element, struct.unpack("<I", extra)[0], data + extra
+        return group << 16 | element, struct.unpack_from("<H", data, 6)[0], data
+
+    def next_header(self):
+        header = self.header()
+        if header is None:
+            raise ValueError("The DICOM ended in the middle of a sequence")
+        return header
+
+    def value(self, length, sink=None):
+        ''' Reads (or skips) the value of an element whose header was just read, copying it to sink if given'''
+        if length != _undefined_length:
+            if sink is None:
+                self.fp.seek(length, io.SEEK_CUR)
+            else:
+                sink += self.fp.read(length)
+            return
+        # An undefined length means a sequence, which ends with a sequence delimiter
+        while True:
+            tag, item_length, raw = self.next_header()
+            if sink is not None:
+                sink += raw
+            if tag == _SequenceDelimiter:
+                return
+            self.item(item_length, sink)
+
+    def item(self, length, sink=None):
+        ''' Reads (or skips) the contents of an item whose header was just read, copying them to sink if given'''
+        if length != _undefined_length:
+            self.value(length, sink)
+            return
+        while True:
+            tag, element_length, raw = self.next_header()
+            if sink is not None:
+                sink += raw
+            if tag == _ItemDelimiter:
+                return
+            self.value(element_length, sink)
+
+    def elements(self, length=None):
+        ''' Yields (tag, length, header bytes) of each element of an item, or of the whole file if length is None
+            The caller must read or skip each element's value before asking for the next
+        '''
+        end = None if length is None or length == _undefined_length else self.fp.tell() + length
+        while end is None or self.fp.tell() < end:
+            header = self.header() if length is None else self.next_header()
+            if header is None or header[0] == _ItemDelimiter:
+                return
+            yield header
+
+    def items(self, length):
+        ''' Yields the length of each item of a sequence whose header was just read
+            The caller must read or skip each item's contents before asking for the next
+        '''
+        end = None if length == _undefined_length else self.fp.tell() + length
+        while end is None or self.fp.tell() < end:
+            tag, item_length, raw = self.next_header()
+            if tag == _SequenceDelimiter:
+                return
+            yield item_length
+
+def _sequence_header(tag, implicit):
+    if implicit:
+        return struct.pack("<HHI", tag >> 16, tag & 0xFFFF, _undefined_length)
+    return struct.pack("<HH2sHI", tag >> 16, tag & 0xFFFF, b"SQ", 0, _undefined_length)
+
+def _decimal(data):
+    ''' The first value of a DS (decimal string) element'''
+    try:
+        return float(data.strip(b" \0").split(b"\\")[0])
+    except ValueError:
+        return None
+
+def _decimals(data):
+    ''' All the values of a DS (decimal string) element, as an array'''
+    try:
+        return array('d', [float(value) for value in data.strip(b" \0").split(b"\\")])
+    except ValueError:
+        return None
+
+def _float(data):
+    ''' The first value of an FL (4 byte float) element'''
+    return struct.unpack_from("<f", data)[0] if len(data) >= 4 else None
+
+def _control_point_values(stream, length):
+    ''' Reads a control point, returning its gantry angle and dose point SSD (cm), each None if missing, and the
+        positions of the devices it lists: {RTBeamLimitingDeviceType: LeafJawPositions}
+    '''
+    gantry = ssd = None
+    devices = {}
+    for tag, element_length, raw in stream.elements(length):
+        if tag == _GantryAngle:
+            gantry = _decimal(stream.fp.read(element_length))
+        elif tag == _BeamLimitingDevicePositionSequence:
+            for item_length in stream.items(element_length):
+                device = positions = None
+                for item_tag, value_length, item_raw in stream.elements(item_length):
+                    if item_tag == _RTBeamLimitingDeviceType:
+                        device = stream.fp.read(value_length).strip(b" \0").decode("ascii", "replace")
+                    elif item_tag == _LeafJawPositions:
+                        positions = _decimals(stream.fp.read(value_length))
+                    else:
+                        stream.value(value_length)
+                if device is not None and positions is not None:
+                    devices[device] = positions
+        elif tag == _ReferencedDoseReferenceSequence:
+            # The SSD is in the second dose reference
+            for index, item_length in enumerate(stream.items(element_length)):
+                if index != 1:
+                    stream.item(item_length)
+                    continue
+                for item_tag, value_length, item_raw in stream.elements(item_length):
+                    if item_tag == _BeamDosePointSSD:
+                        value = _float(stream.fp.read(value_length))
+                        ssd = round(value/10, 2) if value is not None else None
+                    else:
+                        stream.value(value_length)
+        else:
+            stream.value(element_length)
+    return gantry, ssd, devices
+
+def _read_beam(stream, length, sink):
+    ''' Copies a beam to sink, apart from all but the first control points, whose values are returned as arrays
+        (and a list of the device positions of each control point)
+    '''
+    gantry, ssd, devices = array('d'), array('d'), []
+    for tag, element_length, raw in stream.elements(length):
+        if tag != _ControlPointSequence:
+            sink += raw
+            stream.value(element_length, sink)
+            continue
+        sink += _sequence_header(tag, stream.implicit)
+        for index, item_length in enumerate(stream.items(element_length)):
+            if index < kept_control_points:
+                # Kept control points are copied whole, and their values read back from the copy
+                control_point = bytearray()
+                stream.item(item_length, control_point)
+                if item_length == _undefined_length:
+                    # Leave out the item delimiter, as the item is rewritten with one of its own
+                    del control_point[-len(_item_end):]
+                sink +=_item_start + control_point + _item_end
+                values = _control_point_values(_Stream(io.BytesIO(bytes(control_point)), stream.implicit), len(control_point))
+            else:
+                values = _control_point_values(stream, item_length)
+            # As in PlanSummary, an array is None if any control point is missing its value
+            if gantry is not None:
+                gantry = gantry if values[0] is not None and not gantry.append(values[0]) else None
+            if ssd is not None:
+                ssd = ssd if values[1] is not None and not ssd.append(values[1]) else None
+            devices.append(values[2])
+        sink += _sequence_end
+    return gantry, ssd, devices
+
+def _encoding(fp):
+    ''' Reads past the preamble and file meta information, if there are any
+        Returns whether the dataset is implicit VR, or None if it's in a transfer syntax that isn't streamed
+    '''
+    start = fp.read(132)
+    if start[128:132] == b"DICM":
+        meta = _Stream(fp, implicit=False)
+        transfer_syntax = None
+        while True:
+            position = fp.tell()
+            header = meta.header()
+            if header is None or header[0] >> 16 != 0x0002:
+                fp.seek(position)
+                break
+            value = fp.read(header[1])
+            if header[0] == _TransferSyntaxUID:
+                transfer_syntax = value.strip(b" \0").decode("ascii", "replace")
+        return {_ImplicitVRLittleEndian: True, _ExplicitVRLittleEndian: False}.get(transfer_syntax)
+
+    # Without file meta information, the encoding is guessed from the first element, as pydicom does
+    fp.seek(0)
+    vr = start[4:6]
+    return not (len(vr) == 2 and vr.isalpha() and vr.isupper())
+
+def read_compact_plan(location, tags):
+    ''' Reads the given elements of an RTPLAN, keeping only the first few control points of each beam as datasets
+
+    location    - the filepath of the DICOM, or a file-like object holding it
+    tags        - the keywords of the top level elements to read
+    Returns a pydicom Dataset, or None if the DICOM's transfer syntax can't be streamed
+    '''
+    from pydicom.datadict import tag_for_keyword
+    from pydicom.filereader import read_dataset
+
+    wanted = set(tag_for_keyword(keyword) for keyword in tags) | {_SpecificCharacterSet}
+    last_wanted = max(wanted)
+    fp = location if hasattr(location, "read") else open(location, 'rb')
+    try:
+        implicit = _encoding(fp)
+        if implicit is None:
+            return None
+        stream = _Stream(fp, implicit)
+        kept = bytearray()
+        beam_arrays = []
+        for tag, length, raw in stream.elements():
+            # Elements are stored in ascending tag order, so nothing wanted comes after the last wanted tag
+            if tag > last_wanted:
+                break
+            if tag == _BeamSequence and tag in wanted:
+                kept += _sequence_header(tag, implicit)
+                for item_length in stream.items(length):
+                    kept += _item_start
+                    beam_arrays.append(_read_beam(stream, item_length, kept))
+                    kept += _item_end
+                kept += _sequence_end
+            elif tag in wanted:
+                kept += raw
+                stream.value(length, kept)
+            else:
+                stream.value(length)
+    finally:
+        if fp is not location:
+            fp.close()
+
+    dataset = read_dataset(io.BytesIO(bytes(kept)), implicit, True)
+    for beam, arrays in zip(dataset.get("BeamSequence") or [], beam_arrays):
+        beam.compact_control_points = arrays
+    return dataset
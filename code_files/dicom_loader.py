@@ -0,0 +1,79 @@
+''' Module for reading only the parts of a DICOM that the program needs
+
+Reading a whole DICOM is wasteful when most of it is never used: RTDOSE and CT files carry large pixel data,
+and the extractors only look at a handful of elements of an RTPLAN. Files are instead read in two steps:
+
+read_header()   - reads just far enough into the file to find its Modality, StudyInstanceUID and SOPInstanceUID.
+                  This is enough to skip files that aren't plans, and to index dose and structure files.
+read_plan()     - reads only the elements that the registered extractors declare they need
+                  (see extractor_tags in code_files/parameters/extractor_functions.py). In low memory mode, the
+                  control points of each beam are streamed into arrays instead (see code_files/compact_plan.py).
+
+Both also read members of zip and tar archives, given as "archive.zip!member" (see code_files/archives.py).
+'''
+
+from code_files import strings, archives
+from code_files.parameters.extractor_functions import extractor_tags
+
+# pydicom takes a large part of the program's startup time, so it is only imported once a DICOM is actually read
+
+# Elements used to identify what a DICOM is and which study it belongs to, by keyword and by tag number
+header_tags = ["SOPInstanceUID", "Modality", "StudyInstanceUID"]
+_header_tag_numbers = [0x00080018, 0x00080060, 0x0020000D]
+
+# Elements in a DICOM are stored in ascending tag order, so a header read can stop at the first element
+# past the last header tag instead of going through the rest of the file
+_last_header_tag = max(_header_tag_numbers)
+
+def _past_header(tag, VR, length):
+    return tag > _last_header_tag
+
+def read_header(location):
+    ''' Reads the Modality, StudyInstanceUID and SOPInstanceUID of a DICOM, without reading the rest of the file
+
+    location    - the filepath of the DICOM (or archive member), or a file-like object holding it
+    Returns a pydicom Dataset containing only the header tags that were found
+    '''
+    from pydicom.filereader import read_partial
+    location = archives.source(location)
+    if hasattr(location, "read"):
+        return read_partial(location, stop_when=_past_header, force=True, specific_tags=_header_tag_numbers)
+    with open(location, 'rb') as fp:
+        return read_partial(fp, stop_when=_past_header, force=True, specific_tags=_header_tag_numbers)
+
+# Elements naming a plan, which usually give away its case (see code_files/case_classifier.py)
+name_tags = ["RTPlanLabel", "RTPlanName"]
+
+def plan_tags():
+    ''' The elements of an RTPLAN needed to extract every parameter'''
+    tags = header_tags + name_tags
+    for parameter in strings.parameters:
+        for keyword in extractor_tags[parameter]:
+            if keyword not in tags:
+                tags.append(keyword)
+    return tags
+
+# In low memory mode, values larger than this many bytes are only read from the file if they are used
+defer_size = 1024
+
+def read_plan(location, tags=None, low_memory=False):
+    ''' Reads the elements of an RTPLAN that are needed for extraction
+
+    location    - the filepath of the DICOM (or archive member), or a file-like object holding it
+    tags        - the keywords of the elements to read. Defaults to those needed by all registered extractors
+    low_memory  - whether to keep only the first control points of each beam as datasets (see read_compact_plan)
+    '''
+    import pydicom
+    location = archives.source(location)
+    tags = plan_tags() if tags is None else tags
+    if low_memory:
+        from code_files.compact_plan import read_compact_plan
+        dataset = read_compact_plan(location, tags)
+        if dataset is not None:
+            return dataset
+        # The transfer syntax can't be streamed, so fall back to deferring the large values of a normal read
+        if hasattr(location, "seek"):
+            location.seek(0)
+        else:
+            return pydicom.dcmread(location, force=True, stop_before_pixels=True, specific_tags=tags, defer_size=defer_size)
+    return pydicom.dcmread(location, force=True, stop_before_pixels=True, specific_tags=tags)
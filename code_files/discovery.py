@@ -0,0 +1,151 @@
+''' Module for finding the DICOMs in a folder
+
+By default only the files directly in a folder whose names end in .dcm are found. find_dicoms() can also:
+
+- search the folder's subfolders too (e.g. an archive organised into patient/study/series folders)
+- choose files with include and exclude glob patterns, e.g. include ["RP*"] or exclude ["*/old/*", "*.bak"]
+- recognise DICOMs by their contents rather than their names, for exports whose files have no extension
+- find the DICOMs in a zip or tar archive, as if it were a folder (see code_files/archives.py)
+
+Listing a deep tree of folders on a network drive is slow, so subfolders can be listed by a pool of threads
+ahead of when they're needed. find_dicoms() is a generator, so processing can start before the search finishes.
+The files are always found in the same order: each folder's files sorted by name, then its subfolders in turn.
+'''
+
+import os
+import struct
+from fnmatch import fnmatchcase
+from code_files.archives import is_archive, find_members, split_member, read_member
+
+# Files written with the DICOM file format have a 128 byte preamble followed by "DICM"
+_preamble_size = 128
+_magic = b"DICM"
+# Other DICOMs (like the sample plans) start straight away with their first element, which is normally in
+# group 0x0002 (file meta information) or group 0x0008 (identifying information, e.g. SpecificCharacterSet)
+_first_groups = (0x0002, 0x0008)
+
+def looks_like_dicom(path):
+    ''' Whether a file (or archive member) looks like a DICOM, from its first 132 bytes'''
+    try:
+        if split_member(path):
+            start = bytes(read_member(path, _preamble_size + len(_magic)))
+        else:
+            with open(path, 'rb') as dicom_file:
+                start = dicom_file.read(_preamble_size + len(_magic))
+    except OSError:
+        return False
+    if start[_preamble_size:] == _magic:
+        return True
+    if len(start) < 8:
+        return False
+    group, element = struct.unpack_from("<HH", start)
+    return group in _first_groups and element < 0x1000
+
+def _matches(relative_path, name, patterns):
+    # Patterns are compared with both the file's name and its path within the folder being searched
+    return any(fnmatchcase(name, pattern) or fnmatchcase(relative_path, pattern) for pattern in patterns)
+
+def folder_searched(root, folder, recursive=False, exclude=None):
+    ''' Whether find_dicoms(root) searches folder, one of root's subfolders (or root itself)'''
+    relative = os.path.relpath(folder, root).replace(os.sep, "/")
+    if relative == ".":
+        return True
+    if not recursive or relative == ".." or relative.startswith("../"):
+        return False
+    # Subfolders left out by exclude aren't searched, and neither are the folders within them
+    parts = relative.split("/")
+    return not (exclude and any(_matches("/".join(parts[:depth]), parts[depth - 1], exclude) for depth in range(1, len(parts) + 1)))
+
+def file_found(root, path, recursive=False, include=None, exclude=None, detect=False, **options):
+    ''' Whether find_dicoms(root) with the same options finds the file at path, going by its name and folder
+        (files are checked one at a time this way as they arrive in a watched folder). With detect, the contents of
+        the file also have to look like a DICOM, which is left to the caller: see looks_like_dicom.
+    '''
+    include = include or (["*"] if detect else ["*.dcm"])
+    if not folder_searched(root, os.path.dirname(path), recursive, exclude):
+        return False
+    relative, name = os.path.relpath(path, root).replace(os.sep, "/"), os.path.basename(path)
+    return _matches(relative, name, include) and not (exclude and _matches(relative, name, exclude))
+
+def _list_folder(folder):
+    ''' Returns the files and the subfolders of a folder, each sorted by name
+        Subfolders which can't be listed (e.g. for lack of permission) are treated as empty
+    '''
+    files, folders = [], []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry)
+                    elif entry.is_file():
+                        files.append(entry)
+                except OSError:
+                    continue
+    except (PermissionError, FileNotFoundError):
+        return [], []
+    files.sort(key=lambda entry: entry.name)
+    folders.sort(key=lambda entry: entry.name)
+    return files, folders
+
+def find_dicoms(folder, recursive=False, include=None, exclude=None, detect=False, threads=1):
+    ''' Generator of the DICOMs in a folder, as os.DirEntry objects (or archives.Member objects, for an archive)
+
+    folder      - the folder to search, or an archive. An archive is searched as a whole, in the order it is stored.
+    recursive   - whether to search its subfolders as well
+    include     - glob patterns of the files to include. Defaults to ["*.dcm"], or ["*"] when detect is set
+    exclude     - glob patterns of the files and subfolders to leave out
+    detect      - whether to only include files whose contents look like a DICOM (see looks_like_dicom)
+    threads     - the number of threads listing subfolders at once, when searching recursively
+    '''
+    include = include or (["*"] if detect else ["*.dcm"])
+    exclude = exclude or []
+    root = os.path.abspath(folder)
+
+    # Patterns are matched against the paths of members within the archive, as they are for files within a folder
+    if is_archive(folder):
+        for member in find_members(folder):
+            if _matches(member.member, member.name, include) and not (exclude and _matches(member.member, member.name, exclude)):
+                if not detect or looks_like_dicom(member.path):
+                    yield member
+        return
+
+    # The folder itself must exist, though subfolders that can't be listed are skipped
+    if not os.path.isdir(folder):
+        raise FileNotFoundError(f"No such folder: <{folder}>")
+
+    def wanted(entry, patterns):
+        return _matches(os.path.relpath(entry.path, root).replace(os.sep, "/"), entry.name, patterns)
+
+    def files_of(files):
+        for entry in files:
+            if wanted(entry, include) and not (exclude and wanted(entry, exclude)):
+                if not detect or looks_like_dicom(entry.path):
+                    yield entry
+
+    def subfolders_of(folders):
+        return [entry for entry in folders if not (exclude and wanted(entry, exclude))] if recursive else []
+
+    if threads <= 1 or not recursive:
+        def walk(path):
+            files, folders = _list_folder(path)
+            yield from files_of(files)
+            for entry in subfolders_of(folders):
+                yield from walk(entry.path)
+        yield from walk(folder)
+        return
+
+    # Every subfolder found is listed straight away by the pool, while the files are still yielded in order
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="discovery") as executor:
+        def walk(listing):
+            files, folders = listing.result()
+            listings = [executor.submit(_list_folder, entry.path) for entry in subfolders_of(folders)]
+            try:
+                yield from files_of(files)
+                for sublisting in listings:
+                    yield from walk(sublisting)
+            finally:
+                for sublisting in listings:
+                    sublisting.cancel()
+        yield from walk(executor.submit(_list_folder, folder))
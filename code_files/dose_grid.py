@@ -0,0 +1,163 @@
+''' Module for looking up doses in an RTDOSE grid without reading the whole grid
+
+A dose grid can be hundreds of MB, while the dose-based parameters only need the dose at a few points (e.g. the
+prescription point). A DoseGrid reads just the elements describing the grid, and finds where its PixelData starts
+in the file. The pixel data is then memory-mapped with numpy.memmap, so looking up a dose only reads the parts
+of the file holding the voxels around the point.
+
+Points are given in patient coordinates (mm), and doses are returned in the grid's DoseUnits (normally GY),
+already multiplied by DoseGridScaling. Doses between voxel centres are interpolated trilinearly. Points outside
+the grid have a dose of nan.
+
+Compressed (encapsulated) pixel data can't be memory-mapped, so it is decoded in full instead. The pixel data of an
+RTDOSE in an archive is an array over the member's contents in memory (see code_files/archives.py).
+'''
+
+import math
+from code_files import archives
+
+_PixelData = 0x7FE00010
+_undefined_length = 0xFFFFFFFF
+
+class DoseGrid:
+    ''' The dose grid of an RTDOSE
+
+    path    - the filepath of the RTDOSE, or its location in an archive
+
+    dataset     - the elements of the RTDOSE, apart from its PixelData
+    origin      - the position (mm) of the centre of the first voxel (ImagePositionPatient)
+    spacing     - the distance (mm) between voxel centres along rows, columns and frames
+    shape       - the number of (frames, rows, columns)
+    scaling     - the factor converting stored voxel values to dose (DoseGridScaling)
+    '''
+    def __init__(self, path):
+        import numpy as np
+        import pydicom
+        self.path = path
+        self.source = archives.source(path)
+        # Values over 1 KB (the pixel data) are left in the file. Only where the pixel data starts is noted.
+        self.dataset = pydicom.dcmread(self.source, force=True, defer_size=1024)
+        dataset = self.dataset
+
+        self.scaling = float(dataset.get("DoseGridScaling", 1.0))
+        frames = int(dataset.get("NumberOfFrames", 1) or 1)
+        self.shape = (frames, int(dataset.Rows), int(dataset.Columns))
+
+        # The directions of rows, columns and frames in patient coordinates
+        orientation = [float(value) for value in dataset.get("ImageOrientationPatient", [1, 0, 0, 0, 1, 0])]
+        self.row_direction = np.array(orientation[:3])
+        self.column_direction = np.array(orientation[3:])
+        self.frame_direction = np.cross(self.row_direction, self.column_direction)
+        self.origin = np.array([float(value) for value in dataset.ImagePositionPatient])
+
+        # PixelSpacing is (between rows, between columns)
+        row_spacing, column_spacing = (float(value) for value in dataset.PixelSpacing)
+        # GridFrameOffsetVector is relative to the first frame when it starts at 0, and holds positions otherwise
+        offsets = np.array([float(value) for value in dataset.get("GridFrameOffsetVector", [0.0])[:frames]])
+        if offsets[0] != 0:
+            offsets = offsets - self.origin.dot(self.frame_direction)
+        self.frame_offsets = offsets
+        frame_spacing = abs(offsets[1] - offsets[0]) if len(offsets) > 1 else 0.0
+        self.spacing = (column_spacing, row_spacing, frame_spacing)
+
+        self._pixels = None
+
+    @property
+    def pixels(self):
+        ''' The stored voxel values, as a (frames, rows, columns) array. Memory-mapped unless they are compressed.'''
+        if self._pixels is None:
+            self._pixels = self._map_pixels()
+        return self._pixels
+
+    def _map_pixels(self):
+        import numpy as np
+        dataset = self.dataset
+        element = dataset.get_item(_PixelData, keep_deferred=True)
+        if element is None:
+            raise ValueError(f"The RTDOSE <{self.path}> has no pixel data")
+
+        implicit, little_endian = dataset.original_encoding
+        if getattr(element, "value_tell", None) is None or element.length == _undefined_length:
+            # Compressed, or small enough to have been read already
+            return dataset.pixel_array.reshape(self.shape)
+
+        signed = int(dataset.get("PixelRepresentation", 0)) == 1
+        dtype = np.dtype("{}{}{}".format("<" if little_endian else ">", "i" if signed else "u", int(dataset.BitsAllocated) // 8))
+        if isinstance(self.source, archives.MemoryFile):
+            return np.frombuffer(self.source.view, dtype=dtype, count=math.prod(self.shape),
+                                 offset=element.value_tell).reshape(self.shape)
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=element.value_tell, shape=self.shape)
+
+    def _indices(self, points):
+        ''' The fractional (frame, row, column) index of each point, with nan for points outside the grid'''
+        import numpy as np
+        relative = points - self.origin
+        column = relative.dot(self.row_direction) / self.spacing[0]
+        row = relative.dot(self.column_direction) / self.spacing[1]
+
+        # Frames may be unevenly spaced, or in descending order
+        frame_position = relative.dot(self.frame_direction)
+        offsets = self.frame_offsets
+        if len(offsets) == 1:
+            frame = np.where(np.isclose(frame_position, offsets[0]), 0.0, np.nan)
+        else:
+            order = np.argsort(offsets)
+            frame = np.interp(frame_position, offsets[order], order.astype(float), left=np.nan, right=np.nan)
+
+        frames, rows, columns = self.shape
+        for index, size in ((row, rows), (column, columns)):
+            # A little tolerance, so that points on the edge of the grid aren't lost to rounding
+            index[np.isclose(index, 0)] = 0
+            index[np.isclose(index, size - 1)] = size - 1
+            index[(index < 0) | (index > size - 1)] = np.nan
+        return np.stack([frame, row, column], axis=1)
+
+    def doses(self, points):
+        ''' The dose at each of an (N, 3) array of points in patient coordinates (mm)
+            Returns an array of N doses, nan where a point is outside the grid
+        '''
+        import numpy as np
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        indices = self._indices(points)
+        inside = ~np.isnan(indices).any(axis=1)
+        doses = np.full(len(points), np.nan)
+        if not inside.any():
+            return doses
+
+        indices = indices[inside]
+        lower = np.floor(indices).astype(int)
+        # Points on the last voxel of an axis interpolate within the last pair of voxels
+        lower = np.minimum(lower, np.maximum(np.array(self.shape) - 2, 0))
+        fraction = indices - lower
+        upper = np.minimum(lower + 1, np.array(self.shape) - 1)
+
+        # The 8 voxels around each point, weighted by how close the point is to each
+        pixels = self.pixels
+        total = np.zeros(len(indices))
+        for corner in range(8):
+            pick = [(corner >> axis) & 1 for axis in range(3)]
+            voxel = tuple(np.where(pick[axis], upper[:, axis], lower[:, axis]) for axis in range(3))
+            weight = np.prod([np.where(pick[axis], fraction[:, axis], 1 - fraction[:, axis]) for axis in range(3)], axis=0)
+            total += weight * pixels[voxel]
+        doses[inside] = total * self.scaling
+        return doses
+
+    def dose(self, point):
+        ''' The dose at a point (x, y, z) in patient coordinates (mm), or nan if it's outside the grid'''
+        return float(self.doses([point])[0])
+
+    def max_dose(self):
+        ''' The highest dose in the grid, read a frame at a time'''
+        if math.prod(self.shape) == 0:
+            return math.nan
+        return max(float(frame.max()) for frame in self.pixels) * self.scaling
+
+    def close(self):
+        ''' Releases the memory map of the pixel data (once nothing else refers to it)'''
+        self._pixels = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
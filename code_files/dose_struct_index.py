@@ -0,0 +1,99 @@
+''' Module for keeping a persistent index of the RTDOSE and RTSTRUCT files in a folder
+
+Finding the dose and structure files that go with a plan means reading the header of every DICOM in the folder.
+Rather than doing this on every run, the modality and StudyInstanceUID of each file are stored in an SQLite
+database along with the file's size and modification time. On the next run only files that are new, or whose
+size or modification time changed, are read again.
+'''
+
+import os
+import sqlite3
+from contextlib import closing
+from code_files import strings
+from code_files.dicom_loader import read_header
+from code_files.discovery import find_dicoms, looks_like_dicom
+
+_schema = '''
+    CREATE TABLE IF NOT EXISTS files (
+        path        TEXT PRIMARY KEY,
+        folder      TEXT NOT NULL,
+        size        INTEGER NOT NULL,
+        mtime_ns    INTEGER NOT NULL,
+        uid         TEXT,
+        modality    TEXT
+    );
+    CREATE INDEX IF NOT EXISTS files_folder ON files (folder);
+'''
+
+def build_index(folder_path, index_file=":memory:", **discovery):
+    ''' Function to build an index of RTDOSE and RTSTRUCT files by StudyInstanceUID, updating the stored index
+
+    folder_path - the folder to index
+    index_file  - the SQLite database holding the index. The default keeps it in memory for this call only.
+    discovery   - options for finding the DICOMs in the folder, e.g. recursive=True (see discovery.find_dicoms)
+    Returns a dictionary: {StudyInstanceUID: {RTDOSE: [paths,...]), RTSTRUCT: [paths,...]}, ...}
+    '''
+    folder = os.path.abspath(folder_path)
+    with closing(sqlite3.connect(index_file)) as connection:
+        connection.executescript(_schema)
+        with connection:
+            files = update_folder(connection, folder, **discovery)
+
+    dose_struct_index = {}
+    for path in sorted(files):
+        uid, modality = files[path]
+        if modality not in [strings.RTDOSE, strings.RTSTRUCT]:
+            continue
+        # create a new dictionary entry if we haven't seen this uid before
+        if uid not in dose_struct_index:
+            dose_struct_index[uid] = {strings.RTDOSE:[], strings.RTSTRUCT:[], None:[]}
+        dose_struct_index[uid][modality].append(path)
+    return dose_struct_index
+
+def update_folder(connection, folder, detect=False, include=None, **discovery):
+    ''' Brings the stored entries for a folder up to date with what's on disk
+        Returns a dictionary {path: (StudyInstanceUID, Modality)} for every DICOM in the folder
+    '''
+    stored = {path: (size, mtime_ns, uid, modality) for path, size, mtime_ns, uid, modality in
+              connection.execute("SELECT path, size, mtime_ns, uid, modality FROM files WHERE folder = ?", (folder,))}
+
+    files = {}
+    changed = []
+    # Files already in the index are known to be DICOMs, so only new files are checked when detecting DICOMs
+    include = include or (["*"] if detect else None)
+    for entry in find_dicoms(folder, include=include, **discovery):
+        stat = entry.stat()
+        path = entry.path
+        entry_info = stored.get(path)
+        # Only read the header of files that are new or have changed since they were last indexed
+        if entry_info is None or entry_info[:2] != (stat.st_size, stat.st_mtime_ns):
+            if detect and not looks_like_dicom(path):
+                continue
+            header = read_header(path)
+            uid, modality = header.get("StudyInstanceUID"), header.get("Modality")
+            uid = str(uid) if uid is not None else None
+            modality = str(modality) if modality is not None else None
+            changed.append((path, folder, stat.st_size, stat.st_mtime_ns, uid, modality))
+        else:
+            uid, modality = entry_info[2:]
+        files[path] = (uid, modality)
+
+    connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", changed)
+    removed = [(path,) for path in stored if path not in files]
+    connection.executemany("DELETE FROM files WHERE path = ?", removed)
+    return files
+
+def update_index(dose_struct_index, path, uid, modality):
+    ''' Adds a new or modified file to an index returned by build_index (e.g. while watching a folder)
+        Files which aren't RTDOSE or RTSTRUCT are only removed from the index, in case they were one before
+    '''
+    for entry in dose_struct_index.values():
+        for paths in entry.values():
+            if path in paths:
+                paths.remove(path)
+    if modality not in [strings.RTDOSE, strings.RTSTRUCT]:
+        return
+    if uid not in dose_struct_index:
+        dose_struct_index[uid] = {strings.RTDOSE:[], strings.RTSTRUCT:[], None:[]}
+    dose_struct_index[uid][modality].append(path)
+    dose_struct_index[uid][modality].sort()
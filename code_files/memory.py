@@ -0,0 +1,85 @@
+''' Module for measuring and limiting how much memory the program uses
+
+A large VMAT plan can take several hundred MB once pydicom has read it, and a parallel batch holds one plan per worker.
+A MemoryGuard is given a limit for the whole batch (the main process and its workers together), which the batch
+checks before starting on another plan: while the batch is over the limit, it waits for the plans in progress to
+finish instead.
+
+Memory is measured as the resident set size (RSS) of each process, from /proc on Linux, or with psutil elsewhere if
+it is installed. Where neither is available, the memory used can't be measured and a MemoryGuard never waits.
+'''
+
+import gc
+import os
+import sys
+import time
+
+_size_units = {"": 1, "B": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+def parse_size(text):
+    ''' Converts a size such as "512MB", "2G" or "1.5 GB" (or a plain number of bytes) to a number of bytes'''
+    value = str(text).strip().upper()
+    number = value.rstrip("BKMGTI ")
+    unit = value[len(number):].strip().replace("I", "")
+    if unit.endswith("B") and len(unit) == 2:
+        unit = unit[0]
+    try:
+        return int(float(number) * _size_units[unit])
+    except (ValueError, KeyError):
+        raise ValueError(f"Not a size: <{text}> (expected e.g. 512MB or 2GB)") from None
+
+def rss(pid=None):
+    ''' The resident set size in bytes of a process (this process by default), or None if it can't be measured'''
+    pid = os.getpid() if pid is None else pid
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except Exception:
+        return None
+
+def release():
+    ''' Frees the memory of objects that are no longer used, and hands as much as possible back to the system'''
+    gc.collect()
+    # glibc keeps freed memory for reuse by the process, unless told to trim it
+    if sys.platform.startswith("linux"):
+        try:
+            import ctypes
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+class MemoryGuard:
+    ''' Checks whether a batch is using more than its share of memory
+
+    limit   - the most memory in bytes that the main process and its workers should use together
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.measurable = rss() is not None
+
+    def used(self, pids=()):
+        ''' The memory in bytes used by this process and the processes with the given ids'''
+        return sum(rss(pid) or 0 for pid in [None, *pids])
+
+    def over(self, pids=()):
+        ''' Whether this process and the processes with the given ids are using more than the limit'''
+        return self.measurable and self.used(pids) > self.limit
+
+    def wait(self, pids=(), timeout=10.0, interval=0.1):
+        ''' Waits up to timeout seconds for the memory used to fall under the limit, freeing what it can first
+            Returns whether the memory used is under the limit
+        '''
+        if not self.over(pids):
+            return True
+        release()
+        deadline = time.monotonic() + timeout
+        while self.over(pids):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+        return True
@@ -0,0 +1,166 @@
+''' Timings and counts of what the program spends its time on
+
+Each stage of processing is wrapped in a timer, e.g.
+
+    with metrics.timer("read_plan", location):
+        dataset = read_plan(location)
+
+and events are counted with metrics.count("files_skipped"). For every timer name the number of calls, the total time
+and the slowest call (with its label, e.g. the plan it was for) are kept, so slow plans can be found after a run.
+
+Metrics are off unless enabled is set to True. While off, timer() returns a shared do-nothing context manager and
+count() returns straight away, so the instrumentation can stay in place at almost no cost.
+
+Worker processes keep their own metrics; each sends back a snapshot() which the main process merge()s.
+At the end of a run the metrics are saved with export_json() and export_prometheus() (the format read by the
+Prometheus node exporter's textfile collector).
+'''
+
+import json
+import os
+import time
+from time import perf_counter
+
+enabled = False
+
+# {name: [calls, total seconds, slowest call in seconds, label of the slowest call]}
+timings = {}
+# {name: count}
+counters = {}
+# Names of the timers whose every call is kept, e.g. so the slowest plans of a run can be listed when profiling
+kept = set()
+# {name: [(seconds, label), ...]} for the timers in kept
+kept_calls = {}
+
+class _Timer:
+    __slots__ = ("name", "label", "start")
+
+    def __init__(self, name, label):
+        self.name = name
+        self.label = label
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        record(self.name, perf_counter() - self.start, self.label)
+        return False
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+_null_timer = _NullTimer()
+
+def timer(name, label=None):
+    ''' A context manager which times its block under name
+
+    name    - the name of what is being timed, e.g. "read_plan" or "extract.gantry"
+    label   - optionally, what this particular call was for (e.g. the plan's location), kept for the slowest call
+    '''
+    if not enabled:
+        return _null_timer
+    return _Timer(name, label)
+
+def record(name, seconds, label=None):
+    ''' Adds one timed call to the metrics'''
+    if name in kept:
+        kept_calls.setdefault(name, []).append((seconds, label))
+    stats = timings.get(name)
+    if stats is None:
+        timings[name] = [1, seconds, seconds, label]
+        return
+    stats[0] += 1
+    stats[1] += seconds
+    if seconds > stats[2]:
+        stats[2] = seconds
+        stats[3] = label
+
+def count(name, amount=1):
+    ''' Adds amount to the counter called name'''
+    if enabled:
+        counters[name] = counters.get(name, 0) + amount
+
+def reset():
+    timings.clear()
+    counters.clear()
+    kept_calls.clear()
+
+def snapshot(clear=False):
+    ''' Returns a copy of the metrics recorded so far, which can be sent to another process and merged there
+        If clear is True, the metrics are reset afterwards
+    '''
+    copy = {"timings": dict((name, list(stats)) for name, stats in timings.items()), "counters": dict(counters),
+            "kept_calls": dict((name, list(timed)) for name, timed in kept_calls.items())}
+    if clear:
+        reset()
+    return copy
+
+def merge(other):
+    ''' Adds the metrics of a snapshot (e.g. from a worker process) to these metrics'''
+    for name, (calls, total, slowest, label) in other["timings"].items():
+        stats = timings.get(name)
+        if stats is None:
+            timings[name] = [calls, total, slowest, label]
+            continue
+        stats[0] += calls
+        stats[1] += total
+        if slowest > stats[2]:
+            stats[2] = slowest
+            stats[3] = label
+    for name, amount in other["counters"].items():
+        counters[name] = counters.get(name, 0) + amount
+    for name, timed in other.get("kept_calls", {}).items():
+        kept_calls.setdefault(name, []).extend(timed)
+
+def summary():
+    ''' The metrics as a dictionary suitable for saving as JSON'''
+    return {
+        "timings": dict((name, {"calls": calls, "total_seconds": total, "mean_seconds": total / calls,
+                                "max_seconds": slowest, "slowest": None if label is None else str(label)})
+                        for name, (calls, total, slowest, label) in sorted(timings.items())),
+        "counters": dict(sorted(counters.items())),
+    }
+
+def export_json(filepath, **run_info):
+    ''' Saves the metrics, along with any details of the run (e.g. the truth table used), as JSON'''
+    data = dict(run_info, time=time.strftime("%Y-%m-%dT%H:%M:%S"), **summary())
+    with open(filepath, 'w') as json_file:
+        json.dump(data, json_file, indent=2)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def export_prometheus(filepath, prefix="plan_checker"):
+    ''' Saves the metrics in the Prometheus text format
+
+    The file is written under a temporary name and then renamed, so that the textfile collector never reads
+    a half written file.
+    '''
+    lines = [
+        f"# HELP {prefix}_stage_seconds Time spent in each stage of processing.",
+        f"# TYPE {prefix}_stage_seconds summary",
+    ]
+    for name, (calls, total, slowest, label) in sorted(timings.items()):
+        lines.append(f'{prefix}_stage_seconds_sum{{stage="{_escape(name)}"}} {total!r}')
+        lines.append(f'{prefix}_stage_seconds_count{{stage="{_escape(name)}"}} {calls}')
+    lines.append(f"# HELP {prefix}_stage_max_seconds The slowest call of each stage of processing.")
+    lines.append(f"# TYPE {prefix}_stage_max_seconds gauge")
+    for name, (calls, total, slowest, label) in sorted(timings.items()):
+        lines.append(f'{prefix}_stage_max_seconds{{stage="{_escape(name)}"}} {slowest!r}')
+    for name, amount in sorted(counters.items()):
+        lines.append(f"# TYPE {prefix}_{name}_total counter")
+        lines.append(f"{prefix}_{name}_total {amount}")
+    lines.append(f"# TYPE {prefix}_last_run_timestamp_seconds gauge")
+    lines.append(f"{prefix}_last_run_timestamp_seconds {time.time():.3f}")
+
+    temporary = filepath + ".tmp"
+    with open(temporary, 'w') as prom_file:
+        prom_file.write("\n".join(lines) + "\n")
+    os.replace(temporary, filepath)
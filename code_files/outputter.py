@@ -1,6 +1,9 @@
 '''Collection of functions to output the extracted parameters into the format specified by the user'''
 
-import pandas as pd
+import csv
+import json
+import os
+from abc import ABC, abstractmethod
 from code_files import strings
 
 def output(parameters, evaluations, solutions, filepath):
@@ -11,8 +14,133 @@ def output(parameters, evaluations, solutions, filepath):
         Value = [item] + [column[item] for column in (parameters, evaluations, solutions)]
         allValues.append(Value)
 
-    test_pd = pd.DataFrame(columns=headers, data=allValues)
+    filepath = output_path(filepath)
+    with open(filepath, 'w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.writer(csv_file, lineterminator=os.linesep)
+        writer.writerow(headers)
+        writer.writerows(allValues)
+    return filepath
 
-    filepath = filepath + ".csv" if not filepath.endswith(".csv") else filepath
-    test_pd.to_csv(filepath, encoding='utf-8', index=False)
-    return filepath
\ No newline at end of file
+def output_path(filepath):
+    ''' The path of the report that output() writes for the given filepath'''
+    return filepath + ".csv" if not filepath.endswith(".csv") else filepath
+
+class BatchReport(ABC):
+    ''' A single report for a whole run, with one row per plan and parameter
+
+    Rows are written as each plan's results arrive rather than being collected in memory, and the file is
+    written through a large buffer so that each plan doesn't cost a separate write.
+    The format is chosen from the extension of filepath: .csv, .jsonl or .parquet
+    When plans are evaluated against several truth tables, the report has a "Truth Table" column naming the table
+    of each row (truth_tables=True).
+    '''
+    headers = ["Plan", "Case", "Parameter Name", "Parameter Value", "Parameter Evaluation", "Parameter Solution"]
+    buffer_size = 1024 * 1024
+
+    def __init__(self, filepath, truth_tables=False):
+        self.filepath = filepath
+        self.truth_tables = truth_tables
+        if truth_tables:
+            self.headers = ["Plan", "Truth Table"] + self.headers[1:]
+
+    def rows(self, location, case, parameters, evaluations, solutions, truth_table=None):
+        first = [str(location), truth_table] if self.truth_tables else [str(location)]
+        for item in strings.parameters:
+            yield first + [case, item] + [column[item] for column in (parameters, evaluations, solutions)]
+
+    @abstractmethod
+    def write(self, location, case, parameters, evaluations, solutions, truth_table=None):
+        ''' Adds the rows of a plan to the report'''
+
+    @abstractmethod
+    def flush(self):
+        ''' Writes out the buffered rows, e.g. so a report being watched by another program is up to date'''
+
+    @abstractmethod
+    def close(self):
+        ''' Writes out the rest of the report and closes its file'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class CsvReport(BatchReport):
+    def __init__(self, filepath, truth_tables=False):
+        super().__init__(filepath, truth_tables)
+        self.file = open(filepath, 'w', newline='', encoding='utf-8', buffering=self.buffer_size)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.headers)
+
+    def write(self, location, case, parameters, evaluations, solutions, truth_table=None):
+        self.writer.writerows(self.rows(location, case, parameters, evaluations, solutions, truth_table))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class JsonLinesReport(BatchReport):
+    def __init__(self, filepath, truth_tables=False):
+        super().__init__(filepath, truth_tables)
+        self.file = open(filepath, 'w', encoding='utf-8', buffering=self.buffer_size)
+
+    def write(self, location, case, parameters, evaluations, solutions, truth_table=None):
+        for row in self.rows(location, case, parameters, evaluations, solutions, truth_table):
+            self.file.write(json.dumps(dict(zip(self.headers, row))) + "\n")
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class ParquetReport(BatchReport):
+    ''' Parquet reports need the optional pyarrow package. Rows are buffered and written as row groups.'''
+    row_group_size = 64 * 1024
+
+    def __init__(self, filepath, truth_tables=False):
+        super().__init__(filepath, truth_tables)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Writing a .parquet report requires the pyarrow package (pip install pyarrow)")
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([(header, pyarrow.int64() if header == "Case" else pyarrow.string())
+                                      for header in self.headers])
+        self.writer = pyarrow.parquet.ParquetWriter(filepath, self.schema)
+        self.buffered = []
+
+    def write(self, location, case, parameters, evaluations, solutions, truth_table=None):
+        for row in self.rows(location, case, parameters, evaluations, solutions, truth_table):
+            self.buffered.append([value if header == "Case" else str(value) for header, value in zip(self.headers, row)])
+        if len(self.buffered) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffered:
+            columns = list(zip(*self.buffered))
+            self.writer.write_table(self.pyarrow.Table.from_arrays(
+                [self.pyarrow.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+                schema=self.schema))
+            self.buffered = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+report_formats = {
+    ".csv"      : CsvReport,
+    ".jsonl"    : JsonLinesReport,
+    ".parquet"  : ParquetReport,
+}
+
+def open_report(filepath, truth_tables=False):
+    ''' Opens a BatchReport for writing, in the format given by the extension of filepath'''
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension not in report_formats:
+        raise ValueError(f"Unknown report format <{extension}>: the report must end with one of {', '.join(report_formats)}")
+    return report_formats[extension](filepath, truth_tables)
@@ -0,0 +1,156 @@
+''' Module for working out the field shaped by the jaws and multi leaf collimator (MLC) of a beam
+
+A beam's control points give the positions of its beam limiting devices: the X and Y jaws (X/ASYMX, Y/ASYMY) and
+the leaves of the MLC (MLCX or MLCY), as LeafJawPositions. A device is only listed at a control point if it moved,
+so positions are carried forward from the last control point that gave them.
+
+beam_aperture() puts the positions of every control point into arrays, (control points, 2) for each pair of jaws and
+(control points, 2 * leaf pairs) for the MLC, and works out the aperture at every control point at once:
+
+- each leaf pair opens the gap between its two leaves, cut down to the jaws along the direction the leaves move
+- and covers the strip between its two LeafPositionBoundaries, cut down to the other pair of jaws
+- leaf pairs whose gap is at most min_leaf_gap are closed (closed leaves are never quite touching)
+
+The field's extents are those of the open leaf pairs (or of the jaws, without an MLC), and its equivalent square is
+4 * area / perimeter (Sterling's formula), where the perimeter is that of the union of the open strips.
+Positions are in mm at the isocentre plane, as in the DICOM.
+'''
+
+import numpy as np
+
+# Leaf pairs with gaps of this size (mm) or less are taken to be closed
+min_leaf_gap = 1.0
+
+_jaws = {"X": "X", "ASYMX": "X", "Y": "Y", "ASYMY": "Y"}
+_mlcs = ("MLCX", "MLCY")
+
+class Aperture:
+    ''' The field of a beam at each of its control points, as arrays with one value per control point
+
+    x1, x2, y1, y2  - the field's extents (mm). Where the field is closed they are nan.
+    area            - the open area (mm^2)
+    perimeter       - the length of the field's outline (mm)
+    '''
+    __slots__ = ("x1", "x2", "y1", "y2", "area", "perimeter")
+
+    def __init__(self, x1, x2, y1, y2, area, perimeter):
+        closed = area <= 0
+        self.x1, self.x2, self.y1, self.y2 = [np.where(closed, np.nan, edge) for edge in (x1, x2, y1, y2)]
+        self.area = area
+        self.perimeter = perimeter
+
+    @property
+    def equivalent_square(self):
+        ''' The side (mm) of the square field with the same area to perimeter ratio, at each control point'''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.perimeter > 0, 4 * self.area / self.perimeter, np.nan)
+
+    def extents(self):
+        ''' The extents (x1, x2, y1, y2) of the field over all control points: everywhere the beam is ever open
+            Returns None if the beam is never open
+        '''
+        if not np.isfinite(self.x1).any():
+            return None
+        return (float(np.nanmin(self.x1)), float(np.nanmax(self.x2)), float(np.nanmin(self.y1)), float(np.nanmax(self.y2)))
+
+def _carried_forward(rows, width):
+    ''' Stacks the positions of a device at each control point (None where it isn't given) into an array,
+        filling the gaps with the last positions given. Returns None if the device is never given.
+    '''
+    given = [index for index, row in enumerate(rows) if row is not None and len(row) == width]
+    if not given:
+        return None
+    positions = np.full((len(rows), width), np.nan)
+    positions[given] = np.array([rows[index] for index in given], dtype=float)
+    last = np.zeros(len(rows), dtype=int)
+    last[given] = given
+    # Control points before the first one giving positions take those positions
+    last[:given[0]] = given[0]
+    return positions[np.maximum.accumulate(last)]
+
+def beam_aperture(control_points, leaf_boundaries):
+    ''' Works out the aperture of a beam at every control point
+
+    control_points  - for each control point, {RTBeamLimitingDeviceType: LeafJawPositions} of the devices it gives
+    leaf_boundaries - {RTBeamLimitingDeviceType: LeafPositionBoundaries} of the beam's MLCs
+    Returns an Aperture, or None if the field isn't bounded along both axes by the devices given
+    '''
+    count = len(control_points)
+    if not count:
+        return None
+    jaws = {}
+    for axis in ("X", "Y"):
+        rows = [next((positions for device, positions in devices.items() if _jaws.get(device) == axis), None)
+                for devices in control_points]
+        jaws[axis] = _carried_forward(rows, 2)
+
+    for mlc in _mlcs:
+        boundaries = leaf_boundaries.get(mlc)
+        if boundaries is None or len(boundaries) < 2:
+            continue
+        boundaries = np.asarray(boundaries, dtype=float)
+        leaves = _carried_forward([devices.get(mlc) for devices in control_points], 2 * (len(boundaries) - 1))
+        if leaves is None:
+            continue
+        # The leaves of an MLCX move along x, and its leaf pairs are stacked along y (and the other way round for MLCY)
+        moving, stacked = ("X", "Y") if mlc == "MLCX" else ("Y", "X")
+        low, high, lower, upper, area, perimeter = _mlc_aperture(leaves, boundaries, jaws[moving], jaws[stacked])
+        if moving == "X":
+            return Aperture(low, high, lower, upper, area, perimeter)
+        return Aperture(lower, upper, low, high, area, perimeter)
+
+    # Without an MLC the field is the rectangle between the jaws
+    if jaws["X"] is None or jaws["Y"] is None:
+        return None
+    width = np.clip(jaws["X"][:, 1] - jaws["X"][:, 0], 0, None)
+    height = np.clip(jaws["Y"][:, 1] - jaws["Y"][:, 0], 0, None)
+    return Aperture(jaws["X"][:, 0], jaws["X"][:, 1], jaws["Y"][:, 0], jaws["Y"][:, 1], width * height,
+                    np.where(width * height > 0, 2 * (width + height), 0.0))
+
+def _mlc_aperture(leaves, boundaries, moving_jaws, stacked_jaws):
+    ''' The aperture of an MLC, cut down to the jaws, at every control point
+        Returns the extents (low, high) along the direction the leaves move, the extents (lower, upper) along the
+        direction the leaf pairs are stacked, the area and the perimeter, each an array over the control points
+    '''
+    pairs = len(boundaries) - 1
+    count = len(leaves)
+    # Missing jaws don't limit the field
+    if moving_jaws is None:
+        moving_jaws = np.tile([-np.inf, np.inf], (count, 1))
+    if stacked_jaws is None:
+        stacked_jaws = np.tile([-np.inf, np.inf], (count, 1))
+
+    # (control points, leaf pairs) arrays of each leaf pair's opening, within the jaws
+    low = np.maximum(leaves[:, :pairs], moving_jaws[:, :1])
+    high = np.minimum(leaves[:, pairs:], moving_jaws[:, 1:])
+    lower = np.maximum(boundaries[:-1], stacked_jaws[:, :1])
+    upper = np.minimum(boundaries[1:], stacked_jaws[:, 1:])
+    width = high - low
+    height = upper - lower
+    is_open = (width > min_leaf_gap) & (height > 0)
+    width = np.where(is_open, width, 0.0)
+    height = np.where(is_open, height, 0.0)
+    area = (width * height).sum(axis=1)
+
+    # The outline runs up both sides of each open strip, and across the parts of neighbouring strips that don't
+    # overlap (including the ends of the first and last open strips, next to closed ones)
+    overlap = np.where(is_open[:, :-1] & is_open[:, 1:],
+                       np.clip(np.minimum(high[:, :-1], high[:, 1:]) - np.maximum(low[:, :-1], low[:, 1:]), 0, None), 0.0)
+    across = 2 * width.sum(axis=1) - 2 * overlap.sum(axis=1)
+    perimeter = 2 * height.sum(axis=1) + across
+
+    return (np.where(is_open, low, np.inf).min(axis=1), np.where(is_open, high, -np.inf).max(axis=1),
+            np.where(is_open, lower, np.inf).min(axis=1), np.where(is_open, upper, -np.inf).max(axis=1),
+            area, perimeter)
+
+def field_size(aperture):
+    ''' The field size of a beam as written in the truth table, "YxX" in cm (e.g. "10x12" or "1.5x1.5"), from the
+        extents of its aperture over all control points. Each side is rounded to the nearest mm, so a 100.5 mm
+        opening is 10.1 (before the MLC was taken into account, jaw openings were truncated to whole cm, giving 10).
+        Returns None if the beam is never open.
+    '''
+    extents = aperture.extents() if aperture is not None else None
+    if extents is None:
+        return None
+    x1, x2, y1, y2 = extents
+    return "{:g}x{:g}".format(round((y2 - y1) / 10, 1), round((x2 - x1) / 10, 1))
@@ -6,45 +6,50 @@ param_value - the value extracted (and formatted) by the corresponding extractio
 table_value - the value from the truth table (corresponding to case and parameter)
 
 **kwargs {
+    "rule"              - table_value parsed when the truth table was loaded (see truth_table_rules.py)
+    "rules"             - the parsed truth table values of every parameter for this case
     "parameter_values"  - the complete dictionary of extracted values
     "truth_table"       - the complete truth table dictionary
     "case"              - the case number of this plan that's being evaluated
     "file_type"         - Whether it's IMRT, VMAT or not VMAT
+    "diagnostics"       - None, or a dictionary in which evaluators may record details of how they reached their result
 }
+
+Evaluation functions should use the pre-parsed rule rather than splitting and checking table_value themselves.
 '''
 
 from code_files import strings
+from .vmat_matching import match_gantry_ssd
 
 def _evaluate_gantry(param_value, table_value, **kwargs):
     # This line checks whether the parameter value found is the same as the truth table value (this is why the formating of the two dictionaries is important) and gives a "PASS" value
     # Also there are other instances where a PASS is given such as if the Truth Table is a dash for a given parameter in that case any value will satisfy
     # Or if the file is a VMAT and the parameter is either a gantry or an SSD
     file_type = kwargs["file_type"]
+    rule = kwargs["rule"]
 
-    for value in table_value.split(","):
-        if not value.isdigit() and value!=strings.ANY_VALUE:
-            return strings.TRUTH_TABLE_ERROR
+    if rule.error:
+        return strings.TRUTH_TABLE_ERROR
 
     if file_type == strings.VMAT:
         return strings.PASS
     else:
-        return strings.PASS if (param_value == table_value or table_value == strings.ANY_VALUE) else strings.FAIL
+        return strings.PASS if (param_value == rule.text or rule.any) else strings.FAIL
 
 def _evaluate_ssd(param_value, table_value, **kwargs):
-    if table_value == strings.ANY_VALUE:
+    rule = kwargs["rule"]
+    if rule.any:
         return strings.PASS
 
-    for value in table_value.split(","):
-        if not value.isdigit() and value!=strings.ANY_VALUE and value!="?":
-            return strings.TRUTH_TABLE_ERROR
+    if rule.error:
+        return strings.TRUTH_TABLE_ERROR
 
     if kwargs["file_type"] == strings.VMAT:
-        truth_table = kwargs["truth_table"]
+        gantry_rule = kwargs["rules"][strings.gantry]
         parameter_values = kwargs["parameter_values"]
-        case = kwargs["case"]
 
-        if truth_table[strings.gantry][case-1] == strings.ANY_VALUE or parameter_values[strings.gantry] == "error retrieving gantry":
-            if truth_table[strings.gantry][case-1] != strings.ANY_VALUE:
+        if gantry_rule.any or parameter_values[strings.gantry] == "error retrieving gantry":
+            if not gantry_rule.any:
                 return strings.PASS
             else:
                 return strings.FAIL
@@ -52,70 +57,59 @@ def _evaluate_ssd(param_value, table_value, **kwargs):
         if len(parameter_values[strings.gantry])!=len(parameter_values[strings.SSD]):
             return strings.FAIL
 
-        truth_table_gantry_list = truth_table[strings.gantry][case-1].split(',')
-        truth_table_ssd_list = truth_table[strings.SSD][case-1].split(',')
-        if len(truth_table_gantry_list) != len(truth_table_ssd_list):
+        if len(gantry_rule.values) != len(rule.values):
             return strings.FAIL
 
-        for i in range(len(truth_table_gantry_list)):
-            gantry_value = float(truth_table_gantry_list[i])
-            ssd_value = truth_table_ssd_list[i]
-            if ssd_value == '?':
-                continue
-
-            ssd_value=float(ssd_value)
-            j = 0
-            while j < len(parameter_values[strings.gantry]):
-                if abs(parameter_values[strings.gantry][j] - gantry_value) < 0.3:
-                    if abs(parameter_values[strings.SSD][j] - ssd_value) > 1:
-                        return strings.FAIL
-                j+=1
-        return strings.PASS
+        # '?' SSDs are parsed as None and accept any value
+        result, matches = match_gantry_ssd(parameter_values[strings.gantry], parameter_values[strings.SSD],
+                                           gantry_rule.values, rule.values)
+        if kwargs.get("diagnostics") is not None:
+            kwargs["diagnostics"][strings.SSD] = matches
+        return result
     else:
-        truth_table_ssd_list = table_value.split(',')
-        if len(truth_table_ssd_list) != len(param_value):
+        if len(rule.values) != len(param_value):
             return strings.FAIL
 
-        i=0
-        while i < len(truth_table_ssd_list):
-            if truth_table_ssd_list[i] != '?':
-                if abs(int(truth_table_ssd_list[i])-float(param_value[i])) > 1:
+        for ssd_value, param_ssd in zip(rule.values, param_value):
+            if ssd_value is not None:
+                if abs(ssd_value-float(param_ssd)) > 1:
                     return strings.FAIL
-            i+=1
         return strings.PASS
 
 def _evaluate_wedge(param_value, table_value, **kwargs):
-    for value in table_value.split(","):
-        if not value.isdigit() and value!=strings.ANY_VALUE and value!=strings.no_wedge:
-            return strings.TRUTH_TABLE_ERROR
+    rule = kwargs["rule"]
+    if rule.error:
+        return strings.TRUTH_TABLE_ERROR
 
-    if table_value == strings.no_wedge:
+    if rule.text == strings.no_wedge:
         all_no_wedge = all(map(lambda w_angle: w_angle == strings.no_wedge, param_value.split(',')))
         return strings.PASS if all_no_wedge else strings.FAIL
     else:
-        return strings.PASS if table_value == param_value else strings.FAIL
+        return strings.PASS if rule.text == param_value else strings.FAIL
 
 def _evaluate_prescription_dose(param_value, table_value, **kwargs):
     ''' param_value and table_value are in the format DOSE/FRACTION/UNIT'''
+    rule = kwargs["rule"]
+    if rule.error:
+        return strings.TRUTH_TABLE_ERROR
 
     prescription_items = param_value.split("/")
-    table_items = table_value.split("/")
-    for i in range(3):
-        if table_items[i] != strings.ANY_VALUE and prescription_items[i] != table_items[i]:
+    for i, table_item in enumerate(rule.items):
+        # Items which accept any value are parsed as None
+        if table_item is not None and prescription_items[i] != table_item:
             return strings.FAIL
     return strings.PASS
 
 def _evaluate_collimator(param_value, table_value, **kwargs):
-    for value in table_value.split(","):
-        if not value.isdigit() and value!=strings.ANY_VALUE:
-            if not value[0] == "*" or len(value)<2 or not value[1:].isdigit():
-                return strings.TRUTH_TABLE_ERROR
+    rule = kwargs["rule"]
+    if rule.error:
+        return strings.TRUTH_TABLE_ERROR
 
-    if table_value == strings.ANY_VALUE:
+    if rule.any:
         return strings.PASS
 
-    result = table_value == param_value if table_value[0] != '*' else    \
-             table_value[1:] != param_value
+    result = rule.angle == param_value if not rule.negated else    \
+             rule.angle != param_value
     return strings.PASS if result else strings.FAIL
 
 def _evaluate_energy(param_value, table_value, **kwargs):
@@ -123,30 +117,33 @@ def _evaluate_energy(param_value, table_value, **kwargs):
     return strings.NOT_APPLICABLE
 
 def _evaluate_field_size(param_value, table_value, **kwargs):
-    if table_value == strings.ANY_VALUE:
+    rule = kwargs["rule"]
+    if rule.any:
         return strings.PASS
-    truth_table_ssd_list = table_value.split(',')
     param_value=param_value.split(',')
 
-    if len(truth_table_ssd_list) == 1:
+    if len(rule.values) == 1:
         for i in range(len(param_value)):
             if param_value[i] == strings.Not_Extracted:
-                return "Not Implemented For MLCX/MLCY"
-            if truth_table_ssd_list[0] != param_value[i]:
+                return strings.Not_Extracted
+            if rule.values[0] != param_value[i]:
                 return strings.FAIL
         return strings.PASS
     else:
-        i = 0
-        for i in range(len(truth_table_ssd_list)):
-            if truth_table_ssd_list[i] != '?':
+        for i, table_size in enumerate(rule.values):
+            # '?' field sizes are parsed as None and accept any value
+            if table_size is not None:
+                if i >= len(param_value):
+                    return strings.FAIL
                 if param_value[i]==strings.Not_Extracted:
-                    return "Not Implemented For MLCX/MLCY"
-                if truth_table_ssd_list[i]!= param_value[i]:
+                    return strings.Not_Extracted
+                if table_size != param_value[i]:
                     return strings.FAIL
         return strings.PASS
 
 def _evaluate_default(param_value, table_value, **kwargs):
-    if param_value == table_value or table_value == strings.ANY_VALUE:
+    rule = kwargs["rule"]
+    if param_value == rule.text or rule.any:
         return strings.PASS
     return strings.FAIL
 
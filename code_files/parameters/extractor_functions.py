@@ -3,23 +3,34 @@
 Each function in supplied with the same arguments:
 
 dataset             - The full data from the RTPLAN being extracted
-dose                - The RTDOSE associated with the RTPLAN. May be None if no associated dose found!
-struct              - The RTSTRUCT dicom associated with the RTPLAN. May be None. 
+dose                - A DoseGrid of the RTDOSE associated with the RTPLAN (see code_files/dose_grid.py), for looking
+                        up the dose at points without reading the whole grid. Its elements are in dose.dataset.
+                        May be None if no associated dose found!
+struct              - A StructureSet of the RTSTRUCT associated with the RTPLAN (see code_files/structure_set.py), for
+                        finding which ROIs contain a point. May be None.
 case                - The case number of the RTPLAN being extracted
+summary             - A PlanSummary of the RTPLAN's beams (see plan_summary.py). Extractors should read beam
+                        and control point values from here rather than walking dataset.BeamSequence themselves.
+
+Each function also declares, in extractor_tags, the top level elements of the RTPLAN that it reads.
+Only those elements are loaded from the file (see code_files/dicom_loader.py), so a new extractor must list
+the elements it uses there.
 '''
 
 from code_files import strings
 
-def _extract_mode(dataset, dose, struct, case):
-    # For now, we are only producing IMRT vs VMAT modes for cases 6, 7, and 8
-    if case not in [6, 7, 8]:
+# For now, we are only producing IMRT vs VMAT modes for cases 6, 7, and 8. These are the only cases whose
+# extracted values differ from those of other cases (see also code_files/case_classifier.py).
+mode_cases = [6, 7, 8]
+
+def _extract_mode(dataset, dose, struct, case, summary):
+    if case not in mode_cases:
         return strings.NOT_IMPLEMENTED
 
-    moving_gantry = int(dataset.BeamSequence[0].ControlPointSequence[0].GantryAngle) != \
-                            int(dataset.BeamSequence[0].ControlPointSequence[1].GantryAngle)
+    moving_gantry = int(summary.first_beam_gantry[0]) != int(summary.first_beam_gantry[1])
 
     # One beam will be the setup beam, which is not counted
-    number_of_beams = len(dataset.BeamSequence) - 1
+    number_of_beams = summary.number_of_beams - 1
 
     # "If IMRT there should be 5 static gantry positions (5 beams) for each case, and the intensity of the 
     # beam is modulated by moving the multi leaf collimator (MLC) to different control points within each 
@@ -33,7 +44,7 @@ def _extract_mode(dataset, dose, struct, case):
         mode = "UNKNOWN"
     return mode
 
-def _extract_prescription_dose(dataset, dose, struct, case):
+def _extract_prescription_dose(dataset, dose, struct, case, summary):
     total_prescription_dose = str(int(dataset.DoseReferenceSequence[0].TargetPrescriptionDose))
     number_of_fractions = str(dataset.FractionGroupSequence[0].NumberOfFractionsPlanned)
 
@@ -42,131 +53,87 @@ def _extract_prescription_dose(dataset, dose, struct, case):
     # To begin you assign the total_perscription dose to the parameter value
     # Then when perscription dose is 24,48,50, or 900 you also need to check the amount of fractions
     # and when its 900 the primary dosimeter unit needs to be 'MU' as well
-    try:
-        prim_dosimeter_unit = dataset.BeamSequence[0].PrimaryDosimeterUnit
-    except:
+    prim_dosimeter_unit = summary.primary_dosimeter_unit
+    if prim_dosimeter_unit is None:
         prim_dosimeter_unit = "No primary dosimeter unit"
 
     return total_prescription_dose + "/" + number_of_fractions + "/" + prim_dosimeter_unit
 
-def _extract_collimator(dataset, dose, struct, case):
-    beams = list(filter(lambda beam: beam.BeamDescription != strings.SETUP_beam, dataset.BeamSequence))
-
+def _extract_collimator(dataset, dose, struct, case, summary):
     # Record collimator value in the parameter_values dictionary as a string to be consistant with truth_table format 
     # According to the truth table the collimator only needs to be recorded for cases 1&5 where only 1 beam occurs    
-    collimator_value = beams[len(beams)-1].ControlPointSequence[0].BeamLimitingDeviceAngle
+    collimator_value = summary.beams[-1].collimator
     return str(int(collimator_value))
 
-def _extract_gantry(dataset, dose, struct, case):
+def _extract_gantry(dataset, dose, struct, case, summary):
     try:
-        file_type = _extract_mode(dataset, dose, struct, case)
-        #If the dataset is a VMAT file it goes through each of the control point sequence and finds each associated gantry angle and returns the lowest value slash the highest value
+        file_type = _extract_mode(dataset, dose, struct, case, summary)
+        #If the dataset is a VMAT file it returns the gantry angle of each control point of the first (non setup) beam
         if file_type == strings.VMAT:
-            i = 0
-            vmat_gantry_angles = []
-            while i < len(dataset.BeamSequence):
-                if dataset.BeamSequence[i].BeamDescription != strings.SETUP_beam:
-                    for control_point in dataset.BeamSequence[i].ControlPointSequence:
-                        vmat_gantry_angles.append(float(control_point.GantryAngle))
-                    return vmat_gantry_angles
-                i+=1
-            return "error retrieving gantry"
+            if not summary.beams:
+                return "error retrieving gantry"
+            vmat_gantry_angles = summary.beams[0].control_point_gantry
+            if vmat_gantry_angles is None:
+                return strings.ANY_VALUE
+            return list(vmat_gantry_angles)
         # If not, then return the Gantry Angle of all beams, separated by commas
         else:
-            #ignore setup beams
-            beams = list(filter(lambda beam: beam.BeamDescription != strings.SETUP_beam, dataset.BeamSequence))
             #obtain the gantry angles of all beams
-            gantry_instances = map(lambda beam: str(int(beam.ControlPointSequence[0].GantryAngle)), beams)
+            gantry_instances = map(lambda beam: str(int(beam.gantry)), summary.beams)
 
             return ','.join(gantry_instances)
     except:
         return strings.ANY_VALUE
 
-def _extract_ssd(dataset, dose, struct, case):
+def _extract_ssd(dataset, dose, struct, case, summary):
     #find SSD in centimeters
-    file_type = _extract_mode(dataset, dose, struct, case)
+    file_type = _extract_mode(dataset, dose, struct, case, summary)
 
     ssd_list = []
     try:
         if file_type == strings.VMAT:
-            vmat_ssd_list = []
-            for i in range(len(dataset.BeamSequence)):
-                if dataset.BeamSequence[i].BeamDescription != strings.SETUP_beam:
-                    for control_point in dataset.BeamSequence[i].ControlPointSequence:
-                        vmat_ssd_list.append(round(float(control_point.ReferencedDoseReferenceSequence[1].BeamDosePointSSD)/10,2))
-                    return vmat_ssd_list
-            return "error retrieving SSD"
+            if not summary.beams or summary.beams[0].control_point_ssd is None:
+                return "error retrieving SSD"
+            return list(summary.beams[0].control_point_ssd)
         else:
-            beams = list(filter(lambda beam: beam.BeamDescription != strings.SETUP_beam, dataset.BeamSequence))
             #obtain the ssd of all beams
             #in the DICOM file the SSD is given in millimetres so its divided by 10 so its in centimetres
-            ssd_list = list(map(lambda beam: round(beam.ControlPointSequence[0].SourceToSurfaceDistance / 10, 2), beams))
+            ssd_list = list(map(lambda beam: round(beam.ssd / 10, 2), summary.beams))
             return ssd_list
     except:
         return "error retrieving SSD"
 
-def _extract_wedge(dataset, dose, struct, case):
+def _extract_wedge(dataset, dose, struct, case, summary):
     # It may need more work to deal with VMAT files for cases 6,7,8
 
-    #ignore setup beams
-    beams = list(filter(lambda beam: beam.BeamDescription != strings.SETUP_beam, dataset.BeamSequence))
     # if there are wedges, get the wedge angle of the beam. Otherwise, get 0
-    wedge_angles = list(map(lambda beam: str(int(beam.WedgeSequence[0].WedgeAngle)) if int(beam.NumberOfWedges) > 0 else strings.no_wedge, beams))
+    wedge_angles = list(map(lambda beam: str(int(beam.wedge_angle)) if beam.number_of_wedges > 0 else strings.no_wedge, summary.beams))
 
     return ','.join(wedge_angles)
 
-def _extract_energy(dataset, dose, struct, case):
+def _extract_energy(dataset, dose, struct, case, summary):
     energy = ''
 
-    for beam in dataset.BeamSequence:
-        if beam.BeamDescription == strings.SETUP_beam:
-            continue
-
-        energy = str(int(beam.ControlPointSequence[0].NominalBeamEnergy))
-        if beam.PrimaryFluenceModeSequence[0].FluenceMode != strings.STANDARD_FLUENCE:
-            energy += str(beam.PrimaryFluenceModeSequence[0].FluenceModeID)
+    for beam in summary.beams:
+        energy = str(int(beam.energy))
+        if beam.fluence_mode not in (None, strings.STANDARD_FLUENCE):
+            energy += str(beam.fluence_mode_id)
     return energy
 
-def _extract_field_size(dataset, dose, struct, case):
-    beams = list(filter(lambda beam: beam.BeamDescription != strings.SETUP_beam, dataset.BeamSequence))
-    # record collimator value in the parameter_values dictionary as a string to be consistant with truth_table format
-    # According to the truth table the collimator only needs to be recorded for cases 1&5 where only 1 beam occurs
-
+def _extract_field_size(dataset, dose, struct, case, summary):
+    # The field of each beam is shaped by its jaws and MLC over all of its control points (see aperture.py).
+    # aperture.py needs numpy, so it isn't imported until a field size is extracted
+    from code_files.parameters.aperture import field_size
     field_size_list=[]
 
-    for beam in beams:
-        beam_type_number = len(beam.ControlPointSequence[0].BeamLimitingDevicePositionSequence)
-
-        length_x = 0
-        length_y = 0
-
-        for i in range(beam_type_number):
-            device_type = beam.ControlPointSequence[0].BeamLimitingDevicePositionSequence[
-                i].RTBeamLimitingDeviceType
-            jaw_position = beam.ControlPointSequence[0].BeamLimitingDevicePositionSequence[
-                i].LeafJawPositions
-
-            if device_type != "MLCX" and device_type != "MLCY":
-
-                if device_type == "X":
-                    length_x = int((-jaw_position[0] + jaw_position[1]) / 10)
-                elif device_type == "Y":
-                    length_y = int((-jaw_position[0] + jaw_position[1]) / 10)
-                elif device_type == "ASYMX":
-                    length_x = int((-jaw_position[0] + jaw_position[1]) / 10)
-                elif device_type == "ASYMY":
-                    length_y = int((-jaw_position[0] + jaw_position[1]) / 10)
-                if length_x != 0 and length_y != 0:
-
-                    field_size_list.append(str(length_y) + "x" + str(length_x))
-            else:
-                if length_x==0 or length_y==0:
-                    field_size_list.append(strings.Not_Extracted)
+    for beam in summary.beams:
+        size = field_size(beam.aperture)
+        field_size_list.append(size if size is not None else strings.Not_Extracted)
 
     return ','.join(field_size_list)
 
 #just a placeholder function to indicate which parameter extractions have not been implemented
-def to_be_implemented(dataset, dose, struct, case):
+def to_be_implemented(dataset, dose, struct, case, summary):
     return strings.NOT_IMPLEMENTED
 
 extractor_functions = {
@@ -184,3 +151,20 @@ extractor_functions = {
     strings.meas                    : to_be_implemented,
     strings.energy                  : _extract_energy,
 }
+
+# The top level elements of the RTPLAN that each extraction function reads
+extractor_tags = {
+    strings.mode                    : ["BeamSequence"],
+    strings.prescription_dose       : ["DoseReferenceSequence", "FractionGroupSequence", "BeamSequence"],
+    strings.prescription_point      : [],
+    strings.isocenter_point         : [],
+    strings.override                : [],
+    strings.collimator              : ["BeamSequence"],
+    strings.gantry                  : ["BeamSequence"],
+    strings.SSD                     : ["BeamSequence"],
+    strings.couch                   : [],
+    strings.field_size              : ["BeamSequence"],
+    strings.wedge                   : ["BeamSequence"],
+    strings.meas                    : [],
+    strings.energy                  : ["BeamSequence"],
+}
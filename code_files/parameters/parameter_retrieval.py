@@ -1,10 +1,14 @@
 '''This file applies the extraction and evaluation functions defined in extractor_functions.py and evaluator functions.py'''
 
-# We import the pydicom library to use it's DICOM reading methods
-import pydicom as dicom
-from code_files import strings
-from .extractor_functions import extractor_functions, _extract_mode
+from code_files import strings, metrics
+from .extractor_functions import extractor_functions, mode_cases
+from .plan_summary import PlanSummary
 from .evaluator_functions import evaluator_functions
+from .truth_table_rules import case_rules
+
+# Names of the timers of each extractor and evaluator (see code_files/metrics.py)
+_extract_timers = dict((parameter, "extract." + parameter) for parameter in strings.parameters)
+_evaluate_timers = dict((parameter, "evaluate." + parameter) for parameter in strings.parameters)
 
 def extract_parameters(dataset, dose_struct_paths, case):
     ''' 
@@ -21,34 +25,76 @@ def extract_parameters(dataset, dose_struct_paths, case):
             exit("In parameter/parameter_retrieval.py, in function extract_parameters()\n \
                 Unexpected number of dose/struct files found associated with one RTPLAN")
 
-        dose = dicom.dcmread(dose_struct_paths[strings.RTDOSE][0], force=True)
-        struct = dicom.dcmread(dose_struct_paths[strings.RTSTRUCT][0], force=True)
+        # Imported only here, as pydicom and numpy are slow to import
+        from code_files.dose_grid import DoseGrid
+        from code_files import structure_set
+        with metrics.timer("read_dose_struct"):
+            # The dose grid's pixel data is only memory-mapped, and read as far as the extractors look up doses
+            dose = DoseGrid(dose_struct_paths[strings.RTDOSE][0])
+            # A structure set shared by several plans is only parsed for the first of them
+            struct = structure_set.load(dose_struct_paths[strings.RTSTRUCT][0])
     else:
         dose = struct = None
 
+    # Walk through the beams and control points once, for all of the extraction functions to share
+    with metrics.timer("plan_summary"):
+        summary = PlanSummary(dataset)
+
     #run the extraction functions for each parameter and store the values in parameter_values dictionary
     parameter_values = {}
     for parameter in strings.parameters:
-        parameter_values[parameter] = extractor_functions[parameter](dataset, dose, struct, case)
+        with metrics.timer(_extract_timers[parameter]):
+            parameter_values[parameter] = extractor_functions[parameter](dataset, dose, struct, case, summary)
 
     return parameter_values
 
-def evaluate_parameters(parameter_values, truth_table, case):
+def evaluate_combinations(dataset, dose_struct_paths, combinations):
+    '''
+    Extracts the parameters of a plan once and evaluates them for several truth tables and cases
+    (the parameters are only extracted again for cases whose extraction differs, see mode_cases)
+
+    dataset             - A pydicom Dataset object
+    dose_struct_paths   - as for extract_parameters()
+    combinations        - a list of (truth_table, case) to evaluate the plan for
+    Returns a list of (parameter_values, pass_fail_values), one for each combination
+    '''
+    extracted = {}
+    results = []
+    for truth_table, case in combinations:
+        group = case in mode_cases
+        if group not in extracted:
+            extracted[group] = extract_parameters(dataset, dose_struct_paths, case)
+        results.append((extracted[group], evaluate_parameters(extracted[group], truth_table, case)))
+    return results
+
+def evaluate_parameters(parameter_values, truth_table, case, diagnostics=None):
+    '''
+    parameter_values    - the dictionary of extracted values, from extract_parameters()
+    truth_table         - a dictionary of correct values for each case (ideally a CompiledTruthTable)
+    case                - the case number to evaluate against
+    diagnostics         - optionally, a dictionary in which evaluators record details of their results
+                            e.g. diagnostics[strings.SSD] lists the control points matched to each VMAT gantry angle
+    '''
     case = int(case)
     # Initialise a dictionary where every key is a parameter and every associated value will either be strings.PASS,strings.FAIL or if that can't be determined the truth table value associated with that case will be added
     pass_fail_values = {}
     
     # Check if the case number is valid
     cases = len(truth_table["case"])
-    if case not in range(1, 18):
+    if case not in range(1, cases + 1):
         raise Exception(f"Invalid case number! Must be between 1 and {cases}")
 
+    # The truth table values for this case, already parsed if the truth table was compiled when it was read
+    rules = case_rules(truth_table, case)
+
     # Grouped information that will be passed onto evaluation functions
     context = {
+        "rules": rules,
         "parameter_values": parameter_values,
         "truth_table": truth_table,
         "case": case,
-        "file_type": parameter_values[strings.mode]
+        "file_type": parameter_values[strings.mode],
+        "diagnostics": diagnostics
     }
 
     # Iterate through each parameter you want to check
@@ -61,7 +107,8 @@ def evaluate_parameters(parameter_values, truth_table, case):
             param_value = parameter_values[param]
             table_value = truth_table[param][case-1]
             # Call the appropriate evaluator function for each parameter
-            pass_fail_values[param] = evaluator_functions[param](param_value, table_value, **context)
+            with metrics.timer(_evaluate_timers.get(param) or "evaluate." + param):
+                pass_fail_values[param] = evaluator_functions[param](param_value, table_value, rule=rules[param], **context)
     return pass_fail_values
  
         
@@ -0,0 +1,150 @@
+''' A compact summary of the beams in an RTPLAN, built in a single pass over the dataset
+
+Most extraction functions need the same few values from each treatment beam, and on VMAT plans a beam can have
+hundreds of control points. Rather than each extractor walking dataset.BeamSequence (and filtering out the setup
+beam) again, extract_parameters builds one PlanSummary and passes it to every extraction function.
+
+Values that are missing from the DICOM are stored as None, and it's up to each extractor to handle them.
+'''
+
+from array import array
+from code_files import strings
+
+def _get(function):
+    ''' Returns function(), or None if the value it reads is missing from the DICOM'''
+    try:
+        return function()
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+# Tags of the values read at every control point. Looking elements up by tag is noticeably faster than by keyword,
+# which matters on VMAT plans with hundreds of control points.
+_GantryAngle = 0x300A011E
+_ReferencedDoseReferenceSequence = 0x300C0050
+_BeamDosePointSSD = 0x300A008A
+_BeamLimitingDevicePositionSequence = 0x300A011A
+_RTBeamLimitingDeviceType = 0x300A00B8
+_LeafJawPositions = 0x300A011C
+
+def _positions(device):
+    ''' The LeafJawPositions of a beam limiting device, as an array
+        Converting the value of the element to numbers through pydicom is slow (each is made a DSfloat), so while
+        the element is still raw, its text is converted directly
+    '''
+    value = device.get_item(_LeafJawPositions).value
+    if isinstance(value, bytes):
+        return array('d', map(float, value.split(b"\\")))
+    return array('d', value if hasattr(value, "__iter__") else [value])
+
+class BeamSummary:
+    ''' The values of one treatment beam used by the extractors
+
+    gantry, collimator, ssd, energy, devices    - from the beam's first control point
+    devices                                     - [(RTBeamLimitingDeviceType, LeafJawPositions), ...]
+    leaf_boundaries                             - {RTBeamLimitingDeviceType: LeafPositionBoundaries} of the MLCs
+    control_point_gantry                        - array of the gantry angle at every control point
+    control_point_ssd                           - array of the dose point SSD (cm) at every control point
+    control_point_devices                       - for every control point, {RTBeamLimitingDeviceType: LeafJawPositions}
+                                                    of the devices it lists
+    aperture                                    - the field shaped by the jaws and MLC at every control point
+                                                    (see aperture.py), or None if it can't be worked out
+
+    The control point arrays are only needed for some plans (e.g. VMAT), so they are built the first time
+    any is used, in one pass over the control points. Plans read by read_compact_plan() (see
+    code_files/compact_plan.py) come with the arrays already built.
+    '''
+    __slots__ = ("gantry", "collimator", "ssd", "energy", "fluence_mode", "fluence_mode_id",
+                 "number_of_wedges", "wedge_angle", "devices", "leaf_boundaries", "_aperture",
+                 "_control_points", "_control_point_arrays")
+
+    def __init__(self, beam):
+        control_points = _get(lambda: beam.ControlPointSequence) or []
+        first = control_points[0] if control_points else None
+
+        self.gantry = _get(lambda: first.GantryAngle)
+        self.collimator = _get(lambda: first.BeamLimitingDeviceAngle)
+        self.ssd = _get(lambda: first.SourceToSurfaceDistance)
+        self.energy = _get(lambda: first.NominalBeamEnergy)
+        self.fluence_mode = _get(lambda: beam.PrimaryFluenceModeSequence[0].FluenceMode)
+        self.fluence_mode_id = _get(lambda: beam.PrimaryFluenceModeSequence[0].FluenceModeID)
+        self.number_of_wedges = _get(lambda: int(beam.NumberOfWedges))
+        self.wedge_angle = _get(lambda: beam.WedgeSequence[0].WedgeAngle)
+        self.devices = _get(lambda: [(device.RTBeamLimitingDeviceType, device.LeafJawPositions)
+                                     for device in first.BeamLimitingDevicePositionSequence])
+        self.leaf_boundaries = dict((device.RTBeamLimitingDeviceType, device.LeafPositionBoundaries)
+                                    for device in _get(lambda: beam.BeamLimitingDeviceSequence) or []
+                                    if device.get("LeafPositionBoundaries"))
+        self._aperture = False
+
+        self._control_points = control_points
+        self._control_point_arrays = getattr(beam, "compact_control_points", None)
+
+    @property
+    def control_point_gantry(self):
+        return self._walk_control_points()[0]
+
+    @property
+    def control_point_ssd(self):
+        return self._walk_control_points()[1]
+
+    @property
+    def control_point_devices(self):
+        return self._walk_control_points()[2]
+
+    @property
+    def aperture(self):
+        if self._aperture is False:
+            from code_files.parameters.aperture import beam_aperture
+            self._aperture = beam_aperture(self.control_point_devices, self.leaf_boundaries)
+        return self._aperture
+
+    def _walk_control_points(self):
+        if self._control_point_arrays is not None:
+            return self._control_point_arrays
+
+        # One pass over the control points. If any control point is missing a value, the whole array is None.
+        gantry, ssd, devices = array('d'), array('d'), []
+        for control_point in self._control_points:
+            try:
+                devices.append(dict((str(device[_RTBeamLimitingDeviceType].value), _positions(device))
+                                    for device in control_point[_BeamLimitingDevicePositionSequence].value))
+            except (KeyError, TypeError, ValueError):
+                devices.append({})
+            if gantry is not None:
+                try:
+                    gantry.append(float(control_point[_GantryAngle].value))
+                except (KeyError, TypeError, ValueError):
+                    gantry = None
+            if ssd is not None:
+                try:
+                    dose_point = control_point[_ReferencedDoseReferenceSequence].value[1]
+                    ssd.append(round(float(dose_point[_BeamDosePointSSD].value)/10,2))
+                except (IndexError, KeyError, TypeError, ValueError):
+                    ssd = None
+        self._control_point_arrays = (gantry, ssd, devices)
+        # The control points are no longer needed once their values are in the arrays
+        self._control_points = None
+        return self._control_point_arrays
+
+class PlanSummary:
+    ''' The values of an RTPLAN's beams used by the extractors
+
+    beams                   - a BeamSummary for every beam that isn't the setup beam, in order
+    number_of_beams         - the number of beams in the plan, including the setup beam
+    first_beam_gantry       - the gantry angles of the first two control points of the first beam (setup or not)
+    primary_dosimeter_unit  - the PrimaryDosimeterUnit of the first beam
+    '''
+    __slots__ = ("beams", "number_of_beams", "first_beam_gantry", "primary_dosimeter_unit")
+
+    def __init__(self, dataset):
+        beam_sequence = _get(lambda: dataset.BeamSequence) or []
+        self.number_of_beams = len(beam_sequence)
+        self.first_beam_gantry = ()
+        self.primary_dosimeter_unit = None
+        if beam_sequence:
+            first_control_points = _get(lambda: beam_sequence[0].ControlPointSequence) or []
+            self.first_beam_gantry = tuple(control_point.get("GantryAngle") for control_point in first_control_points[:2])
+            self.primary_dosimeter_unit = _get(lambda: beam_sequence[0].PrimaryDosimeterUnit)
+
+        #ignore setup beams
+        self.beams = [BeamSummary(beam) for beam in beam_sequence if beam.get("BeamDescription") != strings.SETUP_beam]
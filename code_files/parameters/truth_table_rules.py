@@ -0,0 +1,150 @@
+''' Pre-parsed truth table values
+
+The values in the truth table are strings with a small syntax of their own, e.g.
+    "150,60,0,300,210"  - a gantry angle for each beam
+    "?,89,93,89,?"      - an SSD for each beam, with "?" accepting any value
+    "*0"                - any collimator angle except 0
+    "50/25/-"           - DOSE/FRACTION/UNIT, with "-" accepting any value
+
+Each value is parsed once, when the truth table is loaded, into a rule object for its parameter.
+The evaluation functions then work with the rule instead of splitting and checking the string on every call,
+and badly formatted values are found when the table is loaded instead of when a plan is evaluated.
+
+Each parsing function is supplied with the truth table value (a string) and returns a rule.
+If the value is badly formatted, the rule's error is set to a message describing the problem.
+'''
+
+from code_files import strings
+
+class Rule:
+    ''' A parsed truth table value
+
+    text    - the original truth table value
+    any     - True if the value accepts any parameter value
+    error   - None, or a message describing why the value couldn't be parsed
+    '''
+    __slots__ = ("text", "any", "error")
+
+    def __init__(self, text, error=None):
+        self.text = text
+        self.any = text == strings.ANY_VALUE
+        self.error = error
+
+class ListRule(Rule):
+    ''' A comma separated list of values, one per beam. Values which accept anything are stored as None.'''
+    __slots__ = ("values",)
+
+    def __init__(self, text, values, error=None):
+        super().__init__(text, error)
+        self.values = values
+
+class CollimatorRule(Rule):
+    ''' A collimator angle, which may be negated with a "*" prefix to accept any angle except it'''
+    __slots__ = ("angle", "negated")
+
+    def __init__(self, text, angle, negated, error=None):
+        super().__init__(text, error)
+        self.angle = angle
+        self.negated = negated
+
+class PrescriptionRule(Rule):
+    ''' DOSE/FRACTION/UNIT, with each item either a required value or None to accept any value'''
+    __slots__ = ("items",)
+
+    def __init__(self, text, items, error=None):
+        super().__init__(text, error)
+        self.items = items
+
+def _parse_default(table_value):
+    return Rule(table_value)
+
+def _parse_gantry(table_value):
+    angles = []
+    for value in table_value.split(","):
+        if value == strings.ANY_VALUE:
+            angles.append(None)
+        elif value.isdigit():
+            angles.append(float(value))
+        else:
+            return ListRule(table_value, (), f"gantry angle <{value}> is not a whole number")
+    return ListRule(table_value, tuple(angles))
+
+def _parse_ssd(table_value):
+    ssds = []
+    for value in table_value.split(","):
+        if value in (strings.ANY_VALUE, strings.ANY_SSD):
+            ssds.append(None)
+        elif value.isdigit():
+            ssds.append(float(value))
+        else:
+            return ListRule(table_value, (), f"SSD <{value}> is not a whole number")
+    return ListRule(table_value, tuple(ssds))
+
+def _parse_wedge(table_value):
+    for value in table_value.split(","):
+        if not value.isdigit() and value != strings.ANY_VALUE and value != strings.no_wedge:
+            return ListRule(table_value, (), f"wedge <{value}> is not a whole number or '{strings.no_wedge}'")
+    return ListRule(table_value, tuple(table_value.split(",")))
+
+def _parse_collimator(table_value):
+    for value in table_value.split(","):
+        if not value.isdigit() and value != strings.ANY_VALUE:
+            if not value[:1] == "*" or len(value) < 2 or not value[1:].isdigit():
+                return CollimatorRule(table_value, None, False, f"collimator angle <{value}> is not a whole number")
+    negated = table_value[:1] == "*"
+    return CollimatorRule(table_value, table_value[1:] if negated else table_value, negated)
+
+def _parse_prescription_dose(table_value):
+    items = table_value.split("/")
+    if len(items) != 3:
+        return PrescriptionRule(table_value, (), "prescription must be in the format DOSE/FRACTION/UNIT")
+    return PrescriptionRule(table_value, tuple(None if item == strings.ANY_VALUE else item for item in items))
+
+def _parse_field_size(table_value):
+    sizes = table_value.split(",")
+    return ListRule(table_value, tuple(None if size == "?" else size for size in sizes))
+
+rule_parsers = {
+    strings.mode                    : _parse_default,
+    strings.prescription_dose       : _parse_prescription_dose,
+    strings.prescription_point      : _parse_default,
+    strings.isocenter_point         : _parse_default,
+    strings.override                : _parse_default,
+    strings.collimator              : _parse_collimator,
+    strings.gantry                  : _parse_gantry,
+    strings.SSD                     : _parse_ssd,
+    strings.couch                   : _parse_default,
+    strings.field_size              : _parse_field_size,
+    strings.wedge                   : _parse_wedge,
+    strings.meas                    : _parse_default,
+    strings.energy                  : _parse_default,
+}
+
+def parse_case(truth_table, case):
+    ''' Parses the truth table values of one case
+        Returns a dictionary {parameter: rule} for every parameter in the truth table
+    '''
+    return dict((parameter, rule_parsers[parameter](str(truth_table[parameter][case-1])))
+                for parameter in strings.parameters if parameter in truth_table)
+
+class CompiledTruthTable(dict):
+    ''' A truth table dictionary {parameter: [value for each case]} which also holds the parsed rules for every case
+
+    rules   - a dictionary {case: {parameter: rule}}
+    errors  - a list of (case, parameter, value, message) for every badly formatted value in the table
+    '''
+    def __init__(self, truth_table):
+        super().__init__(truth_table)
+        self.rules = {}
+        self.errors = []
+        for case in range(1, len(self["case"]) + 1):
+            self.rules[case] = parse_case(self, case)
+            for parameter, rule in self.rules[case].items():
+                if rule.error:
+                    self.errors.append((case, parameter, rule.text, rule.error))
+
+def case_rules(truth_table, case):
+    ''' The parsed rules for one case of a truth table, parsing them now if the table isn't compiled'''
+    if isinstance(truth_table, CompiledTruthTable):
+        return truth_table.rules[case]
+    return parse_case(truth_table, case)
@@ -0,0 +1,61 @@
+''' Matching the SSDs of a VMAT arc against the truth table
+
+For a VMAT plan the truth table gives an SSD for a few gantry angles, e.g. gantry "150,60,0,300,210" with
+SSD "?,89,93,89,?". Every control point whose gantry angle is within gantry_tolerance of one of those angles
+must have an SSD within ssd_tolerance of the corresponding truth table SSD.
+
+An arc has hundreds of control points, so rather than comparing every truth table angle with every control point,
+the control point angles are sorted once and the control points near each truth table angle are found by binary
+search (numpy.searchsorted).
+'''
+
+from collections import namedtuple
+from code_files import strings
+
+# The control points found near one truth table gantry angle
+#   gantry          - the truth table gantry angle
+#   ssd             - the truth table SSD for that angle (cm)
+#   control_points  - the indices of the control points within tolerance of the gantry angle
+#   max_deviation   - the largest difference between their SSDs and the truth table SSD (None if no control points)
+#   result          - PASS or FAIL
+GantryMatch = namedtuple("GantryMatch", ["gantry", "ssd", "control_points", "max_deviation", "result"])
+
+def match_gantry_ssd(gantry_angles, ssds, table_gantry, table_ssd, gantry_tolerance=0.3, ssd_tolerance=1):
+    ''' Checks the SSD of every control point near each of the truth table's gantry angles
+
+    gantry_angles   - the gantry angle of each control point
+    ssds            - the SSD (cm) of each control point
+    table_gantry    - the truth table gantry angles
+    table_ssd       - the truth table SSD for each of those angles, or None to accept any SSD
+    Returns PASS or FAIL, and a list with a GantryMatch for each truth table angle that has an SSD
+    '''
+    # numpy is only needed here, so it isn't imported until a VMAT plan is evaluated
+    import numpy as np
+
+    gantry_angles = np.asarray(gantry_angles, dtype=float)
+    ssds = np.asarray(ssds, dtype=float)
+    checked = [(gantry, ssd) for gantry, ssd in zip(table_gantry, table_ssd) if gantry is not None and ssd is not None]
+    if not checked:
+        return strings.PASS, []
+
+    order = np.argsort(gantry_angles, kind="stable")
+    sorted_angles = gantry_angles[order]
+    targets = np.array([gantry for gantry, _ in checked], dtype=float)
+
+    # Find every window at once. The windows are slightly wider than the tolerance, and then narrowed with the exact
+    # comparison, so that control points right on the edge are treated the same as a direct comparison would.
+    margin = gantry_tolerance + 1e-9
+    starts = np.searchsorted(sorted_angles, targets - margin, side="left")
+    ends = np.searchsorted(sorted_angles, targets + margin, side="right")
+
+    matches = []
+    for (gantry, ssd), start, end in zip(checked, starts, ends):
+        window = order[start:end]
+        window = np.sort(window[np.abs(gantry_angles[window] - gantry) < gantry_tolerance])
+        deviations = np.abs(ssds[window] - ssd)
+        max_deviation = float(deviations.max()) if len(window) else None
+        result = strings.FAIL if len(window) and max_deviation > ssd_tolerance else strings.PASS
+        matches.append(GantryMatch(gantry, ssd, window.tolist(), max_deviation, result))
+
+    result = strings.FAIL if any(match.result == strings.FAIL for match in matches) else strings.PASS
+    return result, matches
@@ -0,0 +1,114 @@
+''' A pipeline which overlaps reading, processing and writing a batch of files, using threads
+
+Processing a batch one file at a time alternates between waiting for the disk (or network) and using the CPU.
+In a pipeline each file goes through three stages, which run at the same time on different files:
+
+read        - run by a pool of reader threads, which read ahead of the files being processed
+process     - run by one thread, on each file in turn
+write       - run in the thread that iterates over the results, on each file in turn
+
+The stages are joined by bounded queues, so the readers never get more than queue_size files ahead
+(which also caps how many files are held in memory at once), and results come out in the same order as the items.
+'''
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Passed down the queues after the last item
+_finished = object()
+
+class _Failed:
+    ''' Passed down the queues in place of an item when a stage raised an exception'''
+    def __init__(self, error):
+        self.error = error
+
+def _put(destination, item, stop):
+    ''' Puts item in the destination queue, waiting for space unless the pipeline is stopped
+        Returns False if the pipeline was stopped
+    '''
+    while not stop.is_set():
+        try:
+            destination.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get(source, stop):
+    ''' Gets the next item from the source queue, or _finished if the pipeline is stopped'''
+    while not stop.is_set():
+        try:
+            return source.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _finished
+
+def run_pipeline(items, read, process, write, readers=4, queue_size=8):
+    ''' Runs every item through the read, process and write functions, with the stages overlapping
+
+    items       - the items to process, e.g. file paths
+    read        - the first stage, run by the reader threads: read(item) -> value passed to process
+    process     - the second stage, run in a thread of its own: process(value) -> value passed to write
+    write       - the last stage, run by the caller: write(value) -> the result yielded for the item
+    readers     - the number of reader threads
+    queue_size  - the maximum number of items waiting between two stages
+
+    Yields the result of each item, in the order of items. If a stage raises an exception, the pipeline is stopped
+    and the exception is raised here.
+    '''
+    stop = threading.Event()
+    read_queue = queue.Queue(queue_size)
+    process_queue = queue.Queue(queue_size)
+    executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="pipeline-read")
+
+    def feed():
+        # Futures are queued in order, so reads can finish in any order while the items stay in order
+        try:
+            for item in items:
+                if not _put(read_queue, executor.submit(read, item), stop):
+                    return
+        except Exception as error:
+            _put(read_queue, _Failed(error), stop)
+            return
+        _put(read_queue, _finished, stop)
+
+    def run_process():
+        while True:
+            future = _get(read_queue, stop)
+            if future is _finished or isinstance(future, _Failed):
+                _put(process_queue, future, stop)
+                return
+            try:
+                value = process(future.result())
+            except Exception as error:
+                _put(process_queue, _Failed(error), stop)
+                return
+            if not _put(process_queue, value, stop):
+                return
+
+    threads = [threading.Thread(target=feed, name="pipeline-feed", daemon=True),
+               threading.Thread(target=run_process, name="pipeline-process", daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            value = _get(process_queue, stop)
+            if value is _finished:
+                return
+            if isinstance(value, _Failed):
+                raise value.error
+            yield write(value)
+    finally:
+        # Also reached if the caller stops iterating early: the other threads are told to stop and waited for
+        stop.set()
+        for thread in threads:
+            thread.join()
+        while True:
+            try:
+                pending = read_queue.get_nowait()
+            except queue.Empty:
+                break
+            if hasattr(pending, "cancel"):
+                pending.cancel()
+        executor.shutdown(wait=True)
@@ -0,0 +1,141 @@
+''' Profiling a whole run of the program, for finding out why a batch is slow
+
+While a Profiler is running, the batch is profiled in two ways at once:
+
+cProfile        - every function call is counted and timed. Saved as PREFIX.prof, which can be opened with
+                  python -m pstats, snakeviz, etc.
+sampling        - a background thread looks at the main thread's call stack every few milliseconds. The stacks are
+                  saved as PREFIX.folded ("outer;inner;innermost count" lines), the format read by flamegraph.pl,
+                  speedscope and other flame graph tools.
+
+A plain text summary is saved as PREFIX.txt. It splits the time spent between pydicom, pandas, numpy, this
+program's code, built-in functions and everything else, lists the hottest functions of each, and lists the slowest
+plans of the batch.
+'''
+
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from code_files import metrics
+
+# The folder containing the program's code, used to tell its functions apart from library functions
+_project_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Libraries whose time is reported separately in the summary, and how they are recognised by their filenames
+libraries = [
+    ("pydicom", os.sep + "pydicom" + os.sep),
+    ("pandas", os.sep + "pandas" + os.sep),
+    ("numpy", os.sep + "numpy" + os.sep),
+]
+
+def library(filename):
+    ''' The name of the library (or "project", "builtins" or "other") a function belongs to, by the file it is defined in'''
+    # cProfile gives built-in functions (e.g. methods of str, or file reads) the filename "~"
+    if filename == "~" or filename.startswith("<"):
+        return "builtins"
+    for name, marker in libraries:
+        if marker in filename:
+            return name
+    if os.path.abspath(filename).startswith(_project_folder) and "site-packages" not in filename:
+        return "project"
+    return "other"
+
+def _frame_name(code):
+    return "{}:{}".format(os.path.basename(code.co_filename), code.co_name).replace(";", ":").replace(" ", "_")
+
+class Profiler:
+    ''' Profiles the program between start() and stop()
+
+    prefix      - the path, without extension, of the files the profile is saved to
+    top         - the number of hottest functions listed for each library in the summary
+    slowest     - the number of slowest plans listed in the summary
+    interval    - the time in seconds between the samples of the call stack
+    '''
+    def __init__(self, prefix, top=20, slowest=10, interval=0.005):
+        self.prefix = prefix
+        self.top = top
+        self.slowest = slowest
+        self.interval = interval
+        self.profile = cProfile.Profile()
+        self.stacks = Counter()
+        self._stop_sampling = threading.Event()
+        self._sampler = None
+        self._metrics_enabled = None
+
+    def start(self):
+        # The time of every plan is kept by the metrics, to find the slowest
+        self._metrics_enabled = metrics.enabled
+        metrics.enabled = True
+        metrics.kept.add("process_dicom")
+
+        self._thread_id = threading.get_ident()
+        self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+        self._started = time.perf_counter()
+        self._sampler.start()
+        self.profile.enable()
+
+    def stop(self):
+        ''' Stops profiling and saves the profile
+            Returns the paths of the files that were saved
+        '''
+        self.profile.disable()
+        self.wall_time = time.perf_counter() - self._started
+        self._stop_sampling.set()
+        self._sampler.join()
+        metrics.enabled = self._metrics_enabled
+        metrics.kept.discard("process_dicom")
+
+        files = [self.prefix + ".prof", self.prefix + ".folded", self.prefix + ".txt"]
+        self.profile.dump_stats(files[0])
+        with open(files[1], 'w') as folded:
+            for stack, samples in self.stacks.most_common():
+                folded.write(f"{stack} {samples}\n")
+        with open(files[2], 'w') as text:
+            text.write(self.summary())
+        return files
+
+    def _sample(self):
+        # Runs in a background thread, so it isn't seen by cProfile (which only profiles the thread that enabled it)
+        while not self._stop_sampling.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def summary(self):
+        ''' A plain text summary of where the time of the run went'''
+        stats = pstats.Stats(self.profile, stream=io.StringIO()).stats
+        own_time = Counter()
+        functions = {}
+        for (filename, line, function), (primitive_calls, calls, total, cumulative, callers) in stats.items():
+            group = library(filename)
+            own_time[group] += total
+            functions.setdefault(group, []).append((total, cumulative, calls, f"{function} ({os.path.basename(filename)}:{line})"))
+        profiled_time = sum(own_time.values()) or 1
+
+        lines = [f"Profile of {' '.join(sys.argv)}",
+                 f"Wall time {self.wall_time:.3f} s, {sum(self.stacks.values())} stack samples", ""]
+
+        lines.append("Time spent in the functions of each library:")
+        for group, seconds in own_time.most_common():
+            lines.append("  {:10} {:9.3f} s  {:5.1f}%".format(group, seconds, 100 * seconds / profiled_time))
+
+        plans = sorted(metrics.kept_calls.get("process_dicom", []), key=lambda call: call[0], reverse=True)
+        lines += ["", f"Slowest {min(self.slowest, len(plans))} of {len(plans)} plans:"]
+        for seconds, location in plans[:self.slowest]:
+            lines.append("  {:9.3f} s  {}".format(seconds, location))
+
+        for group, seconds in own_time.most_common():
+            lines += ["", f"Hottest {group} functions:",
+                      "  {:>10} {:>10} {:>10}  {}".format("own s", "cumul. s", "calls", "function")]
+            for total, cumulative, calls, name in sorted(functions[group], reverse=True)[:self.top]:
+                lines.append("  {:10.4f} {:10.4f} {:10}  {}".format(total, cumulative, calls, name))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,136 @@
+''' Module for caching the results of processing a plan, so unchanged plans aren't processed again
+
+Results are stored in an SQLite database, keyed by a hash of everything that determines them:
+- the contents of the RTPLAN
+- the contents of the truth table file
+- the source code of the extraction and evaluation functions, and of the code reading the DICOMs and the truth table
+  (so changing them invalidates old results)
+- the case number, and the dose and structure files associated with the plan
+
+The database is kept under a maximum size by evicting the least recently used results.
+'''
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from code_files import strings, archives
+
+_schema = '''
+    CREATE TABLE IF NOT EXISTS results (
+        key         TEXT PRIMARY KEY,
+        value       TEXT NOT NULL,
+        size        INTEGER NOT NULL,
+        last_used   REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+'''
+
+def file_digest(path):
+    ''' The SHA-256 hash of a file's (or archive member's) contents'''
+    if archives.split_member(path):
+        return hashlib.sha256(archives.read_member(path)).hexdigest()
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# The modules outside the parameters package whose code also determines the results: reading the DICOMs (and their
+# compact form), the dose and structure files, and the truth table, and the names the parameters are stored under
+result_modules = ["dicom_loader.py", "compact_plan.py", "dose_grid.py", "structure_set.py", "truth_table_reader.py",
+                  "strings.py"]
+
+def code_version():
+    ''' A hash of the source of the parameters package, which holds all extraction and evaluation code, and of the
+        result_modules that read the plans and the files evaluated with them
+    '''
+    digest = hashlib.sha256()
+    folder = os.path.dirname(__file__)
+    package = os.path.join(folder, "parameters")
+    sources = [os.path.join("parameters", name) for name in sorted(os.listdir(package)) if name.endswith(".py")]
+    for name in sources + result_modules:
+        with open(os.path.join(folder, name), 'rb') as source:
+            digest.update(name.encode() + source.read())
+    return digest.hexdigest()
+
+class ResultCache:
+    ''' A size-bounded, persistent cache of extracted parameters and evaluations
+
+    cache_file          - the SQLite database to store results in
+    truth_table_file    - the truth table the results are evaluated against
+    max_size            - the maximum total size, in bytes, of the cached results
+    '''
+    def __init__(self, cache_file, truth_table_file, max_size):
+        self.cache_file = cache_file
+        self.max_size = max_size
+        self.version = file_digest(truth_table_file) + code_version()
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # Connections can't be shared between processes, so each worker process opens its own
+        state = dict(self.__dict__)
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def connection(self):
+        # SQLite connections can't be used from another thread either, so each thread (e.g. of a pipeline) has its own
+        local = self._local
+        if getattr(local, "connection", None) is None or local.pid != os.getpid():
+            local.connection = sqlite3.connect(self.cache_file, timeout=30)
+            local.connection.executescript(_schema)
+            local.pid = os.getpid()
+        return local.connection
+
+    def key(self, location, case_number, dose_struct_paths, data=None):
+        ''' The cache key for processing the plan at location as the given case
+            data is the contents of the plan, if it has already been read into memory
+        '''
+        digest = hashlib.sha256()
+        digest.update(self.version.encode())
+        digest.update((hashlib.sha256(data).hexdigest() if data is not None else file_digest(location)).encode())
+        digest.update(str(case_number).encode())
+        if dose_struct_paths:
+            for modality in (strings.RTDOSE, strings.RTSTRUCT):
+                for path in dose_struct_paths[modality]:
+                    stat = archives.stat(path)
+                    digest.update(f"{modality}:{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        ''' Returns the cached (parameters, evaluations), or None if the key isn't in the cache'''
+        connection = self.connection()
+        row = connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        with connection:
+            connection.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+        parameters, evaluations = json.loads(row[0])
+        return parameters, evaluations
+
+    def put(self, key, parameters, evaluations):
+        value = json.dumps([parameters, evaluations])
+        connection = self.connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                               (key, value, len(value), time.time()))
+            self._evict(connection)
+
+    def _evict(self, connection):
+        ''' Removes the least recently used results until the cache is within its maximum size'''
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_size:
+            return
+        evicted = []
+        for key, size in connection.execute("SELECT key, size FROM results ORDER BY last_used"):
+            if total <= self.max_size:
+                break
+            evicted.append((key,))
+            total -= size
+        connection.executemany("DELETE FROM results WHERE key = ?", evicted)
@@ -0,0 +1,209 @@
+''' Module for keeping the results of every run in one database, to look at results across runs and over time
+
+Each run (python app.py --store results.sqlite) adds to an SQLite database:
+
+    runs        - when each run started and finished, its truth tables and inputs
+    plans       - each plan processed: its location, SOPInstanceUID, StudyInstanceUID, truth table and case
+    results     - each parameter of each plan: its value, evaluation and the truth table's solution
+
+Results are inserted in batches of batch_size plans, each batch in one transaction, so storing results costs
+little more than writing them to a report. results holds the case and time of its plan as well, and is indexed on
+(parameter, case, evaluation, time), so questions such as "every FAIL gantry result for case 7 in the last month"
+are answered from the index without going through every result:
+
+    query("results.sqlite", parameter="gantry", case=7, evaluation="FAIL", days=30)
+
+or from the command line:
+
+    python -m code_files.results_store results.sqlite --parameter gantry --case 7 --evaluation FAIL --days 30
+'''
+
+import json
+import sqlite3
+import time
+from datetime import datetime, date
+
+_schema = '''
+    CREATE TABLE IF NOT EXISTS runs (
+        id                  INTEGER PRIMARY KEY,
+        started             REAL NOT NULL,
+        finished            REAL,
+        truth_tables        TEXT,
+        inputs              TEXT
+    );
+    CREATE TABLE IF NOT EXISTS plans (
+        id                  INTEGER PRIMARY KEY,
+        run                 INTEGER NOT NULL,
+        location            TEXT NOT NULL,
+        sop_instance_uid    TEXT,
+        study_instance_uid  TEXT,
+        truth_table         TEXT,
+        case_number         INTEGER,
+        processed           REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS results (
+        plan                INTEGER NOT NULL,
+        parameter           TEXT NOT NULL,
+        value               TEXT,
+        evaluation          TEXT,
+        solution            TEXT,
+        case_number         INTEGER,
+        processed           REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS results_parameter ON results (parameter, case_number, evaluation, processed);
+    CREATE INDEX IF NOT EXISTS results_processed ON results (processed);
+    CREATE INDEX IF NOT EXISTS results_plan ON results (plan);
+    CREATE INDEX IF NOT EXISTS plans_sop_instance_uid ON plans (sop_instance_uid);
+    CREATE INDEX IF NOT EXISTS plans_study_instance_uid ON plans (study_instance_uid);
+    CREATE INDEX IF NOT EXISTS plans_case ON plans (case_number, processed);
+'''
+
+# The number of plans whose results are inserted together
+batch_size = 100
+
+def _text(value):
+    # Lists of values (e.g. SSDs) are stored as JSON, so they can be read back as lists
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, default=str)
+
+def identifiers(location):
+    ''' The (SOPInstanceUID, StudyInstanceUID) of a DICOM, read from its header. Either is None if missing.'''
+    from code_files.dicom_loader import read_header
+    try:
+        header = read_header(location)
+    except (OSError, ValueError):
+        return None, None
+    return tuple(str(header[keyword].value) if keyword in header else None
+                 for keyword in ("SOPInstanceUID", "StudyInstanceUID"))
+
+class ResultsStore:
+    ''' The results database, open for adding a run's results
+
+    store_file  - the SQLite database, created if it doesn't exist
+    '''
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self.connection = sqlite3.connect(store_file, timeout=30)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(_schema)
+        self.run = None
+        self.pending = []
+        self.count = 0
+
+    def start_run(self, truth_tables, inputs):
+        ''' Records the start of a run, which the results added from now on belong to'''
+        with self.connection:
+            self.run = self.connection.execute("INSERT INTO runs (started, truth_tables, inputs) VALUES (?, ?, ?)",
+                                               (time.time(), json.dumps(list(truth_tables)), json.dumps(list(inputs)))).lastrowid
+        return self.run
+
+    def add(self, location, case, parameters, evaluations, solutions, truth_table=None, identifiers=None):
+        ''' Adds the results of a plan (the same arguments as BatchReport.write)
+
+        identifiers - the plan's (SOPInstanceUID, StudyInstanceUID), read from the DICOM when they are stored if not given
+        '''
+        self.pending.append((str(location), case, parameters, evaluations, solutions, truth_table,
+                             identifiers, time.time()))
+        if len(self.pending) >= batch_size:
+            self.flush()
+
+    def flush(self):
+        ''' Inserts the results added since the last flush, in one transaction'''
+        if not self.pending:
+            return
+        from code_files import strings
+        rows = []
+        with self.connection:
+            for location, case, parameters, evaluations, solutions, truth_table, plan_identifiers, processed in self.pending:
+                sop_instance_uid, study_instance_uid = plan_identifiers or identifiers(location)
+                plan = self.connection.execute(
+                    "INSERT INTO plans (run, location, sop_instance_uid, study_instance_uid, truth_table, case_number, processed) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (self.run, location, sop_instance_uid, study_instance_uid, truth_table, case, processed)).lastrowid
+                rows += [(plan, parameter, _text(parameters[parameter]), _text(evaluations[parameter]),
+                          _text(solutions[parameter]), case, processed) for parameter in strings.parameters]
+            self.connection.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.count += len(self.pending)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        if self.run is not None:
+            with self.connection:
+                self.connection.execute("UPDATE runs SET finished = ? WHERE id = ?", (time.time(), self.run))
+        self.connection.close()
+
+def _timestamp(moment):
+    ''' A time given as a datetime, a date, an ISO date string ("2024-03-31") or a Unix time, as a Unix time'''
+    if isinstance(moment, str):
+        moment = datetime.fromisoformat(moment)
+    if isinstance(moment, datetime):
+        return moment.timestamp()
+    if isinstance(moment, date):
+        return datetime(moment.year, moment.month, moment.day).timestamp()
+    return float(moment)
+
+def query(store_file, parameter=None, case=None, evaluation=None, since=None, until=None, days=None,
+          truth_table=None, uid=None):
+    ''' Finds results in a results database
+
+    parameter, case, evaluation, truth_table    - only the results with these values, if given
+    since, until                                - only the results of plans processed in this time (see _timestamp)
+    days                                        - only the results of the last number of days
+    uid                                         - only the results of the plan or study with this SOPInstanceUID
+                                                    or StudyInstanceUID
+    Returns a list of dictionaries, one per result, from the most recent
+    '''
+    conditions, values = [], []
+    for column, value in (("r.parameter", parameter), ("r.case_number", case), ("r.evaluation", evaluation),
+                          ("p.truth_table", truth_table)):
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            values.append(value)
+    if days is not None:
+        since = time.time() - days * 24 * 60 * 60
+    if since is not None:
+        conditions.append("r.processed >= ?")
+        values.append(_timestamp(since))
+    if until is not None:
+        conditions.append("r.processed < ?")
+        values.append(_timestamp(until))
+    if uid is not None:
+        conditions.append("(p.sop_instance_uid = ? OR p.study_instance_uid = ?)")
+        values += [uid, uid]
+
+    sql = ("SELECT datetime(r.processed, 'unixepoch', 'localtime') AS processed, p.run, p.location, p.sop_instance_uid, "
+           "p.study_instance_uid, p.truth_table, r.case_number AS 'case', r.parameter, r.value, r.evaluation, r.solution "
+           "FROM results r JOIN plans p ON p.id = r.plan")
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY r.processed DESC, p.id, r.rowid"
+    connection = sqlite3.connect(store_file)
+    try:
+        connection.row_factory = sqlite3.Row
+        return [dict(row) for row in connection.execute(sql, values)]
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    import argparse
+    import csv
+    import sys
+    parser = argparse.ArgumentParser(description="Find results in a results database, printed as CSV.")
+    parser.add_argument("store", help="The results database (see --store in app.py).")
+    parser.add_argument("--parameter", help="e.g. gantry")
+    parser.add_argument("--case", type=int)
+    parser.add_argument("--evaluation", help="e.g. FAIL")
+    parser.add_argument("--truth_table", help="The name of the truth table, when runs compared several.")
+    parser.add_argument("--since", help="A date, e.g. 2024-03-01")
+    parser.add_argument("--until", help="A date, e.g. 2024-04-01")
+    parser.add_argument("--days", type=float, help="Only the results of the last number of days.")
+    parser.add_argument("--uid", help="A SOPInstanceUID or StudyInstanceUID.")
+    args = vars(parser.parse_args())
+    rows = query(args.pop("store"), **args)
+    writer = csv.writer(sys.stdout)
+    if rows:
+        writer.writerow(rows[0].keys())
+    writer.writerows(row.values() for row in rows)
@@ -0,0 +1,277 @@
+''' Module for checking plans through a local HTTP API, so that e.g. a TPS export hook can get a verdict without
+paying for starting Python, importing pydicom and reading the truth tables for every plan
+
+The server (python app.py --serve) keeps pydicom, the truth tables and the dose/struct index of each folder it
+has seen in memory. Each client is handled on its own thread, and the plans are checked by a bounded pool of
+worker processes (-w), so a client only waits for the others when the pool is busy.
+
+    GET  /health    the truth tables loaded and the number of plans checked
+    POST /check     checks a plan, given either as JSON: {"path": "C:/exports/RP.dcm", "case": 7, "truth_table": "lvl3"}
+                    or as the DICOM itself (Content-Type: application/dicom), with the case and truth table in the
+                    query: /check?case=7&truth_table=lvl3
+
+The case and truth table are optional: without a case, the case is worked out from the plan (see case_classifier),
+and the truth table defaults to the first one loaded. Truth tables are named by their filename without extension.
+The response is JSON: {location, truth_table, case, parameters, evaluations, solutions}. Errors are {"error": ...}
+with the status 400 (bad request), 404 (no such file), 413 (too large), 422 (not a plan, or its case is unclear) or
+503 (too many plans waiting, try again later).
+
+The server listens on HOST:PORT (127.0.0.1:8765 by default, so it is only reachable from this computer) or on a
+Unix socket, given as unix:PATH.
+'''
+
+import io
+import json
+import os
+import stat
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlsplit, parse_qs
+from code_files import metrics
+from code_files.dicom_loader import read_header, read_plan
+from code_files.parameters.parameter_retrieval import extract_parameters, evaluate_parameters
+
+default_address = "127.0.0.1:8765"
+# How many plans can wait for the pool (per worker) before more are turned away
+queue_per_worker = 4
+# The largest DICOM accepted in a request
+max_body_size = 512 * 1024 * 1024
+
+# The truth tables and settings of the process checking plans (see init_worker)
+_state = {}
+
+class RequestError(Exception):
+    ''' A plan that can't be checked, reported to the client with an HTTP status'''
+    def __init__(self, status, message):
+        super().__init__(status, message)
+        self.status = status
+        self.message = message
+
+def init_worker(truth_tables, low_memory):
+    ''' Keeps the truth tables in a worker process, so that they aren't sent with each plan'''
+    _state.update(truth_tables=truth_tables, low_memory=low_memory)
+
+def check_plan(source, location, case, table_name, dose_struct_paths):
+    ''' Extracts and evaluates a plan, in a worker of the pool
+
+    source              - the path of the plan, or its contents (bytes)
+    location            - the name of the plan in the response
+    case                - the case number, or None to work it out
+    table_name          - the name of the truth table to evaluate against
+    dose_struct_paths   - the plan's dose and structure files, as found in the dose/struct index (or None)
+    Returns the response, or raises RequestError
+    '''
+    truth_table = _state["truth_tables"][table_name]
+    with metrics.timer("read_plan", location):
+        dataset = read_plan(io.BytesIO(source) if isinstance(source, bytes) else source, low_memory=_state["low_memory"])
+
+    confidence = None
+    if case is None:
+        from code_files.case_classifier import classify
+        with metrics.timer("classify_case"):
+            classification = classify(dataset, truth_table, location)
+        if not classification.confident:
+            raise RequestError(422, "unclear case, {} ({:.2f}) or {}: give the case".format(
+                classification.case, classification.confidence, classification.describe_alternatives()))
+        case, confidence = classification.case, classification.confidence
+
+    parameters = extract_parameters(dataset, dose_struct_paths, case)
+    evaluations = evaluate_parameters(parameters, truth_table, case)
+    solutions = dict([(key, truth_table[key][case-1]) for key in truth_table])
+    result = dict(location=location, truth_table=table_name, case=case, parameters=parameters,
+                  evaluations=evaluations, solutions=solutions)
+    if confidence is not None:
+        result["confidence"] = confidence
+    return result
+
+class PlanServer:
+    ''' The state kept between requests: the pool checking plans, and the dose/struct index of each folder
+
+    truth_tables        - {name: truth table}. Plans are evaluated against the first unless the request names another.
+    workers             - the number of plans checked at once. With more than one, plans are checked in processes.
+    low_memory          - whether plans are read in low memory mode (see dicom_loader.read_plan)
+    dose_struct_index   - a function returning the dose/struct index of a folder (see app.dose_struct_references),
+                            or None to not look for dose and structure files
+    '''
+    def __init__(self, truth_tables, workers=1, low_memory=False, dose_struct_index=None):
+        self.truth_tables = truth_tables
+        self.default_table = next(iter(truth_tables))
+        self.dose_struct_index = dose_struct_index
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.waiting = threading.BoundedSemaphore(workers * queue_per_worker)
+        if workers > 1:
+            self.pool = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(truth_tables, low_memory))
+        else:
+            init_worker(truth_tables, low_memory)
+            self.pool = ThreadPoolExecutor(1)
+
+    def check(self, source, location=None, case=None, truth_table=None):
+        ''' Checks a plan, given by its path or contents (bytes). Returns the response, or raises RequestError'''
+        table_name = truth_table or self.default_table
+        if table_name not in self.truth_tables:
+            raise RequestError(400, f"Unknown truth table <{table_name}>: use one of {', '.join(self.truth_tables)}")
+        if case is not None and not 1 <= case <= len(self.truth_tables[table_name]["case"]):
+            raise RequestError(400, f"Case must be an integer between 1 and {len(self.truth_tables[table_name]['case'])}")
+        if isinstance(source, str) and not os.path.isfile(source):
+            raise RequestError(404, f"No such file <{source}>")
+        location = location or (source if isinstance(source, str) else "plan")
+
+        # The header is read here, to turn away files that aren't plans and to find the plan's dose and structures
+        with metrics.timer("read_header"):
+            header = read_header(io.BytesIO(source) if isinstance(source, bytes) else source)
+        if str(header.get("Modality")) != "RTPLAN":
+            raise RequestError(422, f"<{location}> is not a plan file")
+        dose_struct_paths = None
+        if isinstance(source, str):
+            dose_struct_paths = self.dose_struct_paths(os.path.dirname(os.path.abspath(source)), header.get("StudyInstanceUID"))
+
+        if not self.waiting.acquire(blocking=False):
+            metrics.count("plans_turned_away")
+            raise RequestError(503, "Too many plans are waiting to be checked: try again later")
+        try:
+            with metrics.timer("check_plan", location):
+                result = self.pool.submit(check_plan, source, location, case, table_name, dose_struct_paths).result()
+        finally:
+            self.waiting.release()
+        with self.lock:
+            self.checked += 1
+        return result
+
+    def dose_struct_paths(self, folder, uid):
+        ''' The dose and structure files of a plan in a folder. The folder's index is built when a plan from it is
+            first checked, and again when a plan's StudyInstanceUID isn't in it (its files may have arrived since)
+        '''
+        if self.dose_struct_index is None or uid is None:
+            return None
+        with self.lock:
+            index = self.indexes.get(folder)
+            if index is None or uid not in index:
+                index = self.indexes[folder] = self.dose_struct_index(folder)
+        return index.get(uid) if index else None
+
+    def health(self):
+        return dict(status="ok", truth_tables=list(self.truth_tables), default_truth_table=self.default_table,
+                    checked=self.checked)
+
+    def close(self):
+        self.pool.shutdown()
+
+class RequestHandler(BaseHTTPRequestHandler):
+    ''' Handles the requests of one client connection (see the module docstring for the API)'''
+    server_version = "PlanCheck"
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if urlsplit(self.path).path != "/health":
+            return self.respond(404, dict(error=f"Unknown path <{self.path}>: use /health or /check"))
+        self.respond(200, self.server.plans.health())
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/check":
+            return self.respond(404, dict(error=f"Unknown path <{url.path}>: use /check"))
+        try:
+            self.respond(200, self.server.plans.check(**self.read_request(parse_qs(url.query))))
+        except RequestError as error:
+            self.respond(error.status, dict(error=error.message))
+        except Exception as error:
+            self.respond(500, dict(error=f"{type(error).__name__}: {error}"))
+
+    def read_request(self, query):
+        ''' The arguments of PlanServer.check for a request'''
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > max_body_size:
+            raise RequestError(413, f"The request is larger than {max_body_size} bytes")
+        body = self.rfile.read(length)
+        request = dict((key, values[-1]) for key, values in query.items())
+        if self.headers.get_content_type() == "application/json":
+            try:
+                arguments = json.loads(body or b"{}")
+            except ValueError as error:
+                raise RequestError(400, f"The request isn't valid JSON: {error}")
+            if not isinstance(arguments, dict):
+                raise RequestError(400, "A JSON request must be an object, with the \"path\" of the plan")
+            request.update(arguments)
+            if not request.get("path"):
+                raise RequestError(400, 'A JSON request needs the "path" of the plan')
+            source = str(request["path"])
+        else:
+            if not body:
+                raise RequestError(400, "Send the plan as JSON with its path, or the DICOM itself")
+            source = body
+        try:
+            case = int(request["case"]) if request.get("case") not in (None, "") else None
+        except (TypeError, ValueError):
+            raise RequestError(400, f"Case must be an integer, not <{request['case']}>")
+        return dict(source=source, location=request.get("location"), case=case, truth_table=request.get("truth_table"))
+
+    def respond(self, status, content):
+        body = json.dumps(content, default=str).encode("utf-8")
+        if status != 200:
+            # The rest of a rejected request may not have been read, so the connection can't be reused
+            self.close_connection = True
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.server.log and self.command == "POST":
+            self.server.log("{:10} {}".format("CHECKED" if status == 200 else f"ERROR {status}",
+                                              content.get("location") or content.get("error")))
+
+    def log_message(self, format, *args):
+        # Requests are logged by respond(), in the same way as the rest of the program
+        pass
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # Unix socket clients have no address, which BaseHTTPRequestHandler expects
+        request, address = super().get_request()
+        return request, ("unix", 0)
+
+def make_server(address, plans, log=None):
+    ''' Creates the server for a PlanServer, listening on HOST:PORT or unix:PATH (see serve())'''
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        # A socket left behind by an earlier server is replaced, but nothing else is: the path may be a mistake
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise ValueError(f"<{path}> already exists and isn't a socket")
+            os.remove(path)
+        server = _UnixHTTPServer(path, RequestHandler)
+    else:
+        host, _, port = address.rpartition(":")
+        try:
+            server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), RequestHandler)
+        except ValueError:
+            raise ValueError(f"Not an address: <{address}> (expected HOST:PORT or unix:PATH)")
+        server.daemon_threads = True
+    server.plans = plans
+    server.log = log
+    return server
+
+def serve(address, plans, log=print):
+    ''' Serves the API of a PlanServer on an address, until interrupted (Ctrl+C or SIGTERM)'''
+    import signal
+    server = make_server(address, plans, log)
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    if log:
+        log(f"\nChecking plans at {address} (POST /check, GET /health). Press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        if log:
+            log("\nStopped serving")
+    finally:
+        server.server_close()
+        plans.close()
+        if address.startswith("unix:") and os.path.exists(address[len("unix:"):]):
+            os.remove(address[len("unix:"):])
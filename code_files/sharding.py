@@ -0,0 +1,289 @@
+''' Module for spreading a batch over several computers (or processes) which share a folder
+
+The coordinator (python app.py --shard coordinate --shard_queue S:/audits/q3.sqlite) finds the plans of the inputs
+as a normal run would, and writes them to a manifest: an SQLite work queue of shards of shard_size plans. Workers
+on any computer which can reach the queue (python app.py --shard work --shard_queue S:/audits/q3.sqlite) claim
+shards one at a time, process their plans and save the results of each shard as JSON lines in a folder next to
+the queue. Once every shard is finished, the coordinator merges their results into one report, in the order of the
+manifest. A queue can also be merged at any time with --shard merge.
+
+A worker holds a lease on the shard it is processing, which it renews while it works. If the worker crashes (or
+loses the shared folder), its lease runs out and the shard is claimed again by another worker, up to max_attempts
+times. Results are only saved under a shard's name once the whole shard is done, so a shard is never half merged.
+
+The truth tables, cases and output folder are the coordinator's, and are stored in the queue. Otherwise each
+worker uses its own settings.txt (e.g. for skip_dose_structure and cache_folder).
+SQLite needs working file locks on the shared folder: local disks and SMB shares have them, but some NFS setups don't.
+'''
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+# The number of plans in each shard
+shard_size = 50
+# How long a worker's claim on a shard lasts without being renewed, in seconds. It is renewed every third of this.
+lease_seconds = 120.0
+# How many times a shard is tried before it is given up on
+max_attempts = 3
+
+_schema = '''
+    CREATE TABLE IF NOT EXISTS settings (
+        key             TEXT PRIMARY KEY,
+        value           TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS shards (
+        id              INTEGER PRIMARY KEY,
+        state           TEXT NOT NULL DEFAULT 'pending',
+        worker          TEXT,
+        lease_expires   REAL,
+        attempts        INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS plans (
+        shard           INTEGER NOT NULL,
+        position        INTEGER NOT NULL,
+        path            TEXT NOT NULL,
+        input_folder    TEXT,
+        case_number     TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS shards_state ON shards (state, id);
+    CREATE INDEX IF NOT EXISTS plans_shard ON plans (shard, position);
+'''
+
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+
+def worker_name():
+    ''' The name a worker claims shards under: its computer and process'''
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def results_folder(queue_file):
+    ''' The folder next to the queue in which the results of its shards are saved'''
+    return os.path.splitext(queue_file)[0] + "_results"
+
+def results_file(queue_file, shard):
+    return os.path.join(results_folder(queue_file), f"shard-{shard:06d}.jsonl")
+
+def _to_json(value):
+    # Classifications and other small result objects are saved as dictionaries of their attributes
+    if isinstance(value, os.PathLike):
+        return os.fspath(value)
+    if hasattr(value, "__slots__"):
+        return dict((name, getattr(value, name)) for name in value.__slots__)
+    return str(value)
+
+class WorkQueue:
+    ''' The manifest of a sharded batch, and the state of each of its shards
+
+    queue_file  - the SQLite database of the queue, on storage shared by the coordinator and the workers
+    '''
+    def __init__(self, queue_file):
+        self.queue_file = queue_file
+        # isolation_level=None leaves transactions to be started explicitly, so that claims can lock the queue first
+        self.connection = sqlite3.connect(queue_file, timeout=60, isolation_level=None)
+        self.connection.executescript(_schema)
+
+    def create(self, plans, settings, size=None):
+        ''' Writes the manifest: plans is an iterable of (path, input folder or None, case number), and settings a
+            dictionary of the settings workers should use (stored as JSON). Returns the number of shards.
+        '''
+        size = size or shard_size
+        shards = 0
+        batch = []
+        with self.transaction():
+            self.connection.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                                        [(key, json.dumps(value)) for key, value in settings.items()])
+            for position, (path, input_folder, case_number) in enumerate(plans):
+                shard = position // size + 1
+                if shard > shards:
+                    self.connection.execute("INSERT INTO shards (id) VALUES (?)", (shard,))
+                    shards = shard
+                batch.append((shard, position, str(path), None if input_folder is None else str(input_folder),
+                              json.dumps(case_number)))
+                if len(batch) >= 1000:
+                    self.connection.executemany("INSERT INTO plans VALUES (?, ?, ?, ?, ?)", batch)
+                    batch = []
+            self.connection.executemany("INSERT INTO plans VALUES (?, ?, ?, ?, ?)", batch)
+        return shards
+
+    def transaction(self):
+        return _Transaction(self.connection)
+
+    def settings(self):
+        return dict((key, json.loads(value)) for key, value in self.connection.execute("SELECT key, value FROM settings"))
+
+    def expire(self, now=None):
+        ''' Gives up on the shards whose lease ran out on their last attempt'''
+        now = time.time() if now is None else now
+        with self.transaction():
+            self.connection.execute("UPDATE shards SET state = ? WHERE state = ? AND lease_expires < ? AND attempts >= ?",
+                                    (FAILED, LEASED, now, max_attempts))
+
+    def claim(self, worker, lease=None):
+        ''' Claims the next shard that is waiting, or whose worker's lease ran out
+            Returns the shard's number, or None if there are none left to claim
+        '''
+        now = time.time()
+        self.expire(now)
+        with self.transaction():
+            row = self.connection.execute("SELECT id FROM shards WHERE state = ? OR (state = ? AND lease_expires < ?) "
+                                          "ORDER BY id LIMIT 1", (PENDING, LEASED, now)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE shards SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                                    "WHERE id = ?", (LEASED, worker, now + (lease or lease_seconds), row[0]))
+        return row[0]
+
+    def renew(self, shard, worker, lease=None):
+        ''' Extends a worker's lease on a shard. Returns False if the shard is no longer the worker's.'''
+        with self.transaction():
+            cursor = self.connection.execute("UPDATE shards SET lease_expires = ? WHERE id = ? AND worker = ? AND state = ?",
+                                             (time.time() + (lease or lease_seconds), shard, worker, LEASED))
+        return cursor.rowcount == 1
+
+    def finish(self, shard, worker, partial_file=None):
+        ''' Marks a worker's shard as done. Returns False if the shard is no longer the worker's.
+
+        partial_file    - the worker's results for the shard, given the shard's name (see results_file) only if the
+                            shard is still the worker's. The queue stays locked until they are, so no other worker
+                            can take the shard over in between.
+        '''
+        with self.transaction():
+            cursor = self.connection.execute("UPDATE shards SET state = ?, lease_expires = NULL WHERE id = ? AND worker = ? "
+                                             "AND state = ?", (DONE, shard, worker, LEASED))
+            if cursor.rowcount == 1 and partial_file is not None:
+                os.replace(partial_file, results_file(self.queue_file, shard))
+        return cursor.rowcount == 1
+
+    def plans(self, shard):
+        ''' The plans of a shard, as [(path, input folder, case number), ...]'''
+        return [(path, input_folder, json.loads(case_number)) for path, input_folder, case_number in
+                self.connection.execute("SELECT path, input_folder, case_number FROM plans WHERE shard = ? ORDER BY position",
+                                        (shard,))]
+
+    def progress(self):
+        ''' The number of shards in each state: {state: count}'''
+        return dict(self.connection.execute("SELECT state, COUNT(*) FROM shards GROUP BY state"))
+
+    def shards(self):
+        ''' [(shard, state), ...] for every shard, in order'''
+        return list(self.connection.execute("SELECT id, state FROM shards ORDER BY id"))
+
+    def close(self):
+        self.connection.close()
+
+class _Transaction:
+    ''' An immediate transaction: the queue is locked for writing from the start, so two workers can't claim a shard
+        at once. Waits (up to the connection's timeout) for other workers' transactions to finish.
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute("COMMIT" if exc_type is None else "ROLLBACK")
+
+class _Heartbeat(threading.Thread):
+    ''' Renews a worker's lease on a shard in the background, for as long as the shard is being processed'''
+    def __init__(self, queue_file, shard, worker, lease):
+        super().__init__(daemon=True)
+        self.queue_file, self.shard, self.worker, self.lease = queue_file, shard, worker, lease
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        with closing(WorkQueue(self.queue_file)) as queue:
+            while not self.stopped.wait(self.lease / 3):
+                try:
+                    if not queue.renew(self.shard, self.worker, self.lease):
+                        self.lost = True
+                        return
+                except sqlite3.OperationalError:
+                    # The shared folder may be briefly unreachable: the lease lasts for a while yet
+                    pass
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def work(queue_file, process_plan, worker=None, lease=None, poll_interval=5.0, log=print):
+    ''' Claims and processes shards until every shard is done. While the last shards are being processed by other
+        workers, it waits to take over any whose worker stops renewing its lease.
+
+    process_plan    - a function (path, input folder, case number) returning the message and record of a plan
+                        (see app.process_dicom). An exception fails that plan only; it is saved with the results.
+    Returns the number of shards this worker finished
+    '''
+    worker = worker or worker_name()
+    lease = lease or lease_seconds
+    os.makedirs(results_folder(queue_file), exist_ok=True)
+    finished = 0
+    with closing(WorkQueue(queue_file)) as queue:
+        while True:
+            shard = queue.claim(worker, lease)
+            if shard is None:
+                if not queue.progress().get(LEASED):
+                    return finished
+                time.sleep(poll_interval)
+                continue
+            log(f"\nProcessing shard {shard} as {worker}")
+            heartbeat = _Heartbeat(queue_file, shard, worker, lease)
+            heartbeat.start()
+            # Results are written under a name of this worker's, and only given the shard's name once it is done
+            partial_file = results_file(queue_file, shard) + "." + worker.replace(":", "-") + ".partial"
+            try:
+                with open(partial_file, 'w', encoding='utf-8') as results:
+                    for path, input_folder, case_number in queue.plans(shard):
+                        if heartbeat.lost:
+                            break
+                        try:
+                            message, record = process_plan(path, input_folder, case_number)
+                            line = dict(location=path, message=message, record=record)
+                        except Exception as error:
+                            message = "{:10} {}: {}: {}".format("FAILED", path, type(error).__name__, error)
+                            line = dict(location=path, message=message, error=f"{type(error).__name__}: {error}")
+                        log(message)
+                        results.write(json.dumps(line, default=_to_json) + "\n")
+            finally:
+                heartbeat.stop()
+            # The results only replace the shard's if the shard is still this worker's: if its lease ran out, another
+            # worker may have taken the shard over and saved its own results already
+            if not heartbeat.lost and queue.finish(shard, worker, partial_file):
+                finished += 1
+            else:
+                log(f"Lost the lease on shard {shard}: it is being processed by another worker")
+                os.remove(partial_file)
+
+def wait(queue_file, poll_interval=5.0, log=print):
+    ''' Waits until every shard of a queue is done (or has failed), logging the progress as it changes'''
+    last = None
+    with closing(WorkQueue(queue_file)) as queue:
+        while True:
+            queue.expire()
+            progress = queue.progress()
+            if progress != last:
+                log("Shards: " + ", ".join(f"{progress.get(state, 0)} {state}" for state in (PENDING, LEASED, DONE, FAILED)))
+                last = progress
+            if not progress.get(PENDING) and not progress.get(LEASED):
+                return progress
+            time.sleep(poll_interval)
+
+def merge(queue_file):
+    ''' The results of every finished shard of a queue, in the order of the manifest
+        Yields (shard, result) where result is {location, message, record} for a processed plan,
+        {location, message, error} for a plan which failed, or None for a shard which isn't done
+    '''
+    with closing(WorkQueue(queue_file)) as queue:
+        shards = queue.shards()
+    for shard, state in shards:
+        if state != DONE:
+            yield shard, None
+            continue
+        with open(results_file(queue_file, shard), encoding='utf-8') as results:
+            for line in results:
+                yield shard, json.loads(line)
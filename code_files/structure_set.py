@@ -0,0 +1,165 @@
+''' Module for finding which structures (ROIs) of an RTSTRUCT contain a point
+
+An RTSTRUCT outlines each ROI as a stack of planar contours, one or more on each CT slice. A StructureSet turns
+ROIContourSequence into numpy arrays once, indexed so that a query only looks at the contours that could contain
+the point:
+
+- each ROI keeps its slices sorted by z, so the slice a point lies on is found with a binary search
+- each contour has a bounding box, and only the contours whose box holds the point are tested
+- the point-in-polygon test (even-odd rule, so holes cut out of a contour work) is vectorized over the points
+  and the edges of the contour
+
+Many plans are usually checked against the same structure set (e.g. every plan of a phantom), so load() keeps
+the StructureSets it has parsed, by their SOPInstanceUID. A structure set shared by a batch is only parsed once.
+'''
+
+from collections import OrderedDict
+from code_files import archives
+
+# Tags of the elements read from an RTSTRUCT (the header is read first, to look the structure set up by its UID)
+_SOPInstanceUID = 0x00080018
+_header_tags = [0x00080016, _SOPInstanceUID, 0x00080060]
+
+# The number of parsed structure sets kept by load()
+cache_size = 16
+_cache = OrderedDict()
+
+class Structure:
+    ''' The contours of one ROI
+
+    number      - ROINumber
+    name        - ROIName
+    z           - the sorted z (mm) of each slice with contours
+    contours    - for each slice, a list of (N, 2) arrays of the (x, y) corners of its contours
+    boxes       - for each slice, an (M, 4) array of the (min x, min y, max x, max y) of its M contours
+    tolerance   - how far (mm) from a slice a point can be and still count as on it: half the slice spacing
+    '''
+    def __init__(self, number, name, contours):
+        import numpy as np
+        self.number = number
+        self.name = name
+
+        # Contours are grouped by slice. Slices whose z differ by less than a micron are the same slice.
+        slices = {}
+        for points in contours:
+            slices.setdefault(round(float(points[0, 2]), 3), []).append(np.ascontiguousarray(points[:, :2]))
+        self.z = np.array(sorted(slices))
+        self.contours = [slices[z] for z in self.z]
+        self.boxes = [np.array([np.concatenate([polygon.min(axis=0), polygon.max(axis=0)]) for polygon in polygons])
+                      for polygons in self.contours]
+        spacing = np.diff(self.z)
+        self.tolerance = float(np.median(spacing)) / 2 if len(spacing) else 0.5
+        if len(self.z):
+            self.bounds = np.concatenate([np.min([box[:, :2].min(axis=0) for box in self.boxes], axis=0),
+                                          np.max([box[:, 2:].max(axis=0) for box in self.boxes], axis=0),
+                                          [self.z[0] - self.tolerance, self.z[-1] + self.tolerance]])
+        else:
+            self.bounds = None
+
+    def contains(self, points):
+        ''' Whether each of an (N, 3) array of points (mm, patient coordinates) is inside the ROI
+            Returns an array of N booleans
+        '''
+        import numpy as np
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        inside = np.zeros(len(points), dtype=bool)
+        if self.bounds is None:
+            return inside
+
+        # Points outside the ROI's bounding box are never tested against its contours
+        min_x, min_y, max_x, max_y, min_z, max_z = self.bounds
+        candidates = np.flatnonzero((points[:, 0] >= min_x) & (points[:, 0] <= max_x) & (points[:, 1] >= min_y) &
+                                    (points[:, 1] <= max_y) & (points[:, 2] >= min_z) & (points[:, 2] <= max_z))
+        if not len(candidates):
+            return inside
+
+        # The nearest slice to each point
+        z = points[candidates, 2]
+        above = np.searchsorted(self.z, z)
+        below = np.clip(above - 1, 0, len(self.z) - 1)
+        above = np.clip(above, 0, len(self.z) - 1)
+        nearest = np.where(np.abs(self.z[below] - z) <= np.abs(self.z[above] - z), below, above)
+        on_slice = np.abs(self.z[nearest] - z) <= self.tolerance
+        candidates, nearest = candidates[on_slice], nearest[on_slice]
+
+        for slice_index in np.unique(nearest):
+            chosen = candidates[nearest == slice_index]
+            xy = points[chosen, :2]
+            result = np.zeros(len(chosen), dtype=bool)
+            boxes = self.boxes[slice_index]
+            for polygon, box in zip(self.contours[slice_index], boxes):
+                in_box = (xy[:, 0] >= box[0]) & (xy[:, 0] <= box[2]) & (xy[:, 1] >= box[1]) & (xy[:, 1] <= box[3])
+                if in_box.any():
+                    # Contours are combined with the even-odd rule, so a contour inside another is a hole in it
+                    result[in_box] ^= _in_polygon(xy[in_box], polygon)
+            inside[chosen] = result
+        return inside
+
+def _in_polygon(points, polygon):
+    ''' Whether each of an (N, 2) array of points is inside a polygon given by an (M, 2) array of its corners
+        Counts the polygon's edges crossed by a ray from each point towards +x, for all points and edges at once
+    '''
+    import numpy as np
+    x, y = points[:, 0:1], points[:, 1:2]
+    x1, y1 = polygon[:, 0], polygon[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    straddles = (y1 > y) != (y2 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing_x = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+    crossings = straddles & (x < crossing_x)
+    return crossings.sum(axis=1) % 2 == 1
+
+class StructureSet:
+    ''' The ROIs of an RTSTRUCT, for finding which contain a point
+
+    dataset     - the RTSTRUCT, as a pydicom Dataset
+
+    uid         - the structure set's SOPInstanceUID
+    structures  - {ROIName: Structure}, for every ROI with contours
+    '''
+    def __init__(self, dataset):
+        import numpy as np
+        self.uid = str(dataset.get("SOPInstanceUID", ""))
+        names = dict((int(roi.ROINumber), str(roi.ROIName)) for roi in dataset.get("StructureSetROISequence", []))
+        self.structures = {}
+        for roi in dataset.get("ROIContourSequence", []):
+            number = int(roi.ReferencedROINumber)
+            contours = [np.array(contour.ContourData, dtype=float).reshape(-1, 3)
+                        for contour in roi.get("ContourSequence", [])
+                        if contour.get("ContourGeometricType", "CLOSED_PLANAR") == "CLOSED_PLANAR" and contour.get("ContourData")]
+            if contours:
+                name = names.get(number, str(number))
+                self.structures[name] = Structure(number, name, contours)
+
+    def contains(self, name, points):
+        ''' Whether each of an (N, 3) array of points is inside the ROI with the given name'''
+        return self.structures[name].contains(points)
+
+    def structures_containing(self, point):
+        ''' The names of the ROIs which contain a point (x, y, z), in the order of the structure set'''
+        return [name for name, structure in self.structures.items() if structure.contains([point])[0]]
+
+def load(path):
+    ''' Returns the StructureSet of an RTSTRUCT file, parsing it only if a structure set with the same SOPInstanceUID
+        hasn't been parsed already (by this process)
+    '''
+    from pydicom.filereader import read_partial
+    import pydicom
+    # A structure set in an archive is read from memory (see code_files/archives.py)
+    source = archives.source(path)
+    with (open(path, 'rb') if source is path else source) as fp:
+        header = read_partial(fp, stop_when=lambda tag, VR, length: tag > _SOPInstanceUID, force=True,
+                              specific_tags=_header_tags)
+    uid = header.get("SOPInstanceUID")
+    if uid is not None and str(uid) in _cache:
+        _cache.move_to_end(str(uid))
+        return _cache[str(uid)]
+
+    if source is not path:
+        source.seek(0)
+    structure_set = StructureSet(pydicom.dcmread(source, force=True))
+    if uid is not None:
+        _cache[str(uid)] = structure_set
+        while len(_cache) > cache_size:
+            _cache.popitem(last=False)
+    return structure_set
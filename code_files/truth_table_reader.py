@@ -1,12 +1,24 @@
 ''' Module for parsing the truth table from a csv input into a python dictionary'''
 
-import pandas as pd
-from pathlib import Path
 import csv
+from code_files.parameters.truth_table_rules import CompiledTruthTable
 
 def read_truth_table(truth_table_file):
-    tt = pd.read_csv(truth_table_file, dtype='str')
-    return tt.to_dict('list')
+    ''' Reads the truth table, parsing every value into a rule for evaluation
+        Returns a CompiledTruthTable, which is a dictionary {parameter: [value for each case]}.
+        Any badly formatted values are listed in its errors attribute.
+    '''
+    with open(truth_table_file, newline='', encoding='utf-8-sig') as csv_file:
+        reader = csv.reader(csv_file)
+        headers = next(reader)
+        tt = dict((header, []) for header in headers)
+        for row in reader:
+            # Skip blank lines, such as at the end of the file
+            if not any(row):
+                continue
+            for header, value in zip(headers, row):
+                tt[header].append(value)
+    return CompiledTruthTable(tt)
     
 if __name__ == "__main__":
     tt = read_truth_table("data/truth_table_lvl3.csv")
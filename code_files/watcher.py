@@ -0,0 +1,247 @@
+''' Module for watching folders for new or modified DICOMs
+
+On Linux the folders are watched with inotify (through ctypes, so no extra packages are needed), which wakes the
+watcher as soon as a file in them changes. Elsewhere, or if inotify can't be used, each folder is polled instead:
+one os.scandir every poll_interval seconds, comparing the size and modification time of each file with the last scan.
+
+A file that is still being copied in mustn't be processed, so changed files are only reported once their size and
+modification time have stayed the same for settle_time seconds.
+
+The files watched are the ones a batch run would find in the folders, with the same discovery options (see
+code_files/discovery.py): with recursive, the subfolders are watched too (including those created later), and only
+files matching include and not exclude are reported. With detect, a file is only reported once it has settled if its
+contents look like a DICOM.
+'''
+
+import os
+import select
+import struct
+import time
+from code_files.discovery import find_dicoms, folder_searched, file_found, looks_like_dicom
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_watched_events = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+_event_header = struct.Struct("iIII")
+
+def _scan(folder, discovery):
+    ''' Returns {path: (size, mtime_ns)} for every file in a folder that find_dicoms would find by its name'''
+    include = discovery.get("include") or (["*"] if discovery.get("detect") else ["*.dcm"])
+    files = {}
+    try:
+        for entry in find_dicoms(folder, recursive=discovery.get("recursive", False), include=include,
+                                 exclude=discovery.get("exclude")):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+    except FileNotFoundError:
+        pass
+    return files
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+class _Inotify:
+    ''' Waits for files in the watched folders to change, with the Linux inotify API'''
+    method = "inotify"
+
+    def __init__(self, folders, discovery):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.discovery = discovery
+        # {watch: (folder, the watched folder it is in)}: inotify only watches the folder itself, so each subfolder
+        # searched is watched separately
+        self.folders = {}
+        try:
+            for folder in folders:
+                self._watch(folder, folder)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def _watch(self, folder, root):
+        import ctypes
+        watch = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), _watched_events)
+        if watch < 0:
+            raise OSError(ctypes.get_errno(), f"Could not watch <{folder}> with inotify")
+        self.folders[watch] = (folder, root)
+        if self.discovery.get("recursive"):
+            try:
+                with os.scandir(folder) as entries:
+                    subfolders = [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+            except (PermissionError, FileNotFoundError):
+                return
+            for subfolder in sorted(subfolders):
+                if folder_searched(root, subfolder, True, self.discovery.get("exclude")):
+                    self._watch(subfolder, root)
+
+    def changed(self, timeout):
+        ''' Waits up to timeout seconds for files to change
+            Returns the paths of the files that changed, or None if events were lost and every folder should be scanned
+        '''
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        paths = set()
+        rescan = False
+        offset = 0
+        while offset < len(data):
+            watch, mask, cookie, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if watch not in self.folders:
+                continue
+            folder, root = self.folders[watch]
+            path = os.path.join(folder, name)
+            if mask & IN_ISDIR:
+                # A new subfolder is watched from now on, and scanned for the files put in it before it was watched
+                if self.discovery.get("recursive") and folder_searched(root, path, True, self.discovery.get("exclude")):
+                    try:
+                        self._watch(path, root)
+                    except OSError:
+                        pass
+                    rescan = True
+                continue
+            if file_found(root, path, **self.discovery):
+                paths.add(path)
+        return None if rescan else paths
+
+    def close(self):
+        os.close(self.fd)
+
+class _Polling:
+    ''' Finds files in the watched folders that changed, by scanning the folders every poll_interval seconds'''
+    method = "polling"
+
+    def __init__(self, folders, poll_interval):
+        self.folders = folders
+        self.poll_interval = poll_interval
+        self.next_scan = time.monotonic() + poll_interval
+
+    def changed(self, timeout):
+        # A full scan is returned as None, which tells the FolderWatcher to compare the folders with what it knows
+        delay = self.next_scan - time.monotonic()
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(0, delay))
+        self.next_scan = time.monotonic() + self.poll_interval
+        return None
+
+    def close(self):
+        pass
+
+class FolderWatcher:
+    ''' Watches folders for DICOMs which are created or modified
+
+    folders         - the folders to watch (and their subfolders, with recursive in discovery)
+    settle_time     - the number of seconds a file's size and modification time must stay the same before it is reported
+    poll_interval   - the number of seconds between scans of the folders, if they can't be watched with inotify
+    use_inotify     - whether to try inotify before falling back to polling
+    discovery       - the options for finding DICOMs in the folders, as for find_dicoms (e.g. recursive=True)
+
+    The DICOMs already in the folders when the watcher is created are not reported, unless they are modified.
+    '''
+    def __init__(self, folders, settle_time=2.0, poll_interval=5.0, use_inotify=True, discovery=None):
+        self.folders = [os.path.abspath(folder) for folder in folders]
+        self.settle_time = settle_time
+        self.discovery = dict(discovery or {})
+        self.discovery.pop("threads", None)
+        self.backend = None
+        if use_inotify:
+            try:
+                self.backend = _Inotify(self.folders, self.discovery)
+            except (OSError, AttributeError):
+                # Not Linux, or too many watches: fall back to polling
+                self.backend = None
+        if self.backend is None:
+            self.backend = _Polling(self.folders, poll_interval)
+        self.method = self.backend.method
+
+        # The files already processed (or there from the start), and the files waiting to settle
+        #   known   - {path: (size, mtime_ns)}
+        #   pending - {path: ((size, mtime_ns), time the size and mtime were last seen to change)}
+        self.known = {}
+        for folder in self.folders:
+            self.known.update(_scan(folder, self.discovery))
+        self.pending = {}
+
+    def changes(self):
+        ''' Yields a list of the paths of new or modified DICOMs, each time some have settled. Runs until interrupted.'''
+        while True:
+            ready = self.poll(timeout=1.0)
+            if ready:
+                yield ready
+
+    def poll(self, timeout=None):
+        ''' Waits for changes for up to timeout seconds (less while files are settling)
+            Returns a sorted list of the paths of DICOMs that have changed and settled since the last call
+        '''
+        if self.pending:
+            timeout = self.settle_time / 4 if timeout is None else min(timeout, self.settle_time / 4)
+        changed = self.backend.changed(timeout)
+        now = time.monotonic()
+
+        if changed is None:
+            # Every folder is compared with what is known
+            for folder in self.folders:
+                for path, signature in _scan(folder, self.discovery).items():
+                    if self.known.get(path) != signature and path not in self.pending:
+                        self.pending[path] = (signature, now)
+        else:
+            for path in changed:
+                if path not in self.pending:
+                    self.pending[path] = (None, now)
+
+        ready = []
+        for path, (signature, since) in list(self.pending.items()):
+            current = _stat(path)
+            if current is None:
+                # Deleted (or renamed) before it settled
+                del self.pending[path]
+                self.known.pop(path, None)
+            elif current != signature:
+                self.pending[path] = (current, now)
+            elif now - since >= self.settle_time:
+                del self.pending[path]
+                if self.known.get(path) != current:
+                    self.known[path] = current
+                    # Only files whose contents look like a DICOM are reported, once they're complete
+                    if not self.discovery.get("detect") or looks_like_dicom(path):
+                        ready.append(path)
+        return sorted(ready)
+
+    def close(self):
+        self.backend.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,83 @@
+''' Tests for working out the field shaped by the jaws and MLC of a beam'''
+
+import subprocess
+import sys
+import unittest
+import numpy as np
+from code_files import strings
+from code_files.dicom_loader import read_plan
+from code_files.parameters.aperture import beam_aperture, field_size
+from code_files.parameters.parameter_retrieval import extract_parameters, evaluate_parameters
+from code_files.truth_table_reader import read_truth_table
+
+# Four 10 mm leaf pairs, from y = -20 to 20
+boundaries = {"MLCX": [-20, -10, 0, 10, 20]}
+
+def leaves(left, right):
+    return list(left) + list(right)
+
+class TestAperture(unittest.TestCase):
+
+    def test_jaws(self):
+        aperture = beam_aperture([{"ASYMX": [-60, 60], "ASYMY": [-50, 50]}], {})
+        self.assertEqual(aperture.extents(), (-60, 60, -50, 50))
+        self.assertEqual(field_size(aperture), "10x12")
+        # Sterling's formula gives the side of the square itself for a square field
+        np.testing.assert_allclose(beam_aperture([{"X": [-15, 15], "Y": [-15, 15]}], {}).equivalent_square, [30])
+
+    def test_field_size_rounding(self):
+        # Sizes are rounded to the nearest mm rather than truncated to whole cm, as fields of 1.5x1.5 are in the truth table
+        def jaw_field(x, y):
+            return field_size(beam_aperture([{"ASYMX": [-x / 2, x / 2], "ASYMY": [-y / 2, y / 2]}], {}))
+        self.assertEqual(jaw_field(15, 15), "1.5x1.5")
+        self.assertEqual(jaw_field(100.5, 99.96), "10x10.1")
+        self.assertEqual(jaw_field(120, 100.04), "10x12")
+
+    def test_numpy_deferred(self):
+        # Starting app.py doesn't import numpy: aperture.py is only imported once a field size is extracted
+        check = "import sys, app; sys.exit('numpy' in sys.modules)"
+        self.assertEqual(subprocess.run([sys.executable, "-c", check]).returncode, 0)
+
+    def test_mlc_within_jaws(self):
+        # The two middle leaf pairs are open 30 mm, the outer ones are closed, and the jaws cut the field to x < 10
+        control_points = [{"X": [-100, 10], "Y": [-100, 100], "MLCX": leaves([-5, -20, -20, -5], [-5, 10, 10, -5])}]
+        aperture = beam_aperture(control_points, boundaries)
+        self.assertEqual(aperture.extents(), (-20, 10, -10, 10))
+        np.testing.assert_allclose(aperture.area, [2 * 30 * 10])
+        np.testing.assert_allclose(aperture.perimeter, [2 * (30 + 20)])
+        self.assertEqual(field_size(aperture), "2x3")
+
+    def test_irregular_outline(self):
+        # An L shape: a 40 mm wide strip next to a 10 mm wide one
+        control_points = [{"X": [-100, 100], "Y": [-10, 10], "MLCX": leaves([0, 0, 0, 0], [0, 40, 10, 0])}]
+        aperture = beam_aperture(control_points, boundaries)
+        np.testing.assert_allclose(aperture.area, [500])
+        np.testing.assert_allclose(aperture.perimeter, [2 * (40 + 20)])
+        np.testing.assert_allclose(aperture.equivalent_square, [4 * 500 / 120])
+
+    def test_carried_forward(self):
+        # Devices that don't move aren't listed again, and the field of the beam covers every control point
+        control_points = [{"X": [-50, 50], "Y": [-20, 20], "MLCX": leaves([-10] * 4, [10] * 4)},
+                          {"MLCX": leaves([-40] * 4, [-20] * 4)},
+                          {}]
+        aperture = beam_aperture(control_points, boundaries)
+        np.testing.assert_allclose(aperture.x1, [-10, -40, -40])
+        np.testing.assert_allclose(aperture.y2, [20, 20, 20])
+        self.assertEqual(aperture.extents(), (-40, 10, -20, 20))
+
+    def test_closed(self):
+        control_points = [{"X": [-50, 50], "Y": [-20, 20], "MLCX": leaves([0] * 4, [0.5] * 4)}]
+        aperture = beam_aperture(control_points, boundaries)
+        self.assertTrue(np.isnan(aperture.x1[0]))
+        self.assertIsNone(field_size(aperture))
+        self.assertIsNone(beam_aperture([{"MLCX": leaves([0] * 4, [10] * 4)}], {}))
+
+    def test_mlc_plan(self):
+        # Case 1 is a 10x10 field shaped by the MLC, within the Y jaws
+        truth_table = read_truth_table("data/truth_table_lvl3.csv")
+        parameters = extract_parameters(read_plan("data/samples2/YellowLvlIII_1a.dcm"), None, 1)
+        self.assertEqual(parameters[strings.field_size], "10x10")
+        self.assertEqual(evaluate_parameters(parameters, truth_table, 1)[strings.field_size], strings.PASS)
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,117 @@
+''' Tests for the high level processing of locations in app.py'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import app
+from code_files.result_cache import ResultCache
+from code_files.truth_table_reader import read_truth_table
+from tests.test_dose_grid import write_dose_grid
+
+class TestParallelProcessing(unittest.TestCase):
+    ''' Tests that processing a folder with a pool of workers, or in a pipeline, gives the same results as processing it serially'''
+
+    @classmethod
+    def setUpClass(self):
+        self.truth_table = read_truth_table("data/truth_table_lvl3.csv")
+        self.paths = [os.path.join("tests/resources", name) for name in ("YellowLvlIII_7a.dcm", "YellowLvlIII_7b.dcm")]
+
+    def setUp(self):
+        self.serial_output = tempfile.mkdtemp()
+        self.parallel_output = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.serial_output)
+        shutil.rmtree(self.parallel_output)
+
+    def test_parallel_matches_serial(self):
+        serial = [app.process_dicom(path, self.serial_output, 7, self.truth_table, None) for path in self.paths]
+        parallel = list(app.process_in_parallel(self.paths, self.parallel_output, 7, self.truth_table, None, 2))
+
+        # Results come back in the order the paths were given
+        self.assertEqual([message.replace(self.serial_output, "") for message, record in serial],
+                         [message.replace(self.parallel_output, "") for message, record in parallel])
+        self.assertEqual([record for message, record in serial], [record for message, record in parallel])
+        for name in os.listdir(self.serial_output):
+            with open(os.path.join(self.serial_output, name)) as serial_file, \
+                 open(os.path.join(self.parallel_output, name)) as parallel_file:
+                self.assertEqual(serial_file.read(), parallel_file.read())
+
+    def test_pipelined_matches_serial(self):
+        serial = [app.process_dicom(path, self.serial_output, 7, self.truth_table, None) for path in self.paths]
+        pipelined = list(app.process_pipelined(self.paths, self.parallel_output, 7, self.truth_table, None, 2))
+
+        self.assertEqual([message.replace(self.serial_output, "") for message, record in serial],
+                         [message.replace(self.parallel_output, "") for message, record in pipelined])
+        self.assertEqual([record for message, record in serial], [record for message, record in pipelined])
+
+class TestSeveralTruthTables(unittest.TestCase):
+    ''' Tests that evaluating plans against several truth tables and cases gives the same results as separate runs'''
+
+    @classmethod
+    def setUpClass(self):
+        self.tables = dict((name, read_truth_table(f"data/{name}.csv")) for name in ("truth_table_lvl3", "truth_table_lvl2"))
+        self.path = "tests/resources/YellowLvlIII_7b.dcm"
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output)
+        self.addCleanup(setattr, app, "truth_tables", app.truth_tables)
+        app.truth_tables = list(self.tables.items())
+
+    def test_matches_separate_runs(self):
+        message, record = app.process_dicom(self.path, self.output, [6, 7], None, None)
+        self.assertEqual([(result["truth_table"], result["case"]) for result in record["results"]],
+                         [("truth_table_lvl3", 6), ("truth_table_lvl3", 7), ("truth_table_lvl2", 6), ("truth_table_lvl2", 7)])
+        app.truth_tables = None
+        for result in record["results"]:
+            single = app.process_dicom(self.path, self.output, result["case"], self.tables[result["truth_table"]], None)[1]
+            self.assertEqual(dict(single, truth_table=result["truth_table"]),
+                             dict(result, location=self.path, identifiers=record["identifiers"]))
+
+    def test_extracted_once(self):
+        # Cases 6 and 7 are both extracted the same way, so the plan is only extracted once for all four evaluations
+        with mock.patch("code_files.parameters.parameter_retrieval.extract_parameters",
+                        wraps=app.extract_parameters) as extract:
+            app.process_dicom(self.path, self.output, [6, 7], None, None)
+        self.assertEqual(extract.call_count, 1)
+
+class TestCachedResults(unittest.TestCase):
+    ''' Tests that plans processed before are reported the same way from the result cache'''
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.addCleanup(setattr, app, "result_cache", app.result_cache)
+        self.path = "tests/resources/YellowLvlIII_7b.dcm"
+
+    def process(self, truth_table_file):
+        app.result_cache = ResultCache(os.path.join(self.folder, "results.sqlite"), truth_table_file, 1024 * 1024)
+        message, record = app.process_dicom(self.path, self.folder, 7, read_truth_table(truth_table_file), None)
+        with open(os.path.join(self.folder, "YellowLvlIII_7b.csv")) as report:
+            return message, report.read()
+
+    def test_report_rewritten(self):
+        # The report left by a run against another truth table is replaced by the cached results' report
+        message, lvl3_report = self.process("data/truth_table_lvl3.csv")
+        self.assertTrue(message.startswith("EXTRACTED"))
+        lvl2_report = self.process("data/truth_table_lvl2.csv")[1]
+        self.assertNotEqual(lvl2_report, lvl3_report)
+        message, report = self.process("data/truth_table_lvl3.csv")
+        self.assertTrue(message.startswith("CACHED"))
+        self.assertEqual(report, lvl3_report)
+
+    def test_other_files_not_hashed(self):
+        # Files which aren't plans are skipped by their header, without reading (and hashing) all of them
+        dose_path = os.path.join(self.folder, "dose.dcm")
+        write_dose_grid(dose_path)
+        app.result_cache = ResultCache(os.path.join(self.folder, "results.sqlite"), "data/truth_table_lvl3.csv", 1024 * 1024)
+        with mock.patch("code_files.result_cache.file_digest") as digest:
+            message, record = app.process_dicom(dose_path, self.folder, 7, read_truth_table("data/truth_table_lvl3.csv"), None)
+        self.assertTrue(message.startswith("SKIPPED"))
+        digest.assert_not_called()
+
+if __name__ == '__main__' :
+    unittest.main()
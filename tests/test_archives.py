@@ -0,0 +1,136 @@
+''' Tests for reading DICOMs straight out of zip and tar archives'''
+
+import mmap
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+import numpy as np
+import app
+from code_files import archives, strings
+from code_files.dicom_loader import read_header
+from code_files.discovery import find_dicoms
+from code_files.dose_grid import DoseGrid
+from code_files.dose_struct_index import build_index
+from code_files.truth_table_reader import read_truth_table
+from tests.test_dose_grid import write_dose_grid, linear_dose
+
+plans = ["YellowLvlIII_7a.dcm", "YellowLvlIII_7b.dcm"]
+
+class TestArchives(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.folder = tempfile.mkdtemp()
+        self.dose_path = os.path.join(self.folder, "dose.dcm")
+        write_dose_grid(self.dose_path)
+        self.archives = {}
+        for name, compression in (("stored.zip", zipfile.ZIP_STORED), ("deflated.zip", zipfile.ZIP_DEFLATED)):
+            path = self.archives[name] = os.path.join(self.folder, name)
+            with zipfile.ZipFile(path, "w", compression) as archive:
+                for plan in plans:
+                    archive.write(os.path.join("tests/resources", plan), f"set1/{plan}")
+                archive.write(self.dose_path, "set1/doses/dose.dcm")
+                archive.writestr("set1/notes.txt", "not a DICOM")
+        for name, mode in (("plans.tar", "w"), ("plans.tar.gz", "w:gz")):
+            path = self.archives[name] = os.path.join(self.folder, name)
+            with tarfile.open(path, mode) as archive:
+                for plan in plans:
+                    archive.add(os.path.join("tests/resources", plan), f"set1/{plan}")
+                archive.add(self.dose_path, "set1/doses/dose.dcm")
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.folder)
+
+    def test_split_member(self):
+        self.assertEqual(archives.split_member("in/plans.zip!set1/RP1.dcm"), ("in/plans.zip", "set1/RP1.dcm"))
+        self.assertEqual(archives.split_member("in/plans.tar.gz!RP!1.dcm"), ("in/plans.tar.gz", "RP!1.dcm"))
+        self.assertIsNone(archives.split_member("in/RP!1.dcm"))
+
+    def test_find_dicoms(self):
+        for name, path in self.archives.items():
+            with self.subTest(name):
+                members = [member.member for member in find_dicoms(path)]
+                self.assertEqual(members, [f"set1/{plan}" for plan in plans] + ["set1/doses/dose.dcm"])
+                # Patterns are matched against the paths within the archive
+                self.assertEqual([member.name for member in find_dicoms(path, exclude=["*/doses/*"], include=["*7b*"])],
+                                 ["YellowLvlIII_7b.dcm"])
+        self.assertEqual(len(list(find_dicoms(self.archives["stored.zip"], detect=True))), 3)
+
+    def test_zero_copy(self):
+        # Stored members are views of the mapped archive, while compressed ones are decompressed
+        location = self.archives["stored.zip"] + "!set1/YellowLvlIII_7a.dcm"
+        contents = archives.read_member(location)
+        self.assertIsInstance(contents, memoryview)
+        self.assertIsInstance(contents.obj, mmap.mmap)
+        with open("tests/resources/YellowLvlIII_7a.dcm", 'rb') as plan:
+            self.assertEqual(contents, plan.read())
+        self.assertIsInstance(archives.read_member(self.archives["plans.tar"] + "!set1/YellowLvlIII_7a.dcm"), memoryview)
+        self.assertIsInstance(archives.read_member(self.archives["plans.tar.gz"] + "!set1/YellowLvlIII_7a.dcm"), bytes)
+        self.assertEqual(str(read_header(location).Modality), "RTPLAN")
+
+    def test_dose_grid(self):
+        for name in ("stored.zip", "plans.tar.gz"):
+            with self.subTest(name), DoseGrid(self.archives[name] + "!set1/doses/dose.dcm") as grid:
+                points = np.array([[-20.0, -30.0, -10.0], [1.25, -10.0, 0.5]])
+                np.testing.assert_allclose(grid.doses(points), linear_dose(*points.T), atol=1e-4)
+        # The voxels of a stored member are an array over the mapped archive
+        with DoseGrid(self.archives["stored.zip"] + "!set1/doses/dose.dcm") as grid:
+            base = grid.pixels
+            while isinstance(base, np.ndarray):
+                base = base.base
+            self.assertIsInstance(base.obj, mmap.mmap)
+
+    def test_dose_struct_index(self):
+        index = build_index(self.archives["deflated.zip"])
+        self.assertEqual(list(index.values())[0][strings.RTDOSE],
+                         [os.path.abspath(self.archives["deflated.zip"]) + "!set1/doses/dose.dcm"])
+
+    def test_matches_folder(self):
+        truth_table = read_truth_table("data/truth_table_lvl3.csv")
+        output = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output)
+        for name, path in self.archives.items():
+            with self.subTest(name):
+                for plan in plans:
+                    message, record = app.process_dicom(f"{path}!set1/{plan}", output, 7, truth_table, None, path)
+                    expected = app.process_dicom(os.path.join("tests/resources", plan), output, 7, truth_table, None)[1]
+                    self.assertEqual(dict(record, location=None), dict(expected, location=None))
+                    # Reports are saved in the same folders as the members within the archive
+                    self.assertTrue(message.endswith(os.path.join(output, "set1", plan.replace(".dcm", ".csv"))))
+
+    def test_report_names(self):
+        # Members at the top of an archive, and members whose names try to leave the output folder
+        truth_table = read_truth_table("data/truth_table_lvl3.csv")
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        output = os.path.join(folder, "reports", "run")
+        path = os.path.join(folder, "hostile.zip")
+        with open("tests/resources/YellowLvlIII_7a.dcm", 'rb') as plan:
+            contents = plan.read()
+        # ZipInfo keeps names as they are given, where ZipFile.write would tidy them up
+        with zipfile.ZipFile(path, "w") as archive:
+            for name in ("RP7a.dcm", "../../escaped/RP7b.dcm", "/absolute/RP7c.dcm", "set1/../../../up/RP7d.dcm"):
+                archive.writestr(zipfile.ZipInfo(name), contents)
+        self.assertEqual(archives.member_folder("../../escaped/RP7b.dcm"), "escaped")
+        self.assertEqual(archives.member_folder("/absolute/RP7c.dcm"), "absolute")
+        self.assertEqual(archives.member_folder("RP7a.dcm"), os.curdir)
+
+        os.makedirs(output)
+        messages = [app.process_dicom(member.path, output, 7, truth_table, None, path)[0] for member in find_dicoms(path)]
+        self.assertEqual(len(messages), 4)
+        self.assertTrue(messages[0].endswith(os.path.join(output, "RP7a.csv")))
+        self.assertTrue(messages[1].endswith(os.path.join(output, "escaped", "RP7b.csv")))
+        self.assertTrue(messages[2].endswith(os.path.join(output, "absolute", "RP7c.csv")))
+        self.assertTrue(messages[3].endswith(os.path.join(output, "up", "RP7d.csv")))
+        # A member given as an input by itself is named after the member too, not the archive
+        message = app.process_dicom(path + "!RP7a.dcm", output, 7, truth_table, None)[0]
+        self.assertTrue(message.endswith(os.path.join(output, "RP7a.csv")))
+        self.assertEqual(sorted(os.listdir(folder)), ["hostile.zip", "reports"])
+        self.assertEqual(os.listdir(os.path.join(folder, "reports")), ["run"])
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,91 @@
+''' Tests for working out the case of a plan without asking for it'''
+
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+import app
+from code_files.case_classifier import ReviewList, classify, label_case
+from code_files.dicom_loader import read_plan
+from code_files.truth_table_reader import read_truth_table
+
+samples = {
+    'data/samples/YellowLvlIII_7a.dcm': 7,
+    'data/samples/YellowLvlIII_7b.dcm': 7,
+    'data/samples2/YellowLvlIII_1a.dcm': 1,
+    'data/samples2/YellowLvlIII_2a.dcm': 2,
+    'data/samples2/YellowLvlIII_3c6FFF.dcm': 3,
+    'data/samples2/YellowLvlIII_8b.dcm': 8,
+}
+
+def unnamed(path):
+    ''' The plan with its name and label removed'''
+    dataset = read_plan(path)
+    dataset.RTPlanName = dataset.RTPlanLabel = "plan"
+    return dataset
+
+class TestCaseClassifier(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.truth_table = read_truth_table("data/truth_table_lvl3.csv")
+
+    def test_label_case(self):
+        dataset = read_plan('data/samples2/YellowLvlIII_8aColls5.dcm')
+        self.assertEqual(label_case(dataset), 8)
+        self.assertEqual(label_case(unnamed('data/samples/YellowLvlIII_7a.dcm'), "exports/QA_12b.dcm"), 12)
+        self.assertIsNone(label_case(unnamed('data/samples/YellowLvlIII_7a.dcm')))
+
+    def test_samples(self):
+        for path, case in samples.items():
+            with self.subTest(path=path):
+                classification = classify(read_plan(path), self.truth_table, path)
+                self.assertEqual(classification.case, case)
+                self.assertTrue(classification.confident)
+
+    def test_contents_alone(self):
+        # Static field cases are told apart by their beams, even without a name
+        classification = classify(unnamed('data/samples2/YellowLvlIII_3a.dcm'), self.truth_table)
+        self.assertEqual((classification.case, classification.confident), (3, True))
+
+    def test_unclear(self):
+        # Cases 6, 7 and 8 only differ in parts of the plan that aren't extracted yet
+        classification = classify(unnamed('data/samples/YellowLvlIII_7b.dcm'), self.truth_table)
+        self.assertFalse(classification.confident)
+        self.assertEqual(classification.case, 6)
+        self.assertEqual([case for case, score in classification.alternatives[:2]], [7, 8])
+
+    def test_review_list(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        review_list = ReviewList(os.path.join(folder, "review.csv"))
+        review_list.add("anonymous.dcm", classify(unnamed('data/samples/YellowLvlIII_7b.dcm'), self.truth_table))
+        review_list.close()
+        with open(review_list.filepath, newline='') as review_file:
+            rows = list(csv.reader(review_file))
+        self.assertEqual(rows[0], ReviewList.header)
+        self.assertEqual(rows[1][:2], ["anonymous.dcm", "6"])
+
+class TestAutoCase(unittest.TestCase):
+
+    def setUp(self):
+        self.truth_table = read_truth_table("data/truth_table_lvl3.csv")
+        self.output = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output)
+        self.addCleanup(setattr, app, "auto_case", app.auto_case)
+        app.auto_case = True
+
+    def test_process_dicom(self):
+        path = 'data/samples2/YellowLvlIII_8b.dcm'
+        message, record = app.process_dicom(path, self.output, None, self.truth_table, None)
+        self.assertEqual(record["case"], 8)
+        self.assertEqual(record, app.process_dicom(path, self.output, 8, self.truth_table, None)[1])
+
+    def test_review(self):
+        path = os.path.join(self.output, "anonymous.dcm")
+        unnamed('data/samples/YellowLvlIII_7b.dcm').save_as(path)
+        message, record = app.process_dicom(path, self.output, None, self.truth_table, None)
+        self.assertTrue(message.startswith("REVIEW"))
+        self.assertEqual(record["location"], path)
+        self.assertFalse(record["review"].confident)
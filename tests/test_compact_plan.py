@@ -0,0 +1,100 @@
+''' Tests for streaming the control points of plans into arrays, and for keeping a batch within a memory limit'''
+
+import io
+import os
+import unittest
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian, ImplicitVRLittleEndian
+from code_files import memory
+from code_files.compact_plan import read_compact_plan
+from code_files.dicom_loader import plan_tags, read_plan
+from code_files.parameters.parameter_retrieval import extract_parameters
+
+samples = ['data/samples/YellowLvlIII_7a.dcm', 'data/samples/YellowLvlIII_7b.dcm',
+           'data/samples2/YellowLvlIII_8b.dcm', 'data/samples2/YellowLvlIII_8aColls5.dcm']
+
+def saved(dataset, transfer_syntax):
+    ''' The dataset written with file meta information in the given transfer syntax'''
+    dataset.file_meta = FileMetaDataset()
+    dataset.file_meta.TransferSyntaxUID = transfer_syntax
+    dataset.file_meta.MediaStorageSOPClassUID = dataset.SOPClassUID
+    dataset.file_meta.MediaStorageSOPInstanceUID = dataset.SOPInstanceUID
+    data = io.BytesIO()
+    dataset.save_as(data, enforce_file_format=True)
+    data.seek(0)
+    return data
+
+def with_ssd(dataset):
+    ''' The dataset with a dose point SSD at every control point, which none of the sample plans have'''
+    for beam in dataset.BeamSequence:
+        for index, control_point in enumerate(beam.ControlPointSequence):
+            dose_point = Dataset()
+            dose_point.BeamDosePointSSD = 900 + index
+            control_point.ReferencedDoseReferenceSequence = Sequence([Dataset(), dose_point])
+    return dataset
+
+class TestCompactPlan(unittest.TestCase):
+
+    def test_same_parameters(self):
+        for path in samples:
+            with self.subTest(path=path):
+                self.assertEqual(extract_parameters(read_plan(path, low_memory=True), None, 1),
+                                 extract_parameters(read_plan(path), None, 1))
+
+    def test_control_points(self):
+        full = with_ssd(pydicom.dcmread('data/samples2/YellowLvlIII_8b.dcm', force=True))
+        compact = read_compact_plan(saved(full, ImplicitVRLittleEndian), plan_tags())
+        for compact_beam, beam in zip(compact.BeamSequence, full.BeamSequence):
+            gantry, ssd, devices = compact_beam.compact_control_points
+            self.assertEqual(list(gantry), [float(control_point.GantryAngle) for control_point in beam.ControlPointSequence])
+            self.assertEqual(list(ssd), [round((900 + index)/10, 2) for index in range(len(beam.ControlPointSequence))])
+            self.assertEqual([dict((device, list(positions)) for device, positions in control_point.items()) for control_point in devices],
+                             [dict((device.RTBeamLimitingDeviceType, [float(position) for position in device.LeafJawPositions])
+                                   for device in control_point.get("BeamLimitingDevicePositionSequence", []))
+                              for control_point in beam.ControlPointSequence])
+            # Only the first control points are kept as datasets
+            self.assertEqual(len(compact_beam.ControlPointSequence), min(2, len(beam.ControlPointSequence)))
+            self.assertEqual(compact_beam.ControlPointSequence[0], beam.ControlPointSequence[0])
+
+    def test_explicit_vr(self):
+        dataset = with_ssd(pydicom.dcmread('data/samples2/YellowLvlIII_8b.dcm', force=True))
+        data = saved(dataset, ExplicitVRLittleEndian)
+        compact = read_compact_plan(data, plan_tags())
+        data.seek(0)
+        self.assertEqual(extract_parameters(compact, None, 1), extract_parameters(read_plan(data), None, 1))
+
+    def test_missing_values(self):
+        # As with a normal read, an array is None if any control point is missing its value
+        dataset = with_ssd(pydicom.dcmread('data/samples2/YellowLvlIII_8b.dcm', force=True))
+        del dataset.BeamSequence[0].ControlPointSequence[5].GantryAngle
+        compact = read_compact_plan(saved(dataset, ImplicitVRLittleEndian), plan_tags())
+        gantry, ssd, devices = compact.BeamSequence[0].compact_control_points
+        self.assertIsNone(gantry)
+        self.assertIsNotNone(ssd)
+
+    def test_unsupported_transfer_syntax(self):
+        dataset = pydicom.dcmread('data/samples/YellowLvlIII_7a.dcm', force=True)
+        data = saved(dataset, DeflatedExplicitVRLittleEndian)
+        self.assertIsNone(read_compact_plan(data, plan_tags()))
+        # A normal read is used instead
+        data.seek(0)
+        self.assertEqual(read_plan(data, low_memory=True).BeamSequence, dataset.BeamSequence)
+
+class TestMemory(unittest.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(memory.parse_size("512MB"), 512 * 1024**2)
+        self.assertEqual(memory.parse_size("2G"), 2 * 1024**3)
+        self.assertEqual(memory.parse_size("1.5 GB"), 3 * 1024**3 // 2)
+        self.assertEqual(memory.parse_size("4096"), 4096)
+        with self.assertRaises(ValueError):
+            memory.parse_size("lots")
+
+    @unittest.skipIf(memory.rss() is None, "memory use can't be measured here")
+    def test_guard(self):
+        self.assertGreater(memory.rss(), 0)
+        self.assertFalse(memory.MemoryGuard(1024**4).over())
+        self.assertTrue(memory.MemoryGuard(1).over([os.getpid()]))
+        self.assertFalse(memory.MemoryGuard(1).wait(timeout=0.05))
@@ -0,0 +1,66 @@
+''' Tests for reading only the needed parts of DICOM files'''
+
+import os
+import tempfile
+import unittest
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from code_files import strings
+from code_files.dicom_loader import read_header, read_plan
+from code_files.parameters.parameter_retrieval import extract_parameters
+
+def write_dose_file(path, study_uid):
+    ''' Writes a minimal RTDOSE with a large block of pixel data'''
+    dataset = Dataset()
+    dataset.file_meta = FileMetaDataset()
+    dataset.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.481.2"
+    dataset.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    dataset.Modality = strings.RTDOSE
+    dataset.StudyInstanceUID = study_uid
+    dataset.SeriesInstanceUID = generate_uid()
+    dataset.BitsAllocated = 16
+    dataset.PixelData = bytes(1024 * 1024)
+    dataset.save_as(path)
+
+class TestReadHeader(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.dose_path = os.path.join(self.folder.name, "dose.dcm")
+        write_dose_file(self.dose_path, "1.2.3.4")
+
+    @classmethod
+    def tearDownClass(self):
+        self.folder.cleanup()
+
+    def test_plan_header(self):
+        header = read_header('tests/resources/YellowLvlIII_7a.dcm')
+        full = pydicom.dcmread('tests/resources/YellowLvlIII_7a.dcm', force=True)
+        self.assertEqual(header.Modality, "RTPLAN")
+        self.assertEqual(header.StudyInstanceUID, full.StudyInstanceUID)
+        self.assertNotIn("BeamSequence", header)
+
+    def test_dose_header(self):
+        # The pixel data of a non-plan file should never be read
+        header = read_header(self.dose_path)
+        self.assertEqual(header.Modality, strings.RTDOSE)
+        self.assertEqual(header.StudyInstanceUID, "1.2.3.4")
+        self.assertNotIn("PixelData", header)
+
+class TestReadPlan(unittest.TestCase):
+
+    def test_only_needed_tags(self):
+        dataset = read_plan('tests/resources/YellowLvlIII_7a.dcm')
+        self.assertIn("BeamSequence", dataset)
+        self.assertNotIn("PatientName", dataset)
+
+    def test_same_extraction_as_full_read(self):
+        for path in ('tests/resources/YellowLvlIII_7a.dcm', 'tests/resources/YellowLvlIII_7b.dcm'):
+            full = pydicom.dcmread(path, force=True)
+            self.assertEqual(extract_parameters(read_plan(path), {}, 7), extract_parameters(full, {}, 7))
+
+if __name__ == '__main__' :
+    unittest.main()
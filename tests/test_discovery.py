@@ -0,0 +1,63 @@
+''' Tests for finding the DICOMs in a folder'''
+
+import os
+import shutil
+import tempfile
+import types
+import unittest
+from code_files.discovery import find_dicoms, looks_like_dicom
+
+class TestFindDicoms(unittest.TestCase):
+
+    def setUp(self):
+        # folder/
+        #     plan.dcm, notes.txt
+        #     patient1/study1/RP1 (a plan without an extension), RP1.bak (a plan)
+        #     patient2/old/plan.dcm
+        #     patient2/z.dcm (not a DICOM), a.dcm (with a preamble)
+        self.folder = tempfile.mkdtemp()
+        plan = 'tests/resources/YellowLvlIII_7a.dcm'
+        for path in ["plan.dcm", "patient1/study1/RP1", "patient1/study1/RP1.bak", "patient2/old/plan.dcm"]:
+            os.makedirs(os.path.dirname(self.path(path)), exist_ok=True)
+            shutil.copy(plan, self.path(path))
+        for path, data in [("notes.txt", b"notes"), ("patient2/z.dcm", b"not a dicom at all"),
+                           ("patient2/a.dcm", bytes(128) + b"DICM" + bytes(16))]:
+            with open(self.path(path), 'wb') as file:
+                file.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def path(self, relative_path):
+        return os.path.join(self.folder, *relative_path.split("/"))
+
+    def found(self, **options):
+        return [os.path.relpath(entry.path, self.folder).replace(os.sep, "/") for entry in find_dicoms(self.folder, **options)]
+
+    def test_top_level(self):
+        self.assertEqual(self.found(), ["plan.dcm"])
+
+    def test_recursive(self):
+        self.assertEqual(self.found(recursive=True),
+                         ["plan.dcm", "patient2/a.dcm", "patient2/z.dcm", "patient2/old/plan.dcm"])
+
+    def test_include_exclude(self):
+        self.assertEqual(self.found(recursive=True, include=["RP*"], exclude=["*.bak"]), ["patient1/study1/RP1"])
+        self.assertEqual(self.found(recursive=True, exclude=["old", "patient2/?.dcm"]), ["plan.dcm"])
+
+    def test_detect(self):
+        self.assertEqual(self.found(recursive=True, detect=True),
+                         ["plan.dcm", "patient1/study1/RP1", "patient1/study1/RP1.bak", "patient2/a.dcm", "patient2/old/plan.dcm"])
+        self.assertFalse(looks_like_dicom(self.path("notes.txt")))
+
+    def test_threaded_walk(self):
+        self.assertIsInstance(find_dicoms(self.folder, recursive=True, threads=4), types.GeneratorType)
+        for options in [dict(recursive=True), dict(recursive=True, detect=True), dict(recursive=True, exclude=["old"])]:
+            self.assertEqual(self.found(threads=4, **options), self.found(**options))
+
+    def test_missing_folder(self):
+        with self.assertRaises(FileNotFoundError):
+            list(find_dicoms(self.path("missing")))
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,96 @@
+''' Tests for looking up doses in a memory-mapped RTDOSE grid'''
+
+import os
+import tempfile
+import unittest
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian, generate_uid
+from code_files import strings
+from code_files.dose_grid import DoseGrid
+
+# A dose which changes linearly in each direction, so trilinear interpolation of it is exact
+def linear_dose(x, y, z):
+    return 2.0 + 0.01 * x + 0.02 * y + 0.05 * z
+
+def write_dose_grid(path, origin=(-20.0, -30.0, -10.0), spacing=(2.5, 2.0), offsets=None, shape=(6, 10, 12),
+                    scaling=1e-4, transfer_syntax=ExplicitVRLittleEndian):
+    ''' Writes an RTDOSE whose grid holds linear_dose at each voxel centre. spacing is PixelSpacing (rows, columns).'''
+    frames, rows, columns = shape
+    offsets = offsets if offsets is not None else [3.0 * frame for frame in range(frames)]
+    z = origin[2] + np.array(offsets) if offsets[0] == 0 else np.array(offsets)
+    y = origin[1] + spacing[0] * np.arange(rows)
+    x = origin[0] + spacing[1] * np.arange(columns)
+    dose = linear_dose(x[None, None, :], y[None, :, None], z[:, None, None])
+
+    dataset = Dataset()
+    dataset.file_meta = FileMetaDataset()
+    dataset.file_meta.TransferSyntaxUID = transfer_syntax
+    dataset.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.481.2"
+    dataset.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    dataset.Modality = strings.RTDOSE
+    dataset.StudyInstanceUID = generate_uid()
+    dataset.ImagePositionPatient = list(origin)
+    dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dataset.NumberOfFrames = frames
+    dataset.GridFrameOffsetVector = list(offsets)
+    dataset.Rows, dataset.Columns = rows, columns
+    dataset.PixelSpacing = list(spacing)
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = "MONOCHROME2"
+    dataset.BitsAllocated = dataset.BitsStored = 32
+    dataset.HighBit = 31
+    dataset.PixelRepresentation = 0
+    dataset.DoseUnits = "GY"
+    dataset.DoseGridScaling = scaling
+    dataset.PixelData = np.round(dose / scaling).astype("<u4").tobytes()
+    dataset.save_as(path, enforce_file_format=True)
+
+class TestDoseGrid(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "dose.dcm")
+        write_dose_grid(self.path)
+
+    @classmethod
+    def tearDownClass(self):
+        self.folder.cleanup()
+
+    def test_memory_mapped(self):
+        with DoseGrid(self.path) as grid:
+            self.assertEqual(grid.shape, (6, 10, 12))
+            self.assertIsInstance(grid.pixels, np.memmap)
+            # The pixel data is left in the file
+            self.assertIsNone(grid.dataset.get_item(0x7FE00010, keep_deferred=True).value)
+
+    def test_voxel_centres(self):
+        with DoseGrid(self.path) as grid:
+            self.assertAlmostEqual(grid.dose((-20.0, -30.0, -10.0)), linear_dose(-20.0, -30.0, -10.0), places=3)
+            self.assertAlmostEqual(grid.dose((-4.0, -15.0, 5.0)), linear_dose(-4.0, -15.0, 5.0), places=3)
+
+    def test_interpolated(self):
+        points = np.array([(-18.7, -29.1, -9.2), (0.3, -20.6, 1.4), (1.9, -8.0, 4.9)])
+        with DoseGrid(self.path) as grid:
+            np.testing.assert_allclose(grid.doses(points), linear_dose(*points.T), atol=1e-3)
+
+    def test_outside(self):
+        with DoseGrid(self.path) as grid:
+            doses = grid.doses([(0.0, 0.0, 100.0), (-25.0, -20.0, 0.0), (0.0, -20.0, 0.0)])
+            self.assertTrue(np.isnan(doses[0]))
+            self.assertTrue(np.isnan(doses[1]))
+            self.assertAlmostEqual(doses[2], linear_dose(0.0, -20.0, 0.0), places=3)
+
+    def test_absolute_descending_frames(self):
+        # GridFrameOffsetVector may hold the z of each frame, in descending order
+        path = os.path.join(self.folder.name, "descending.dcm")
+        write_dose_grid(path, origin=(-20.0, -30.0, 5.0), offsets=[5.0, 2.0, -1.0, -4.0], shape=(4, 10, 12),
+                        transfer_syntax=ImplicitVRLittleEndian)
+        with DoseGrid(path) as grid:
+            self.assertAlmostEqual(grid.dose((0.0, -20.0, -2.5)), linear_dose(0.0, -20.0, -2.5), places=3)
+            self.assertTrue(np.isnan(grid.dose((0.0, -20.0, 6.0))))
+
+    def test_max_dose(self):
+        with DoseGrid(self.path) as grid:
+            self.assertAlmostEqual(grid.max_dose(), linear_dose(2.0, -7.5, 5.0), places=3)
@@ -0,0 +1,77 @@
+''' Tests for the persistent index of dose and structure files'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from code_files import strings
+from code_files import dose_struct_index
+from code_files.dose_struct_index import build_index, update_index
+from tests.test_dicom_loader import write_dose_file
+
+class TestDoseStructIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.folder, "index.sqlite")
+        shutil.copy('tests/resources/YellowLvlIII_7a.dcm', self.folder)
+        self.dose_path = os.path.join(self.folder, "dose.dcm")
+        write_dose_file(self.dose_path, "1.2.3.4")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def build_counting_reads(self):
+        ''' Builds the index, returning it along with the number of headers that had to be read'''
+        with mock.patch.object(dose_struct_index, "read_header", wraps=dose_struct_index.read_header) as read_header:
+            index = build_index(self.folder, self.index_file)
+        return index, read_header.call_count
+
+    def test_index_contents(self):
+        index, _ = self.build_counting_reads()
+        self.assertEqual(list(index), ["1.2.3.4"])
+        self.assertEqual(index["1.2.3.4"][strings.RTDOSE], [os.path.abspath(self.dose_path)])
+        self.assertEqual(index["1.2.3.4"][strings.RTSTRUCT], [])
+
+    def test_unchanged_files_not_reread(self):
+        _, first_reads = self.build_counting_reads()
+        index, second_reads = self.build_counting_reads()
+        self.assertEqual(first_reads, 2)
+        self.assertEqual(second_reads, 0)
+        self.assertIn("1.2.3.4", index)
+
+    def test_changed_and_removed_files(self):
+        self.build_counting_reads()
+        write_dose_file(self.dose_path, "5.6.7.8")
+        os.utime(self.dose_path, ns=(0, 0))
+        index, reads = self.build_counting_reads()
+        self.assertEqual(reads, 1)
+        self.assertEqual(list(index), ["5.6.7.8"])
+
+        os.remove(self.dose_path)
+        index, reads = self.build_counting_reads()
+        self.assertEqual((index, reads), ({}, 0))
+
+    def test_recursive_and_detected(self):
+        nested_path = os.path.join(self.folder, "study", "RD1")
+        os.mkdir(os.path.dirname(nested_path))
+        write_dose_file(nested_path, "5.6.7.8")
+        self.assertNotIn("5.6.7.8", build_index(self.folder, self.index_file, recursive=True))
+        index = build_index(self.folder, self.index_file, recursive=True, detect=True)
+        self.assertEqual(index["5.6.7.8"][strings.RTDOSE], [os.path.abspath(nested_path)])
+        self.assertEqual(index["1.2.3.4"][strings.RTDOSE], [os.path.abspath(self.dose_path)])
+
+    def test_update_index(self):
+        index, _ = self.build_counting_reads()
+        dose_path = os.path.abspath(self.dose_path)
+        update_index(index, "struct.dcm", "1.2.3.4", strings.RTSTRUCT)
+        self.assertEqual(index["1.2.3.4"][strings.RTSTRUCT], ["struct.dcm"])
+
+        # A file rewritten with another study moves to that study
+        update_index(index, dose_path, "5.6.7.8", strings.RTDOSE)
+        self.assertEqual(index["1.2.3.4"][strings.RTDOSE], [])
+        self.assertEqual(index["5.6.7.8"][strings.RTDOSE], [dose_path])
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,75 @@
+''' Tests for the timings and counts recorded in code_files/metrics.py'''
+
+import os
+import shutil
+import tempfile
+import unittest
+import app
+from code_files import metrics
+from code_files.truth_table_reader import read_truth_table
+from tests.test_dicom_loader import write_dose_file
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        metrics.enabled = True
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        metrics.enabled = False
+        metrics.reset()
+        shutil.rmtree(self.folder)
+
+    def test_disabled(self):
+        metrics.enabled = False
+        with metrics.timer("read_plan"):
+            pass
+        metrics.count("files_extracted")
+        self.assertEqual(metrics.snapshot(), {"timings": {}, "counters": {}, "kept_calls": {}})
+
+    def test_timer_keeps_slowest(self):
+        metrics.record("read_plan", 0.5, "a.dcm")
+        metrics.record("read_plan", 2.0, "b.dcm")
+        metrics.record("read_plan", 1.0, "c.dcm")
+        self.assertEqual(metrics.timings["read_plan"], [3, 3.5, 2.0, "b.dcm"])
+
+    def test_merge(self):
+        metrics.record("read_plan", 1.0, "a.dcm")
+        metrics.count("files_extracted")
+        worker = {"timings": {"read_plan": [2, 3.0, 2.5, "b.dcm"], "output": [1, 0.1, 0.1, None]},
+                  "counters": {"files_extracted": 2, "files_skipped": 1}}
+        metrics.merge(worker)
+        self.assertEqual(metrics.timings["read_plan"], [3, 4.0, 2.5, "b.dcm"])
+        self.assertEqual(metrics.timings["output"], [1, 0.1, 0.1, None])
+        self.assertEqual(metrics.counters, {"files_extracted": 3, "files_skipped": 1})
+
+    def test_process_dicom(self):
+        truth_table = read_truth_table("data/truth_table_lvl3.csv")
+        dose_path = os.path.join(self.folder, "dose.dcm")
+        write_dose_file(dose_path, "1.2.3.4")
+        app.process_dicom("tests/resources/YellowLvlIII_7a.dcm", self.folder, 7, truth_table, None)
+        app.process_dicom(dose_path, self.folder, 7, truth_table, None)
+
+        self.assertEqual(metrics.counters, {"files_extracted": 1, "files_skipped": 1})
+        for name in ("process_dicom", "read_header", "read_plan", "extract.gantry", "evaluate.gantry", "output"):
+            self.assertIn(name, metrics.timings)
+        self.assertEqual(metrics.timings["process_dicom"][0], 2)
+
+    def test_export(self):
+        metrics.record("extract.field size", 0.25, "a.dcm")
+        metrics.count("files_failed")
+        json_file = os.path.join(self.folder, "run.json")
+        prometheus_file = os.path.join(self.folder, "run.prom")
+        metrics.export_json(json_file, truth_table="data/truth_table_lvl3.csv")
+        metrics.export_prometheus(prometheus_file)
+
+        with open(prometheus_file) as prom:
+            lines = prom.read().splitlines()
+        self.assertIn('plan_checker_stage_seconds_sum{stage="extract.field size"} 0.25', lines)
+        self.assertIn('plan_checker_stage_seconds_count{stage="extract.field size"} 1', lines)
+        self.assertIn('plan_checker_files_failed_total 1', lines)
+        self.assertEqual(os.listdir(self.folder).count("run.prom.tmp"), 0)
+
+if __name__ == '__main__' :
+    unittest.main()
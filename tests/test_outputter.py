@@ -0,0 +1,63 @@
+''' Tests for writing reports of the extracted and evaluated parameters'''
+
+import csv
+import json
+import os
+import tempfile
+import unittest
+from code_files import strings
+from code_files.outputter import open_report, BatchReport
+
+class TestBatchReport(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.parameters = dict((parameter, parameter + " value") for parameter in strings.parameters)
+        self.parameters[strings.SSD] = [85.19, 89.42]
+        self.evaluations = dict((parameter, strings.PASS) for parameter in strings.parameters)
+        self.solutions = dict((parameter, strings.ANY_VALUE) for parameter in strings.parameters)
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write_report(self, name):
+        filepath = os.path.join(self.folder.name, name)
+        with open_report(filepath) as report:
+            for plan in ("a.dcm", "b.dcm"):
+                report.write(plan, 7, self.parameters, self.evaluations, self.solutions)
+        return filepath
+
+    def test_csv_report(self):
+        with open(self.write_report("report.csv"), newline='') as report:
+            rows = list(csv.reader(report))
+        self.assertEqual(rows[0], BatchReport.headers)
+        # One row per plan and parameter
+        self.assertEqual(len(rows), 1 + 2 * len(strings.parameters))
+        self.assertIn(["b.dcm", "7", strings.SSD, "[85.19, 89.42]", strings.PASS, strings.ANY_VALUE], rows)
+
+    def test_json_lines_report(self):
+        with open(self.write_report("report.jsonl")) as report:
+            rows = [json.loads(line) for line in report]
+        self.assertEqual(len(rows), 2 * len(strings.parameters))
+        ssd_row = [row for row in rows if row["Parameter Name"] == strings.SSD][0]
+        self.assertEqual(ssd_row["Parameter Value"], [85.19, 89.42])
+        self.assertEqual(ssd_row["Case"], 7)
+
+    def test_truth_table_column(self):
+        filepath = os.path.join(self.folder.name, "report.csv")
+        with open_report(filepath, truth_tables=True) as report:
+            report.write("a.dcm", 7, self.parameters, self.evaluations, self.solutions, "truth_table_lvl2")
+        with open(filepath, newline='') as report:
+            rows = list(csv.reader(report))
+        self.assertEqual(rows[0][:3], ["Plan", "Truth Table", "Case"])
+        self.assertEqual(rows[1][:3], ["a.dcm", "truth_table_lvl2", "7"])
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            open_report(os.path.join(self.folder.name, "report.xlsx"))
+
+if __name__ == '__main__' :
+    unittest.main()
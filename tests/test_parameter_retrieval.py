@@ -4,6 +4,7 @@ import unittest
 import pydicom
 from code_files import strings
 from code_files.parameters.parameter_retrieval import extract_parameters, evaluate_parameters
+from code_files.parameters.plan_summary import PlanSummary
 from app import dose_struct_references
 
 class TestIMRTExtractionValues(unittest.TestCase): 
@@ -66,6 +67,29 @@ class TestVMATExtractionValues(unittest.TestCase):
         self.assertEqual(self.extracted[strings.energy], '6')
 
 
+class TestPlanSummary(unittest.TestCase):
+    ''' Tests for the summary of beams shared by the extraction functions'''
+
+    @classmethod
+    def setUpClass(self):
+        self.imrt = PlanSummary(pydicom.dcmread('tests/resources/YellowLvlIII_7a.dcm', force=True))
+        self.vmat = PlanSummary(pydicom.dcmread('tests/resources/YellowLvlIII_7b.dcm', force=True))
+
+    def test_setup_beam_excluded(self):
+        self.assertEqual(self.imrt.number_of_beams, 6)
+        self.assertEqual([int(beam.gantry) for beam in self.imrt.beams], [150, 60, 0, 300, 210])
+
+    def test_control_points(self):
+        beam = self.vmat.beams[0]
+        self.assertEqual(len(beam.control_point_gantry), len(beam.control_point_ssd))
+        self.assertGreater(len(beam.control_point_gantry), 2)
+        self.assertEqual(beam.control_point_gantry[0], 180.0)
+
+    def test_vmat_extraction_uses_summary(self):
+        extracted = extract_parameters(pydicom.dcmread('tests/resources/YellowLvlIII_7b.dcm', force=True), {}, 7)
+        self.assertEqual(extracted[strings.gantry], list(self.vmat.beams[0].control_point_gantry))
+        self.assertEqual(extracted[strings.SSD], list(self.vmat.beams[0].control_point_ssd))
+
 class TestEvaluation(unittest.TestCase): 
     ''' Tests for verifying that evaluation function works correctly
     Each case (from 1-17) of the truth table has its own test against a set of parameters that *should* pass.
@@ -108,6 +132,16 @@ class TestEvaluation(unittest.TestCase):
             passing_data[strings.SSD] = passing_data[strings.SSD].split(',')
             self.assertEqual(evaluate_parameters(passing_data, self.truth_table, case), self.pass_evaluation)
 
+    def test_compiled_matches_plain_table(self):
+        # Evaluating against a plain dictionary parses the case's values on the fly, with the same results
+        plain_table = dict(self.truth_table)
+        for case in (1, 2, 6, 9):
+            data = dict([(key,value[case-1]) for key,value in self.truth_table.items()])
+            del data[strings.case]
+            data[strings.SSD] = data[strings.SSD].split(',')
+            data[strings.gantry] = "0"
+            self.assertEqual(evaluate_parameters(data, plain_table, case), evaluate_parameters(data, self.truth_table, case))
+
     def test_fail_lvl3_prescription(self):
         # Test that a prescription value that is meant to fail does get failed by the evaluation function
         case = 1
@@ -0,0 +1,58 @@
+''' Tests for the threaded read/process/write pipeline'''
+
+import random
+import threading
+import time
+import unittest
+from code_files.pipeline import run_pipeline
+
+class TestPipeline(unittest.TestCase):
+
+    def test_results_in_order(self):
+        def read(item):
+            # Reads finish in a different order to the one they were started in
+            time.sleep(random.random() / 100)
+            return item
+        results = list(run_pipeline(range(50), read, lambda item: item * 2, lambda item: item + 1, readers=4, queue_size=3))
+        self.assertEqual(results, [item * 2 + 1 for item in range(50)])
+
+    def test_reads_overlap_processing(self):
+        def slow_read(item):
+            time.sleep(0.05)
+            return item
+        def slow_process(item):
+            time.sleep(0.05)
+            return item
+        start = time.perf_counter()
+        list(run_pipeline(range(10), slow_read, slow_process, lambda item: item, readers=2, queue_size=2))
+        # One at a time this would take 10 * (0.05 + 0.05) seconds
+        self.assertLess(time.perf_counter() - start, 0.8)
+
+    def test_reads_stay_bounded(self):
+        reading = []
+        def read(item):
+            reading.append(item)
+            return item
+        def write(item):
+            # The readers can't get more than a few items ahead of the writer
+            self.assertLessEqual(len(reading) - item, 2 * 2 + 2 + 2)
+            time.sleep(0.01)
+            return item
+        list(run_pipeline(range(30), read, lambda item: item, write, readers=2, queue_size=2))
+
+    def test_error_stops_pipeline(self):
+        def process(item):
+            if item == 5:
+                raise ValueError("bad plan")
+            return item
+        results = []
+        with self.assertRaises(ValueError):
+            for result in run_pipeline(range(100), lambda item: item, process, lambda item: item, queue_size=2):
+                results.append(result)
+        self.assertEqual(results, [0, 1, 2, 3, 4])
+        # The pipeline's threads have all finished
+        time.sleep(0.05)
+        self.assertFalse([thread for thread in threading.enumerate() if thread.name.startswith("pipeline")])
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,62 @@
+''' Tests for the profiling of a run in code_files/profiling.py'''
+
+import os
+import shutil
+import tempfile
+import unittest
+import app
+from code_files import metrics
+from code_files.profiling import Profiler, library
+from code_files.truth_table_reader import read_truth_table
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        metrics.reset()
+        shutil.rmtree(self.folder)
+
+    def test_library(self):
+        self.assertEqual(library(app.__file__), "project")
+        self.assertEqual(library(os.path.join("site-packages", "pydicom", "filereader.py")), "pydicom")
+        self.assertEqual(library("~"), "builtins")
+        self.assertEqual(library(os.__file__), "other")
+
+    def test_profile_files(self):
+        truth_table = read_truth_table("data/truth_table_lvl3.csv")
+        plans = ["tests/resources/YellowLvlIII_7a.dcm", "tests/resources/YellowLvlIII_7b.dcm"]
+        profiler = Profiler(os.path.join(self.folder, "profile"), slowest=1, interval=0.001)
+        profiler.start()
+        for plan in plans:
+            app.process_dicom(plan, self.folder, 7, truth_table, None)
+        files = profiler.stop()
+
+        self.assertEqual([os.path.basename(path) for path in files], ["profile.prof", "profile.folded", "profile.txt"])
+        self.assertFalse(metrics.enabled)
+        with open(files[1]) as folded:
+            for line in folded:
+                stack, samples = line.rsplit(" ", 1)
+                self.assertGreater(int(samples), 0)
+        with open(files[2]) as summary:
+            text = summary.read()
+        self.assertIn("Slowest 1 of 2 plans:", text)
+        self.assertIn("Hottest pydicom functions:", text)
+
+    def test_pipelined_plans(self):
+        # Plans processed in a pipeline are timed across its stages, so they're listed among the slowest plans too
+        truth_table = read_truth_table("data/truth_table_lvl3.csv")
+        plans = ["tests/resources/YellowLvlIII_7a.dcm", "tests/resources/YellowLvlIII_7b.dcm"]
+        profiler = Profiler(os.path.join(self.folder, "profile"), slowest=2, interval=0.001)
+        profiler.start()
+        list(app.process_pipelined(plans, self.folder, 7, truth_table, None, 2))
+        files = profiler.stop()
+        with open(files[2]) as summary:
+            text = summary.read()
+        self.assertIn("Slowest 2 of 2 plans:", text)
+        for plan in plans:
+            self.assertIn(plan, text)
+
+if __name__ == '__main__' :
+    unittest.main()
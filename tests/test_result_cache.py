@@ -0,0 +1,67 @@
+''' Tests for the cache of processed plan results'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from code_files import result_cache
+from code_files.result_cache import ResultCache, code_version
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.folder, "results.sqlite")
+        self.truth_table_file = os.path.join(self.folder, "truth_table.csv")
+        shutil.copy("data/truth_table_lvl3.csv", self.truth_table_file)
+        self.plan = 'tests/resources/YellowLvlIII_7a.dcm'
+        self.parameters = {"gantry": "0", "SSD": [85.19, 89.42]}
+        self.evaluations = {"gantry": "PASS", "SSD": "FAIL"}
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_round_trip(self):
+        cache = ResultCache(self.cache_file, self.truth_table_file, 1024 * 1024)
+        key = cache.key(self.plan, 7, None)
+        self.assertIsNone(cache.get(key))
+        cache.put(key, self.parameters, self.evaluations)
+
+        # A new cache on the same file (e.g. on the next run) sees the stored results
+        cache = ResultCache(self.cache_file, self.truth_table_file, 1024 * 1024)
+        self.assertEqual(cache.get(cache.key(self.plan, 7, None)), (self.parameters, self.evaluations))
+
+    def test_key_changes(self):
+        cache = ResultCache(self.cache_file, self.truth_table_file, 1024 * 1024)
+        key = cache.key(self.plan, 7, None)
+        self.assertNotEqual(key, cache.key(self.plan, 8, None))
+        self.assertNotEqual(key, cache.key('tests/resources/YellowLvlIII_7b.dcm', 7, None))
+
+        # Editing the truth table invalidates results evaluated against it
+        with open(self.truth_table_file, 'a') as truth_table:
+            truth_table.write("\n")
+        self.assertNotEqual(key, ResultCache(self.cache_file, self.truth_table_file, 1024 * 1024).key(self.plan, 7, None))
+
+    def test_code_version(self):
+        # Changing the code that reads the plans invalidates results, as well as the extraction and evaluation code
+        code = os.path.join(self.folder, "code_files")
+        shutil.copytree(os.path.dirname(result_cache.__file__), code, ignore=shutil.ignore_patterns("__pycache__"))
+        with mock.patch.object(result_cache, "__file__", os.path.join(code, "result_cache.py")):
+            version = code_version()
+            for name in ("dicom_loader.py", "compact_plan.py", os.path.join("parameters", "evaluator_functions.py")):
+                with open(os.path.join(code, name), 'a') as source:
+                    source.write("\n")
+                self.assertNotEqual(code_version(), version)
+                version = code_version()
+
+    def test_eviction(self):
+        cache = ResultCache(self.cache_file, self.truth_table_file, 200)
+        for i in range(5):
+            cache.put(str(i), self.parameters, self.evaluations)
+        # Only the most recently used results fit in the cache
+        self.assertIsNone(cache.get("0"))
+        self.assertIsNotNone(cache.get("4"))
+
+if __name__ == '__main__' :
+    unittest.main()
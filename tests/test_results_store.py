@@ -0,0 +1,81 @@
+''' Tests for keeping the results of every run in one database'''
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import app
+from code_files import strings, results_store
+from code_files.results_store import ResultsStore, query
+from code_files.truth_table_reader import read_truth_table
+
+class TestResultsStore(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.store_file = os.path.join(self.folder, "results.sqlite")
+
+    def add_plan(self, store, location, case, gantry_evaluation, identifiers=("1.2.3", "4.5.6")):
+        parameters = dict((parameter, "0") for parameter in strings.parameters)
+        evaluations = dict((parameter, strings.PASS) for parameter in strings.parameters)
+        evaluations[strings.gantry] = gantry_evaluation
+        parameters[strings.SSD] = [950.0, 1000.0]
+        store.add(location, case, parameters, evaluations, dict(parameters), identifiers=identifiers)
+
+    def test_batches(self):
+        self.addCleanup(setattr, results_store, "batch_size", results_store.batch_size)
+        results_store.batch_size = 2
+        store = ResultsStore(self.store_file)
+        store.start_run(["data/truth_table_lvl3.csv"], ["data/samples"])
+        for number in range(3):
+            self.add_plan(store, f"plan{number}.dcm", 7, strings.FAIL)
+        # Results are inserted a batch at a time, and the rest once the store is closed
+        self.assertEqual(store.count, 2)
+        self.assertEqual(len(query(self.store_file, parameter=strings.gantry)), 2)
+        store.close()
+        self.assertEqual(len(query(self.store_file)), 3 * len(strings.parameters))
+
+    def test_query(self):
+        store = ResultsStore(self.store_file)
+        store.start_run([], [])
+        self.add_plan(store, "old.dcm", 7, strings.FAIL)
+        store.flush()
+        # Earlier results, as if they had been processed two months ago
+        store.connection.execute("UPDATE results SET processed = processed - 60 * 24 * 60 * 60")
+        store.connection.execute("UPDATE plans SET processed = processed - 60 * 24 * 60 * 60")
+        store.connection.commit()
+        self.add_plan(store, "new.dcm", 7, strings.FAIL, ("7.8.9", "4.5.6"))
+        self.add_plan(store, "passed.dcm", 7, strings.PASS)
+        self.add_plan(store, "case6.dcm", 6, strings.FAIL)
+        store.close()
+
+        rows = query(self.store_file, parameter=strings.gantry, case=7, evaluation=strings.FAIL, days=30)
+        self.assertEqual([row["location"] for row in rows], ["new.dcm"])
+        self.assertEqual((rows[0]["sop_instance_uid"], rows[0]["study_instance_uid"]), ("7.8.9", "4.5.6"))
+        since = time.strftime("%Y-%m-%d", time.localtime(time.time() - 90 * 24 * 60 * 60))
+        rows = query(self.store_file, parameter=strings.gantry, case=7, evaluation=strings.FAIL, since=since)
+        self.assertEqual([row["location"] for row in rows], ["new.dcm", "old.dcm"])
+        self.assertEqual(len(query(self.store_file, parameter=strings.SSD, uid="7.8.9")), 1)
+        self.assertEqual(query(self.store_file, parameter=strings.SSD, uid="7.8.9")[0]["value"], "[950.0, 1000.0]")
+
+    def test_run(self):
+        # A run stores the identifiers of its plans, read along with their header
+        self.addCleanup(setattr, app, "results_store", app.results_store)
+        app.results_store = ResultsStore(self.store_file)
+        app.results_store.start_run(["data/truth_table_lvl3.csv"], ["tests/resources"])
+        path = "tests/resources/YellowLvlIII_7b.dcm"
+        record = app.process_dicom(path, self.folder, 7, read_truth_table("data/truth_table_lvl3.csv"), None)[1]
+        app.report_record(record)
+        app.results_store.close()
+
+        rows = query(self.store_file, parameter=strings.gantry)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual((rows[0]["location"], rows[0]["case"], rows[0]["evaluation"]),
+                         (path, 7, record["evaluations"][strings.gantry]))
+        self.assertEqual(rows[0]["sop_instance_uid"], "2.16.840.1.114337.1.1.1597372480.0")
+        self.assertEqual(rows[0]["study_instance_uid"], "1.2.840.113619.2.278.3.380434001.132.1565818860.396")
+
+if __name__ == '__main__' :
+    unittest.main()
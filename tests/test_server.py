@@ -0,0 +1,103 @@
+''' Tests for checking plans through the HTTP API of server.py'''
+
+import http.client
+import json
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from code_files import server
+from code_files.parameters.parameter_retrieval import extract_parameters, evaluate_parameters
+from code_files.dicom_loader import read_plan
+from code_files.truth_table_reader import read_truth_table
+
+class UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__("localhost")
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+class TestServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.truth_table = read_truth_table("data/truth_table_lvl3.csv")
+        self.plans = server.PlanServer({"truth_table_lvl3": self.truth_table})
+        self.server = server.make_server("127.0.0.1:0", self.plans)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.plans.close()
+
+    def request(self, method, path, body=None, content_type="application/json", connection=None):
+        connection = connection or http.client.HTTPConnection(*self.server.server_address)
+        if isinstance(body, dict):
+            body = json.dumps(body)
+        connection.request(method, path, body, {"Content-Type": content_type} if body is not None else {})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+
+    def test_check_path(self):
+        path = "tests/resources/YellowLvlIII_7a.dcm"
+        status, result = self.request("POST", "/check", dict(path=path, case=7))
+        self.assertEqual(status, 200)
+        parameters = extract_parameters(read_plan(path), None, 7)
+        self.assertEqual(result["parameters"], json.loads(json.dumps(parameters)))
+        self.assertEqual(result["evaluations"], evaluate_parameters(parameters, self.truth_table, 7))
+        self.assertEqual((result["location"], result["truth_table"], result["case"]), (path, "truth_table_lvl3", 7))
+
+    def test_check_contents(self):
+        # Without a case, the case is worked out from the plan
+        with open("data/samples2/YellowLvlIII_8b.dcm", "rb") as plan:
+            status, result = self.request("POST", "/check?location=8b", plan.read(), "application/dicom")
+        self.assertEqual(status, 200)
+        self.assertEqual((result["location"], result["case"]), ("8b", 8))
+
+    def test_errors(self):
+        self.assertEqual(self.request("POST", "/check", dict(path="missing.dcm", case=7))[0], 404)
+        self.assertEqual(self.request("POST", "/check", dict(path="tests/resources/YellowLvlIII_7a.dcm", case=99))[0], 400)
+        self.assertEqual(self.request("POST", "/check", dict(path="tests/resources/YellowLvlIII_7a.dcm", case=7,
+                                                             truth_table="lvl1"))[0], 400)
+        self.assertEqual(self.request("POST", "/check", "not json")[0], 400)
+        self.assertEqual(self.request("POST", "/check", "[1]")[0], 400)
+        self.assertEqual(self.request("POST", "/check", '"tests/resources/YellowLvlIII_7a.dcm"')[0], 400)
+        self.assertEqual(self.request("GET", "/elsewhere")[0], 404)
+
+    def test_health(self):
+        status, health = self.request("GET", "/health")
+        self.assertEqual((status, health["truth_tables"]), (200, ["truth_table_lvl3"]))
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "Unix sockets aren't available")
+    def test_unix_socket(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        path = os.path.join(folder.name, "plancheck.sock")
+        unix_server = server.make_server("unix:" + path, self.plans)
+        threading.Thread(target=unix_server.serve_forever, daemon=True).start()
+        self.addCleanup(unix_server.server_close)
+        self.addCleanup(unix_server.shutdown)
+        status, result = self.request("POST", "/check", dict(path="tests/resources/YellowLvlIII_7b.dcm", case=7),
+                                      connection=UnixConnection(path))
+        self.assertEqual((status, result["case"]), (200, 7))
+
+        # The socket of an earlier server is replaced, but a file which isn't a socket is left alone
+        unix_server.shutdown()
+        unix_server.server_close()
+        server.make_server("unix:" + path, self.plans).server_close()
+        report = os.path.join(folder.name, "report.csv")
+        with open(report, "w") as report_file:
+            report_file.write("kept")
+        with self.assertRaises(ValueError):
+            server.make_server("unix:" + report, self.plans)
+        with open(report) as report_file:
+            self.assertEqual(report_file.read(), "kept")
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,128 @@
+''' Tests for spreading a batch over several workers through a shared work queue'''
+
+import csv
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+import app
+from code_files import sharding
+from code_files.sharding import WorkQueue
+
+class TestWorkQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.queue_file = os.path.join(self.folder, "queue.sqlite")
+        self.queue = WorkQueue(self.queue_file)
+        self.addCleanup(self.queue.close)
+        self.plans = [(f"plan{number}.dcm", None, 7) for number in range(5)]
+        self.assertEqual(self.queue.create(self.plans, dict(output=self.folder), size=2), 3)
+
+    def process_plan(self, path, input_folder, case_number):
+        if path == "plan3.dcm":
+            raise ValueError("broken plan")
+        return f"EXTRACTED  {path}", dict(location=path, case=case_number)
+
+    def test_manifest(self):
+        self.assertEqual(self.queue.settings(), dict(output=self.folder))
+        self.assertEqual(self.queue.plans(1), self.plans[:2])
+        self.assertEqual(self.queue.plans(3), self.plans[4:])
+
+    def test_claims(self):
+        self.assertEqual(self.queue.claim("a"), 1)
+        self.assertEqual(self.queue.claim("b"), 2)
+        # Only the worker holding a shard can renew or finish it
+        self.assertFalse(self.queue.renew(1, "b"))
+        self.assertTrue(self.queue.finish(2, "b"))
+        self.assertFalse(self.queue.finish(1, "b"))
+        self.assertEqual(self.queue.progress(), {sharding.LEASED: 1, sharding.DONE: 1, sharding.PENDING: 1})
+
+    def test_crashed_worker(self):
+        # A worker which claimed the first shard and never renewed its lease
+        self.assertEqual(self.queue.claim("crashed", lease=0.01), 1)
+        time.sleep(0.05)
+        finished = sharding.work(self.queue_file, self.process_plan, worker="b", log=lambda message: None)
+        self.assertEqual(finished, 3)
+        self.assertEqual(self.queue.progress(), {sharding.DONE: 3})
+        self.assertFalse(self.queue.finish(1, "crashed"))
+
+        results = list(sharding.merge(self.queue_file))
+        self.assertEqual([result["location"] for shard, result in results], [path for path, _, _ in self.plans])
+        self.assertIn("broken plan", results[3][1]["error"])
+        self.assertEqual(results[0][1]["record"], dict(location="plan0.dcm", case=7))
+
+    def test_expired_lease(self):
+        # A worker whose lease ran out doesn't replace the results of the worker which took its shard over
+        os.makedirs(sharding.results_folder(self.queue_file))
+        self.assertEqual(self.queue.claim("slow", lease=0.01), 1)
+        time.sleep(0.05)
+        self.assertEqual(self.queue.claim("b"), 1)
+        for worker in ("b", "slow"):
+            with open(os.path.join(self.folder, worker), 'w') as partial:
+                partial.write(worker)
+        self.assertTrue(self.queue.finish(1, "b", os.path.join(self.folder, "b")))
+        self.assertFalse(self.queue.finish(1, "slow", os.path.join(self.folder, "slow")))
+        with open(sharding.results_file(self.queue_file, 1)) as results:
+            self.assertEqual(results.read(), "b")
+        self.assertTrue(os.path.exists(os.path.join(self.folder, "slow")))
+
+    def test_gives_up(self):
+        for attempt in range(sharding.max_attempts):
+            self.assertEqual(self.queue.claim("crashed", lease=0.01), 1)
+            time.sleep(0.05)
+        self.queue.expire()
+        self.assertEqual(self.queue.shards()[0], (1, sharding.FAILED))
+        self.assertEqual(self.queue.claim("b"), 2)
+
+class TestShardedBatch(unittest.TestCase):
+    ''' Tests that a batch processed by a worker and merged gives the same report as a normal run'''
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        for name in ("truth_tables", "per_file_output", "auto_case", "review_list", "skip_dose_structure"):
+            self.addCleanup(setattr, app, name, getattr(app, name))
+        app.skip_dose_structure = True
+
+    def test_merged_report(self):
+        queue_file = os.path.join(self.folder, "queue.sqlite")
+        paths = [os.path.abspath(os.path.join("tests/resources", name)) for name in ("YellowLvlIII_7a.dcm", "YellowLvlIII_7b.dcm")]
+        queue = WorkQueue(queue_file)
+        queue.create([(path, None, 7) for path in paths], dict(truth_table_files=[os.path.abspath("data/truth_table_lvl3.csv")],
+                     case_number=7, output=self.folder, per_file=False, auto_case=False), size=1)
+        queue.close()
+        app.work_shards(queue_file)
+        merged = os.path.join(self.folder, "merged.csv")
+        app.run_sharded("merge", queue_file, [], self.folder, 7, [], report_file=merged)
+
+        serial = os.path.join(self.folder, "serial.csv")
+        with app.open_report(serial) as report:
+            for path in paths:
+                app.report_record(app.process_dicom(path, self.folder, 7, app.read_truth_table("data/truth_table_lvl3.csv"), None)[1], report)
+        with open(merged, newline='') as merged_file, open(serial, newline='') as serial_file:
+            self.assertEqual(list(csv.reader(merged_file)), list(csv.reader(serial_file)))
+
+    def test_cases_per_input(self):
+        # Each input's own case is used, without one for the whole batch
+        queue_file = os.path.join(self.folder, "queue.sqlite")
+        report_file = os.path.join(self.folder, "report.csv")
+        inputs = ["tests/resources/YellowLvlIII_7a.dcm,7", "tests/resources/YellowLvlIII_7b.dcm,6"]
+        # The coordinator's wait for workers is where this process works through the shards itself
+        with mock.patch.object(sharding, "wait", side_effect=lambda queue_file, log: app.work_shards(queue_file)):
+            app.run_sharded("coordinate", queue_file, inputs, self.folder, None, ["data/truth_table_lvl3.csv"],
+                            workers=0, report_file=report_file)
+        with open(report_file, newline='') as report:
+            cases = set((os.path.basename(row["Plan"]), row["Case"]) for row in csv.DictReader(report))
+        self.assertEqual(cases, {("YellowLvlIII_7a.dcm", "7"), ("YellowLvlIII_7b.dcm", "6")})
+
+        # An input without a case is still refused
+        with self.assertRaises(SystemExit):
+            app.run_sharded("coordinate", os.path.join(self.folder, "other.sqlite"), inputs + ["tests/resources"],
+                            self.folder, None, ["data/truth_table_lvl3.csv"], workers=0)
+
+if __name__ == '__main__' :
+    unittest.main()
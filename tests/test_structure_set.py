@@ -0,0 +1,101 @@
+''' Tests for finding which structures of an RTSTRUCT contain a point'''
+
+import os
+import tempfile
+import unittest
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from code_files import strings, structure_set
+from code_files.structure_set import StructureSet
+
+def square(centre, half_width, z):
+    x, y = centre
+    return [x - half_width, y - half_width, z, x + half_width, y - half_width, z,
+            x + half_width, y + half_width, z, x - half_width, y + half_width, z]
+
+def write_struct_file(path, rois, uid=None):
+    ''' Writes an RTSTRUCT with an ROI for each (name, {z: [contour data, ...]}) in rois'''
+    dataset = Dataset()
+    dataset.file_meta = FileMetaDataset()
+    dataset.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.481.3"
+    dataset.file_meta.MediaStorageSOPInstanceUID = dataset.SOPInstanceUID = uid or generate_uid()
+    dataset.SOPClassUID = dataset.file_meta.MediaStorageSOPClassUID
+    dataset.Modality = strings.RTSTRUCT
+    dataset.StudyInstanceUID = generate_uid()
+    structure_set_rois, roi_contours = [], []
+    for number, (name, slices) in enumerate(rois, start=1):
+        roi = Dataset()
+        roi.ROINumber = number
+        roi.ROIName = name
+        structure_set_rois.append(roi)
+        contours = []
+        for z, slice_contours in slices.items():
+            for contour_data in slice_contours:
+                contour = Dataset()
+                contour.ContourGeometricType = "CLOSED_PLANAR"
+                contour.ContourData = contour_data
+                contours.append(contour)
+        roi_contour = Dataset()
+        roi_contour.ReferencedROINumber = number
+        roi_contour.ContourSequence = Sequence(contours)
+        roi_contours.append(roi_contour)
+    dataset.StructureSetROISequence = Sequence(structure_set_rois)
+    dataset.ROIContourSequence = Sequence(roi_contours)
+    dataset.save_as(path, enforce_file_format=True)
+    return dataset
+
+slices = [-3.0, 0.0, 3.0]
+rois = [
+    # A 40 mm square on each slice
+    ("CShape", dict((z, [square((0, 0), 20, z)]) for z in slices)),
+    # A 20 mm square with a 10 mm hole in the middle, on each slice
+    ("Ring", dict((z, [square((50, 0), 10, z), square((50, 0), 5, z)]) for z in slices)),
+    # A triangle on one slice
+    ("Triangle", {0.0: [[100, 0, 0, 120, 0, 0, 100, 20, 0]]}),
+]
+
+class TestStructureSet(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "struct.dcm")
+        self.dataset = write_struct_file(self.path, rois)
+        self.structures = StructureSet(self.dataset)
+
+    @classmethod
+    def tearDownClass(self):
+        self.folder.cleanup()
+
+    def test_structures(self):
+        self.assertEqual(list(self.structures.structures), ["CShape", "Ring", "Triangle"])
+        self.assertEqual(list(self.structures.structures["CShape"].z), slices)
+
+    def test_contains(self):
+        points = np.array([(0, 0, 0), (19, -19, 3), (21, 0, 0), (0, 0, 4), (0, 0, 10), (5, 5, 1.2)])
+        np.testing.assert_array_equal(self.structures.contains("CShape", points), [True, True, False, True, False, True])
+
+    def test_holes(self):
+        points = np.array([(50, 0, 0), (58, 0, 0), (50, 8, -3), (61, 0, 0)])
+        np.testing.assert_array_equal(self.structures.contains("Ring", points), [False, True, True, False])
+
+    def test_triangle(self):
+        points = np.array([(105, 5, 0), (115, 15, 0), (101, 1, 0.4)])
+        np.testing.assert_array_equal(self.structures.contains("Triangle", points), [True, False, True])
+
+    def test_structures_containing(self):
+        self.assertEqual(self.structures.structures_containing((0, 0, 0)), ["CShape"])
+        self.assertEqual(self.structures.structures_containing((55, 0, 0)), ["Ring"])
+        self.assertEqual(self.structures.structures_containing((0, 100, 0)), [])
+
+    def test_load_once(self):
+        structure_set._cache.clear()
+        first = structure_set.load(self.path)
+        self.assertIs(structure_set.load(self.path), first)
+        # Another file with the same structure set isn't parsed again
+        copy = os.path.join(self.folder.name, "copy.dcm")
+        write_struct_file(copy, rois[:1], uid=self.dataset.SOPInstanceUID)
+        self.assertIs(structure_set.load(copy), first)
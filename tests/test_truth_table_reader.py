@@ -1,7 +1,9 @@
 ''' Test that the truth table reader function parses the csv input correctly'''
 
 import unittest
+from code_files import strings
 from code_files.truth_table_reader import read_truth_table
+from code_files.parameters.truth_table_rules import CompiledTruthTable, parse_case
 
 class TestTruthTableReader(unittest.TestCase):
 
@@ -52,3 +54,34 @@ class TestTruthTableReader(unittest.TestCase):
         for parameter in self.truth_table:
             for i in range(0, len(self.truth_table['case'])):
                 self.assertEqual(tt[parameter][i].upper(), self.truth_table[parameter][i].upper())
+
+class TestCompiledTruthTable(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.lvl2 = read_truth_table('data/truth_table_lvl2.csv')
+        self.lvl3 = read_truth_table('data/truth_table_lvl3.csv')
+
+    def test_is_compiled(self):
+        self.assertIsInstance(self.lvl3, CompiledTruthTable)
+        self.assertEqual(len(self.lvl3.rules), len(self.lvl3["case"]))
+
+    def test_load_time_errors(self):
+        self.assertEqual(self.lvl3.errors, [])
+        # The level 2 table describes some wedges by their orientation, which can't be evaluated
+        self.assertIn((4, strings.wedge, '30 Heel RT'), [error[:3] for error in self.lvl2.errors])
+
+    def test_parsed_values(self):
+        rules = self.lvl3.rules[6]
+        self.assertEqual(rules[strings.SSD].values, (None, 89, 93, 89, None))
+        self.assertEqual(rules[strings.gantry].values, (150, 60, 0, 300, 210))
+        self.assertTrue(rules[strings.collimator].negated)
+        self.assertEqual(rules[strings.collimator].angle, "0")
+        self.assertEqual(rules[strings.prescription_dose].items, ("50", "25", None))
+        self.assertTrue(self.lvl3.rules[9][strings.gantry].any)
+
+    def test_bad_values(self):
+        truth_table = {strings.case: ["1"], strings.gantry: ["90,abc"], strings.prescription_dose: ["50/25"]}
+        rules = parse_case(truth_table, 1)
+        self.assertIsNotNone(rules[strings.gantry].error)
+        self.assertIsNotNone(rules[strings.prescription_dose].error)
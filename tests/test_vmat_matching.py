@@ -0,0 +1,51 @@
+''' Tests for matching VMAT control point SSDs against the truth table'''
+
+import random
+import unittest
+from code_files import strings
+from code_files.parameters.vmat_matching import match_gantry_ssd
+
+def nested_loop_match(gantry_angles, ssds, table_gantry, table_ssd):
+    ''' The direct comparison of every truth table angle with every control point, to check results against'''
+    for gantry, ssd in zip(table_gantry, table_ssd):
+        if gantry is None or ssd is None:
+            continue
+        for control_point_gantry, control_point_ssd in zip(gantry_angles, ssds):
+            if abs(control_point_gantry - gantry) < 0.3 and abs(control_point_ssd - ssd) > 1:
+                return strings.FAIL
+    return strings.PASS
+
+class TestMatchGantrySSD(unittest.TestCase):
+
+    def test_diagnostics(self):
+        gantry_angles = [180.0, 150.1, 150.0, 90.0, 60.2, 0.0]
+        ssds = [85.0, 85.5, 85.2, 90.0, 89.3, 95.0]
+        result, matches = match_gantry_ssd(gantry_angles, ssds, (150, 60, 0), (None, 89, 93))
+        self.assertEqual(result, strings.FAIL)
+        # The '?' SSD at 150 degrees isn't checked
+        self.assertEqual([match.gantry for match in matches], [60, 0])
+        self.assertEqual(matches[0].control_points, [4])
+        self.assertEqual(matches[0].result, strings.PASS)
+        self.assertEqual(matches[1].control_points, [5])
+        self.assertAlmostEqual(matches[1].max_deviation, 2.0)
+        self.assertEqual(matches[1].result, strings.FAIL)
+
+    def test_no_control_points_near_angle(self):
+        result, matches = match_gantry_ssd([10.0, 20.0], [90.0, 90.0], (300,), (80,))
+        self.assertEqual(result, strings.PASS)
+        self.assertEqual(matches[0].control_points, [])
+        self.assertIsNone(matches[0].max_deviation)
+
+    def test_same_as_nested_loop(self):
+        generator = random.Random(7)
+        table_gantry = (150, 60, 0, 300, 210)
+        table_ssd = (None, 89, 93, 89, None)
+        for _ in range(200):
+            # Angles on a 0.1 degree grid, so that some fall exactly on the edge of the tolerance
+            gantry_angles = [round(generator.uniform(0, 360), 1) for _ in range(generator.randint(1, 400))]
+            ssds = [generator.uniform(87, 95) for _ in gantry_angles]
+            result, _ = match_gantry_ssd(gantry_angles, ssds, table_gantry, table_ssd)
+            self.assertEqual(result, nested_loop_match(gantry_angles, ssds, table_gantry, table_ssd))
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,87 @@
+''' Tests for watching folders for new DICOMs'''
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from code_files.watcher import FolderWatcher
+
+class TestFolderWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.existing = os.path.join(self.folder, "existing.dcm")
+        self.write(self.existing, b"existing")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, path, data, mode='wb'):
+        with open(path, mode) as dicom:
+            dicom.write(data)
+
+    def wait_for(self, watcher, seconds=3.0):
+        ''' Polls the watcher until it reports something, or seconds have passed'''
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            ready = watcher.poll(timeout=0.05)
+            if ready:
+                return ready
+        return []
+
+    def check_watcher(self, use_inotify):
+        with FolderWatcher([self.folder], settle_time=0.3, poll_interval=0.05, use_inotify=use_inotify) as watcher:
+            # Files that were already there aren't reported, nor are files which aren't DICOMs
+            self.write(os.path.join(self.folder, "notes.txt"), b"notes")
+            self.assertEqual(self.wait_for(watcher, 0.5), [])
+
+            # A file isn't reported until it stops changing
+            new = os.path.join(self.folder, "new.dcm")
+            self.write(new, b"part one")
+            self.assertEqual(watcher.poll(timeout=0.1), [])
+            self.write(new, b", part two", mode='ab')
+            self.assertEqual(self.wait_for(watcher), [new])
+
+            # It is reported again when it's modified, but only once
+            self.write(self.existing, b"modified")
+            self.assertEqual(self.wait_for(watcher), [self.existing])
+            self.assertEqual(self.wait_for(watcher, 0.5), [])
+        return watcher.method
+
+    def check_discovery(self, use_inotify):
+        # The same files are watched for as a batch run would find, in subfolders too
+        os.makedirs(os.path.join(self.folder, "set1", "old"))
+        discovery = dict(recursive=True, include=["*.dcm", "RP*"], exclude=["old", "*.bak.dcm"], detect=True, threads=4)
+        with FolderWatcher([self.folder], settle_time=0.3, poll_interval=0.05, use_inotify=use_inotify,
+                           discovery=discovery) as watcher:
+            plan = os.path.join(self.folder, "set1", "RP1")
+            self.write(plan, b"\0" * 128 + b"DICM")
+            self.write(os.path.join(self.folder, "set1", "RP2"), b"not a DICOM")
+            self.write(os.path.join(self.folder, "set1", "old", "RP3.dcm"), b"\0" * 128 + b"DICM")
+            self.write(os.path.join(self.folder, "RP4.bak.dcm"), b"\0" * 128 + b"DICM")
+            self.assertEqual(self.wait_for(watcher), [plan])
+
+            # Including subfolders made after the watch started
+            os.makedirs(os.path.join(self.folder, "set2", "beams"))
+            later = os.path.join(self.folder, "set2", "beams", "RP5.dcm")
+            self.write(later, b"\0" * 128 + b"DICM")
+            self.assertEqual(self.wait_for(watcher), [later])
+            self.assertEqual(self.wait_for(watcher, 0.5), [])
+
+        # Subfolders aren't watched unless recursive
+        with FolderWatcher([self.folder], settle_time=0.3, poll_interval=0.05, use_inotify=use_inotify) as watcher:
+            self.write(os.path.join(self.folder, "set1", "RP6.dcm"), b"\0" * 128 + b"DICM")
+            self.assertEqual(self.wait_for(watcher, 0.5), [])
+
+    def test_polling(self):
+        self.assertEqual(self.check_watcher(use_inotify=False), "polling")
+        self.check_discovery(use_inotify=False)
+
+    def test_inotify(self):
+        # Falls back to polling where inotify isn't available, which is checked the same way
+        self.check_watcher(use_inotify=True)
+        self.check_discovery(use_inotify=True)
+
+if __name__ == '__main__' :
+    unittest.main()